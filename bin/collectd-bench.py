@@ -0,0 +1,1278 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Benchmarks of the collectd plugins
+#
+# Measure the cost of the plugins without a collectd daemon, using the
+# proxy collectd of collectd-cli.py.  Each benchmark is a sub command,
+# see --help.
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import glob
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+LIB_DIR = os.path.join(os.path.dirname(BIN_DIR), 'lib')
+# the fake API of the tests
+TESTS_DIR = os.path.join(os.path.dirname(BIN_DIR), 'tests')
+sys.path.insert(0, LIB_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+from collectd_openstack import churn
+from collectd_openstack import concurrency
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import notifications
+from collectd_openstack import ratelimit
+from collectd_openstack import resilience
+from collectd_openstack import rest
+from collectd_openstack import schedule
+from collectd_openstack import sharding
+from collectd_openstack import shm
+from collectd_openstack import topk
+from collectd_openstack import worker
+
+import fakeapi
+
+
+def load_cli():
+    """Load collectd-cli.py as a module to reuse its proxy classes"""
+    path = os.path.join(BIN_DIR, 'collectd-cli.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('collectd_cli', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('collectd_cli', path)
+
+
+def load_plugin(name):
+    """Namespace of a plugin of lib/ loaded with the proxy collectd"""
+    cli = load_cli()
+    return cli.load_plugin(os.path.join(LIB_DIR, name), cli.Collectd())
+
+
+def measure(function, repeat):
+    """Best time of `repeat` calls, and peak memory of one call"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if tracemalloc:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+def print_measures(count, measures):
+    print("%-10s %12s %14s %14s" % ('path', 'time (ms)', 'records/s',
+                                    'peak mem (kB)'))
+    for name, (elapsed, peak) in measures:
+        print("%-10s %12.1f %14d %14s" % (
+            name, elapsed * 1000, count / elapsed,
+            peak is None and 'n/a' or peak // 1024))
+
+
+def plugin_scripts(names):
+    if names:
+        return names
+    return sorted(glob.glob(os.path.join(LIB_DIR, 'collectd-*.py')))
+
+
+def bench_import(args):
+    """Startup cost of each plugin, each one in a fresh interpreter"""
+    results = []
+    for script in plugin_scripts(args.scripts):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), 'import-one', script])
+        results.append(json.loads(output.decode('utf-8')))
+
+    print("%-40s %10s %8s %12s %8s" % ('plugin', 'load (ms)', 'modules',
+                                       'clients (ms)', 'modules'))
+    for result in results:
+        if result.get('error'):
+            print("%-40s %s" % (result['plugin'], result['error']))
+            continue
+        print("%-40s %10.1f %8d %12s %8s" % (
+            result['plugin'],
+            result['load'] * 1000,
+            result['load_modules'],
+            result['clients'] is None and 'n/a'
+            or '%.1f' % (result['clients'] * 1000),
+            result['clients_modules'] is None and 'n/a'
+            or result['clients_modules']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def bench_import_one(args):
+    cli = load_cli()
+    script = args.script
+    result = {'plugin': os.path.basename(script)}
+
+    modules = len(sys.modules)
+    start = time.time()
+    try:
+        cli.load_plugin(script, cli.Collectd())
+    except Exception as e:
+        result['error'] = "cannot load: %s" % e
+        print(json.dumps(result))
+        return
+    result['load'] = time.time() - start
+    result['load_modules'] = len(sys.modules) - modules
+
+    # What the first connection pays for the deferred client imports
+    from collectd_openstack import clients
+    modules = len(sys.modules)
+    start = time.time()
+    try:
+        clients.load_all()
+        result['clients'] = time.time() - start
+        result['clients_modules'] = len(sys.modules) - modules
+    except ImportError:
+        result['clients'] = None
+        result['clients_modules'] = None
+    print(json.dumps(result))
+
+
+try:
+    from novaclient.base import Resource
+except ImportError:
+    class Resource(object):
+        """What novaclient.base.Resource does with a listing record"""
+
+        def __init__(self, manager, info, loaded=False):
+            self.manager = manager
+            self._info = info
+            self._add_details(info)
+            self._loaded = loaded
+
+        def _add_details(self, info):
+            for (k, v) in info.items():
+                try:
+                    setattr(self, k, v)
+                    self._info[k] = v
+                except AttributeError:
+                    pass
+
+
+def bench_rest(args):
+    """Client library Resources against the projections of the fast path"""
+    projection = load_plugin('collectd-instances-stats.py')['SERVER']
+    body = json.dumps(fakeapi.listing('servers', args.count)).encode('utf-8')
+
+    def client_path():
+        document = json.loads(body.decode('utf-8'))
+        servers = [Resource(None, record, loaded=True)
+                   for record in document['servers']]
+        for vm in servers:
+            (vm.status, vm.flavor['id'], vm.image)
+
+    def fast_path():
+        document = json.loads(body.decode('utf-8'))
+        for vm in map(projection, document['servers']):
+            (vm.status, vm.flavor_id, vm.image_id)
+
+    def stream_path():
+        for vm in map(projection, rest.JsonStream(io.BytesIO(body),
+                                                  'servers')):
+            (vm.status, vm.flavor_id, vm.image_id)
+
+    print("%d servers, %d kB of JSON" % (args.count, len(body) // 1024))
+    print_measures(args.count, [
+        ('client', measure(client_path, args.repeat)),
+        ('fast', measure(fast_path, args.repeat)),
+        ('stream', measure(stream_path, args.repeat)),
+    ])
+
+
+def bench_transfer(args):
+    """Listing fetched from a remote API, with and without compression"""
+    projection = load_plugin('collectd-instances-stats.py')['SERVER']
+    api = fakeapi.FakeAPI({'servers': args.count},
+                          bandwidth=args.bandwidth * 1024).start()
+    transfers = {}
+
+    def fetch(compress):
+        def function():
+            client = rest.RestClient(api.endpoint, 'token', stream=True,
+                                     compress=compress)
+            for vm in client.listing('servers/detail', 'servers',
+                                     projection, {'limit': args.limit}):
+                (vm.status, vm.flavor_id, vm.image_id)
+            client.close()
+            transfers[compress] = client.pop_transfers()['servers']
+        return function
+
+    try:
+        measures = [('plain', measure(fetch(False), args.repeat)),
+                    ('gzip', measure(fetch(True), args.repeat))]
+    finally:
+        api.stop()
+
+    print("%d servers in pages of %d, %d kB/s" % (args.count, args.limit,
+                                                   args.bandwidth))
+    print("%-10s %12s %14s %14s %14s" % ('path', 'time (ms)', 'records/s',
+                                         'received (kB)', 'decoded (kB)'))
+    for (name, (elapsed, _)), compress in zip(measures, (False, True)):
+        received, decoded = transfers[compress]
+        print("%-10s %12.1f %14d %14d %14d" % (
+            name, elapsed * 1000, args.count / elapsed,
+            received // 1024, decoded // 1024))
+
+
+def counting_collectd():
+    """Proxy collectd of collectd-cli.py counting the dispatched values"""
+    cli = load_cli()
+
+    class Values(cli.Values):
+        dispatched = 0
+
+        def dispatch(self):
+            Values.dispatched += 1
+
+    class Collectd(cli.Collectd):
+        def Values(self, **args):
+            return Values(**args)
+
+    return Collectd(), Values
+
+
+def legacy_dispatch(collectd, value, plugin_name, date=None, type_name='',
+                    type_instance='', plugin_instance='', host=''):
+    """The dispatch_value the plugins had before the dispatch module"""
+    val = collectd.Values()
+    val.plugin = plugin_name
+    if plugin_instance:
+        val.plugin_instance = plugin_instance
+    if type_name:
+        val.type = type_name
+    if type_instance:
+        val.type_instance = type_instance
+    if host:
+        val.host = host
+    if date:
+        val.time = date
+    if type(value) == dict:
+        for type_inst in value:
+            val.type_instance = type_inst
+            val.values = [int(value[type_inst])]
+            val.dispatch()
+    elif type(value) == list:
+        val.values = value
+        val.dispatch()
+    else:
+        val.values = [int(value)]
+        val.dispatch()
+
+
+def bench_dispatch(args):
+    """Values dispatched per second, one Values per call or reused"""
+    collectd, Values = counting_collectd()
+    date = int(time.time())
+    statuses = dict(('status-%d' % i, i) for i in range(5))
+    # shaped like the stats of collectd-instances-stats: a few big dicts
+    instances = {
+        'images': dict(('image-%d' % i, i) for i in range(args.count)),
+        'flavors': dict(('flavor-%d' % i, i) for i in range(args.count)),
+        'instances': statuses,
+    }
+    # shaped like the stats of collectd-cinder-stats: many small ones
+    cinder = dict(('type-%d' % i, {'volumes': statuses, 'snapshots': statuses,
+                                   'volumes_size': statuses,
+                                   'snapshots_size': statuses})
+                  for i in range(args.count // 10))
+
+    def legacy(info, nested):
+        def function():
+            for name in info:
+                if nested:
+                    for type_name in info[name]:
+                        legacy_dispatch(collectd, info[name][type_name],
+                                        'cinder', date, type_name, '', name,
+                                        'openstack')
+                else:
+                    legacy_dispatch(collectd, info[name], 'nova', date,
+                                    name, name, '', 'openstack')
+        return function
+
+    def batched(info, nested):
+        dispatcher = dispatch.Dispatcher(collectd)
+
+        def function():
+            for name in info:
+                if nested:
+                    for type_name in info[name]:
+                        dispatcher.add(info[name][type_name], 'cinder',
+                                       type_name, '', name, 'openstack',
+                                       date=date)
+                else:
+                    dispatcher.add(info[name], 'nova', name, name, '',
+                                   'openstack', date=date)
+            dispatcher.flush()
+        return function
+
+    for title, info, nested in (('instances', instances, False),
+                                ('cinder', cinder, True)):
+        Values.dispatched = 0
+        legacy(info, nested)()
+        count = Values.dispatched
+        print("%s: %d values per read" % (title, count))
+        print_measures(count, [
+            ('legacy', measure(legacy(info, nested), args.repeat)),
+            ('batched', measure(batched(info, nested), args.repeat)),
+        ])
+
+
+def bench_topk(args):
+    """Overhead of the per tenant usage on the loop over the servers"""
+    projection = load_plugin('collectd-instances-stats.py')['SERVER']
+    records = [fakeapi.server(i, tenants=args.tenants)
+               for i in range(args.count)]
+    body = json.dumps({'servers': records}).encode('utf-8')
+    servers = [projection(record) for record in records]
+    flavors = dict(('%d' % i, 'flavor-%d' % i) for i in range(1, 11))
+    specs = dict(('%d' % i, (i, 512 * i, 10 * i)) for i in range(1, 11))
+    images = dict((fakeapi._uuid('image', i), 'image-%d' % i)
+                  for i in range(20))
+
+    # the loop of collectd-instances-stats.py
+    def servers_loop(usage, listing=None):
+        def function():
+            stats = {'instances': {}, 'flavors': {}, 'images': {},
+                     'boot': {'ephemeral': 0, 'volume': 0}}
+            resources = {}
+            if usage is not None:
+                tenants = usage.counters
+            for vm in listing and listing() or servers:
+                status = vm.status.lower()
+                stats['instances'][status] = \
+                    stats['instances'].setdefault(status, 0) + 1
+                stats['instances']['total_count'] = \
+                    stats['instances'].setdefault('total_count', 0) + 1
+                flavor = flavors[vm.flavor_id]
+                stats['flavors'][flavor] = \
+                    stats['flavors'].setdefault(flavor, 0) + 1
+                vm_specs = specs[vm.flavor_id]
+                sums = resources.get(flavor)
+                if sums is None:
+                    sums = resources[flavor] = [0, 0, 0]
+                sums[0] += vm_specs[0]
+                sums[1] += vm_specs[1]
+                sums[2] += vm_specs[2]
+                if vm.image_id in images:
+                    image = images[vm.image_id]
+                    stats['images'][image] = \
+                        stats['images'].setdefault(image, 0) + 1
+                    stats['boot']['ephemeral'] += 1
+                else:
+                    stats['boot']['volume'] += 1
+                if usage is not None:
+                    counts = tenants.get(vm.tenant_id)
+                    if counts is None:
+                        usage.insert(vm.tenant_id,
+                                     [1, vm_specs[0], vm_specs[1]])
+                    else:
+                        counts[0] += 1
+                        counts[1] += vm_specs[0]
+                        counts[2] += vm_specs[1]
+            if usage is not None:
+                stats['tenants'] = usage.top()
+            return stats
+        return function
+
+    # the servers as received by a read
+    def stream():
+        return map(projection, rest.JsonStream(io.BytesIO(body), 'servers'))
+
+    def new_usage():
+        return topk.Usage(args.k, ['servers', 'vcpus', 'ram'],
+                          args.capacity)
+
+    plain = measure(servers_loop(None), args.repeat)
+    tenants = measure(lambda: servers_loop(new_usage())(), args.repeat)
+    read = measure(servers_loop(None, stream), args.repeat)
+    print("%d servers of %d tenants, top %d" % (args.count, args.tenants,
+                                                 args.k))
+    print_measures(args.count, [('plain', plain), ('tenants', tenants),
+                                ('read', read)])
+    # the time added to the loop, against the whole read of the listing
+    print("overhead: %.0f%% of the loop, %.1f%% of the read" % (
+        100 * (tenants[0] / plain[0] - 1),
+        100 * (tenants[0] - plain[0]) / read[0]))
+    top = servers_loop(new_usage())()['tenants']['servers']
+    print("%d values per resource instead of %d, %d servers in other" %
+          (len(top), args.tenants, top[topk.OTHER]))
+
+
+def bench_churn(args):
+    """Cost of the churn of a listing between two reads"""
+    servers = [(fakeapi._uuid('server', i), 'ACTIVE')
+               for i in range(args.count)]
+    # new servers first, like the listings of the APIs
+    changed = [(fakeapi._uuid('server', -i), 'BUILD')
+               for i in range(1, args.changes + 1)]
+    step = max(args.count // (args.changes + 1), 1)
+    for i in range(0, args.changes * step, step):
+        changed.append(servers[i])
+        changed.append((servers[i + 1][0], 'ERROR'))
+        changed.extend(servers[i + 3:i + step])
+    changed.extend(servers[args.changes * step:])
+
+    def read(tracker, listing):
+        tracker.start()
+        for server_id, status in listing:
+            tracker.add(server_id, status)
+        return tracker.finish()
+
+    tracker = churn.Churn()
+    read(tracker, servers)
+    old = tracker.records
+    read(tracker, changed)
+    new = tracker.records
+    print("%d servers, %d created, deleted and changed: %s, %d kB kept" %
+          (args.count, args.changes, churn.difference(old, new),
+           len(new) // 1024))
+    print_measures(args.count, [
+        ('record', measure(lambda: read(churn.Churn(), servers),
+                           args.repeat)),
+        ('ordered', measure(lambda: churn.difference(old, new),
+                            args.repeat)),
+        ('sets', measure(lambda: churn.difference_sets(old, new),
+                         args.repeat)),
+    ])
+
+
+
+def bench_notifications(args):
+    """Counters of the servers reset to a listing, then from notifications"""
+    plugin = load_plugin('collectd-instances-stats.py')
+    plugin['config']['top_tenants'] = args.k
+    plugin['config']['churn'] = True
+    utils = plugin['OpenstackUtils']()
+    utils.flavors = dict(('%d' % i, 'flavor-%d' % i) for i in range(1, 11))
+    utils.flavor_specs = dict(('%d' % i, (i, 512 * i, 10 * i, {}))
+                              for i in range(1, 11))
+    utils.images = dict((fakeapi._uuid('image', i), 'image-%d' % i)
+                        for i in range(20))
+    transport = notifications.MemoryTransport({'queue': 'bench'})
+    utils.events = notifications.Consumer(
+        transport, utils.interpret, notifications.Tally(utils.contribution))
+    servers = [plugin['SERVER'](fakeapi.server(i))
+               for i in range(args.count)]
+    # the servers go back and forth between two states
+    batches = [[fakeapi.instance_notification(i * 7919 % args.count,
+                                              state=state)
+                for i in range(args.events)]
+               for state in ('active', 'stopped')]
+
+    def listing():
+        utils.events.reconcile(((vm.id, vm) for vm in servers),
+                               time.time() - 60)
+        return utils._event_stats()
+
+    def events():
+        batches.reverse()
+        for notification in batches[0]:
+            transport.publish(notification)
+        utils.events.drain()
+        return utils._event_stats()
+
+    listing()
+    measures = [('listing', args.count, measure(listing, args.repeat)),
+                ('events', args.events, measure(events, args.repeat))]
+    print("%d servers, %d notifications between two reads, without the "
+          "API requests" % (args.count, args.events))
+    print("%-10s %12s %14s %14s" % ('path', 'time (ms)', 'records/s',
+                                    'peak mem (kB)'))
+    for name, count, (elapsed, peak) in measures:
+        print("%-10s %12.1f %14d %14s" % (
+            name, elapsed * 1000, count / elapsed,
+            peak is None and 'n/a' or peak // 1024))
+    print("%d contributions shared by the servers" %
+          len(utils.events.tally.interned))
+
+
+def bench_resilience(args):
+    """Reads of a hung API, with and without the timeouts and breaker"""
+    projection = load_plugin('collectd-instances-stats.py')['SERVER']
+    api = fakeapi.FakeAPI({'servers': 100}).start()
+
+    def read(client):
+        return len(list(client.listing('servers/detail', 'servers',
+                                       projection)))
+
+    def run(name, function):
+        # every request hangs: a retry should not get an answer either
+        api.hang(args.hang, count=2 * args.reads)
+        requests = api.requests
+        times = []
+        for _ in range(args.reads):
+            start = time.time()
+            try:
+                function()
+            except Exception:
+                pass
+            times.append(time.time() - start)
+        print("%-10s %12.2f %12.2f %10d" % (
+            name, max(times), sum(times), api.requests - requests))
+
+    guard = resilience.Guard(
+        'bench', read_timeout=args.timeout,
+        backoff=resilience.Backoff(base=0.1, cap=0.8),
+        breaker=resilience.Breaker('bench', threshold=args.threshold))
+    print("%d reads of an API answering after %.1fs" % (args.reads,
+                                                         args.hang))
+    print("%-10s %12s %12s %10s" % ('path', 'worst (s)', 'total (s)',
+                                    'requests'))
+    try:
+        run('bare', lambda: read(rest.RestClient(api.endpoint, 'token')))
+        run('guarded', lambda: guard.call(
+            read, rest.RestClient(api.endpoint, 'token',
+                                  timeout=guard.timeout)))
+    finally:
+        api.stop()
+    print("breaker [state, trips, failures, rejected]: %s" % guard.metrics())
+
+
+def bench_engine(args):
+    """Read made of several listings, one after the other and at once"""
+    # the listings of a read, with the share of the latency they take
+    shares = [('servers/detail', 'servers', 1.0),
+              ('volumes/detail', 'volumes', 0.75),
+              ('snapshots/detail', 'snapshots', 0.5),
+              ('os-hypervisors/detail', 'hypervisors', 0.5),
+              ('stacks', 'stacks', 0.25)]
+    api = fakeapi.FakeAPI(
+        dict((key, args.count) for _, key, _ in shares),
+        latency=dict((key, share * args.latency)
+                     for _, key, share in shares)).start()
+    projection = rest.Projection('Record', [('id', 'id')])
+    client = rest.RestClient(api.endpoint, 'token', pool_size=args.limit)
+
+    def fetch(path, key):
+        return len(list(client.listing(path, key, projection)))
+
+    def read(engine):
+        def function():
+            calls = [engine.submit('bench', fetch, path, key)
+                     for path, key, _ in shares]
+            engine.gather(calls)
+            # the best one, the last run is slowed down by tracemalloc
+            read.longest = min(read.longest,
+                               max(call.elapsed for call in calls))
+        return function
+    read.longest = float('inf')
+
+    engine = concurrency.Engine(workers=args.workers, limit=args.limit)
+    try:
+        measures = [('serial', measure(read(concurrency.Engine(workers=0)),
+                                       args.repeat))]
+        longest = read.longest
+        measures.append(('engine', measure(read(engine), args.repeat)))
+    finally:
+        engine.stop()
+        client.close()
+        api.stop()
+    print("%d listings of %d records, answered after %.2fs at most" % (
+        len(shares), args.count, args.latency))
+    print("%-10s %12s %14s" % ('path', 'time (ms)', 'longest (ms)'))
+    for name, (elapsed, _) in measures:
+        print("%-10s %12.1f %14.1f" % (name, elapsed * 1000,
+                                       longest * 1000))
+
+
+# Plugin of the worker benchmark: counts the servers of a listing by
+# status, flavor and tenant
+WORKER_PLUGIN = """
+from collectd_openstack import dispatch
+from collectd_openstack import rest
+
+config = {}
+dispatcher = dispatch.Dispatcher(collectd)
+SERVER = rest.Projection('Server', [('status', 'status'),
+                                    ('flavor_id', 'flavor.id'),
+                                    ('tenant_id', 'tenant_id')])
+
+
+def configure_callback(conf):
+    for node in conf.children:
+        config[node.key] = node.values[0]
+
+
+def init_callback():
+    config['client'] = rest.RestClient(config['Endpoint'], 'token')
+
+
+def read_callback(data=None):
+    counts = {'status': {}, 'flavor': {}, 'tenant': {}}
+    for vm in config['client'].listing('servers/detail', 'servers', SERVER):
+        for name, key in (('status', vm.status), ('flavor', vm.flavor_id),
+                          ('tenant', vm.tenant_id)):
+            counts[name][key] = counts[name].get(key, 0) + 1
+    for name, values in counts.items():
+        dispatcher.add(values, 'bench', name)
+    dispatcher.flush()
+
+
+collectd.register_config(configure_callback)
+collectd.register_init(init_callback)
+collectd.register_read(read_callback)
+"""
+
+
+def bench_worker(args):
+    """Stall of the other plugins during a heavy read, made by collectd
+    or by a worker process"""
+    # the API in a process of its own, it would hold the lock too
+    api = subprocess.Popen(
+        [sys.executable, '-c',
+         "import sys; sys.path.insert(0, %r)\n"
+         "import fakeapi\n"
+         "api = fakeapi.FakeAPI({'servers': %d}).start()\n"
+         "print(api.endpoint); sys.stdout.flush(); sys.stdin.read()"
+         % (TESTS_DIR, args.count)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    endpoint = api.stdout.readline().decode('utf-8').strip()
+    directory = tempfile.mkdtemp()
+    script = os.path.join(directory, 'collectd-bench-worker.py')
+    with open(script, 'w') as f:
+        f.write(WORKER_PLUGIN)
+    config = [['Endpoint', [endpoint], []]]
+    collectd, Values = counting_collectd()
+
+    def stalls(read):
+        """Time of the read, and worst delay of a 10 ms timer meanwhile"""
+        worst = [0]
+        done = threading.Event()
+
+        def tick():
+            while not done.is_set():
+                start = time.time()
+                time.sleep(0.01)
+                worst[0] = max(worst[0], time.time() - start - 0.01)
+        ticker = threading.Thread(target=tick)
+        ticker.start()
+        start = time.time()
+        read()
+        elapsed = time.time() - start
+        done.set()
+        ticker.join()
+        return elapsed, worst[0]
+
+    plugin = load_cli().load_plugin(script, collectd)
+    collectd.config(worker.Node(None, (), config))
+    collectd.init()
+    process = worker.Worker(script, config, collectd)
+    dispatcher = dispatch.Dispatcher(collectd)
+
+    def out_of_process():
+        for value in process.read():
+            dispatcher.add(*value)
+        dispatcher.flush()
+
+    try:
+        measures = []
+        for name, read in (('collectd', collectd.read),
+                           ('worker', out_of_process)):
+            Values.dispatched = 0
+            best = min(stalls(read) for _ in range(args.repeat))
+            measures.append((name, best, Values.dispatched // args.repeat))
+    finally:
+        process.stop()
+        api.stdin.close()
+        api.wait()
+        os.remove(script)
+        os.rmdir(directory)
+    print("%d servers counted by status, flavor and tenant" % args.count)
+    print("%-10s %12s %18s %10s" % ('path', 'time (ms)', 'worst stall (ms)',
+                                    'values'))
+    for name, (elapsed, stall), values in measures:
+        print("%-10s %12.1f %18.1f %10d" % (name, elapsed * 1000,
+                                            stall * 1000, values))
+
+
+def bench_snapshot(args):
+    """Values of a read passed to the dispatcher of another process"""
+    records = [([i, i * 2, i * 3], 'cinder', 'volumes', 'tenant-%d' % i,
+                'backend-%d' % (i % 10), 'openstack', 0)
+               for i in range(args.count)]
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.snapshot')
+    writer = shm.SnapshotWriter(path)
+    writer.write(records)
+    reader = shm.SnapshotReader(path)
+    try:
+        measures = [
+            ('json', measure(lambda: json.loads(json.dumps(records)),
+                             args.repeat)),
+            ('pickle', measure(lambda: pickle.loads(pickle.dumps(records, 2)),
+                               args.repeat)),
+            ('snapshot', measure(lambda: (writer.write(records),
+                                          reader.read()), args.repeat)),
+        ]
+    finally:
+        reader.close()
+        writer.close()
+        os.remove(path)
+        os.rmdir(directory)
+    print("%d values written then read" % args.count)
+    print_measures(args.count, measures)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_schedule(args):
+    """API latency under a fleet of collectors reading at the start of
+    the interval and spread over it"""
+    api = fakeapi.FakeAPI({'servers': args.count}, latency=args.latency,
+                          capacity=args.capacity).start()
+    projection = rest.Projection('Record', [('id', 'id')])
+
+    def fleet(phase, jitter):
+        """Latencies of the listings and phases of the starts"""
+        latencies = []
+        phases = []
+        lock = threading.Lock()
+        end = time.time() + args.cycles * args.interval
+
+        def collector(i):
+            scheduler = schedule.Schedule(
+                'collectd-instances-stats', interval=args.interval,
+                tick=args.interval / 200.0, jitter=jitter,
+                host='node-%d' % i, phase=phase)
+            client = rest.RestClient(api.endpoint, 'token')
+            while time.time() < end:
+                if scheduler.due():
+                    start = time.time()
+                    list(client.listing('servers/detail', 'servers',
+                                        projection))
+                    with lock:
+                        latencies.append(time.time() - start)
+                        phases.append(scheduler.metrics()[0])
+                time.sleep(scheduler.tick)
+            client.close()
+
+        threads = [threading.Thread(target=collector, args=(i,))
+                   for i in range(args.collectors)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, phases
+
+    try:
+        measures = [('aligned', fleet(0, 0)),
+                    ('spread', fleet(None, args.jitter))]
+    finally:
+        api.stop()
+    print("%d collectors reading every %.1fs an API answering %d requests "
+          "at once after %.2fs" % (args.collectors, args.interval,
+                                   args.capacity, args.latency))
+    print("%-10s %8s %10s %10s %10s %12s" % (
+        'schedule', 'reads', 'p50 (ms)', 'p99 (ms)', 'max (ms)',
+        'spread (s)'))
+    for name, (latencies, phases) in measures:
+        print("%-10s %8d %10.1f %10.1f %10.1f %12.2f" % (
+            name, len(latencies), percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, max(latencies) * 1000,
+            max(phases) - min(phases)))
+
+
+def bench_adaptive(args):
+    """Reads of collectors of different costs and rates of change, at a
+    fixed interval and adaptive, on a simulated clock"""
+    # name, seconds per read, seconds between two changes of the values
+    collectors = [('keystone', 0.05, 1800),
+                  ('heat', 0.1, 600),
+                  ('hypervisors', 0.2, 20),
+                  ('instances', 8, 30),
+                  ('ceilometer', 15, 300)]
+
+    def simulate(cost, period, adaptive):
+        """[reads, seconds reading, mean delay to see a change]"""
+        now = [0.0]
+        collectd, Values = counting_collectd()
+        dispatcher = dispatch.Dispatcher(collectd)
+        bounds = adaptive and (args.min_interval, args.max_interval) or \
+            (None, None)
+        scheduler = schedule.Schedule(
+            'bench', interval=args.interval, tick=1, jitter=0,
+            min_interval=bounds[0], max_interval=bounds[1],
+            clock=lambda: now[0])
+        seen = [0, 0.0, 0.0]
+
+        def read():
+            now[0] += cost
+            version = int(now[0] // period)
+            dispatcher.add(version, 'bench', 'version', '', '', 'bench')
+            dispatcher.flush()
+            if version > seen[0]:
+                # the first change not seen yet happened at seen + 1
+                seen[1] += now[0] - (seen[0] + 1) * period
+                seen[2] += 1
+                seen[0] = version
+        reads = [0]
+
+        def counted():
+            reads[0] += 1
+            read()
+        callback = scheduler.wrap(counted, dispatcher)
+        while now[0] < args.hours * 3600:
+            callback()
+            now[0] += scheduler.tick
+        return [reads[0], reads[0] * cost, seen[1] / max(seen[2], 1)]
+
+    print("%.0f hours, interval of %ds, adaptive between %ds and %ds" % (
+        args.hours, args.interval, args.min_interval, args.max_interval))
+    print("fixed / adaptive")
+    print("%-12s %16s %18s %20s" % ('collector', 'reads', 'reading (s)',
+                                    'change seen (s)'))
+    for name, cost, period in collectors:
+        fixed = simulate(cost, period, False)
+        adaptive = simulate(cost, period, True)
+        print("%-12s %7d / %-6d %8.0f / %-7.0f %9.1f / %.1f" % (
+            name, fixed[0], adaptive[0], fixed[1], adaptive[1], fixed[2],
+            adaptive[2]))
+
+
+def bench_ratelimit(args):
+    """Calls of the plugins of a node to one API, unlimited and under a
+    rate limit in queue and skip mode"""
+    api = fakeapi.FakeAPI({'servers': args.count},
+                          latency=args.latency).start()
+    projection = rest.Projection('Record', [('id', 'id')])
+    engine = concurrency.Engine(workers=args.plugins, limit=args.plugins)
+
+    def run(endpoint):
+        """Times of the calls, and the calls skipped"""
+        times = []
+        skipped = [0]
+        lock = threading.Lock()
+        end = time.time() + args.duration
+
+        def fetch(client):
+            list(client.listing('servers/detail', 'servers', projection))
+            with lock:
+                times.append(time.time())
+
+        def plugin(i):
+            # a plugin reading as fast as it can, with its own tenant
+            tenant = 'tenant-%d' % (i % 2)
+            scope = concurrency.Scope(engine, tenant)
+            client = rest.RestClient(api.endpoint, 'token', service=endpoint,
+                                     tenant=tenant)
+            while time.time() < end:
+                try:
+                    scope.gather([scope.submit(endpoint, fetch, client)])
+                except ratelimit.Throttled:
+                    with lock:
+                        skipped[0] += 1
+                    time.sleep(args.latency)
+            client.close()
+
+        threads = [threading.Thread(target=plugin, args=(i,))
+                   for i in range(args.plugins)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return times, skipped[0]
+
+    def peak(times):
+        """Most calls made in one second"""
+        times.sort()
+        first = 0
+        best = 0
+        for last, stamp in enumerate(times):
+            while stamp - times[first] >= 1:
+                first += 1
+            best = max(best, last - first + 1)
+        return best
+
+    for mode in ratelimit.MODES:
+        ratelimit.limiter('bench-%s' % mode, rate=args.rate,
+                          burst=args.burst, tenant_rate=args.rate / 2.0,
+                          mode=mode, max_wait=args.duration)
+    try:
+        measures = [('none', run('bench-none'))]
+        for mode in ratelimit.MODES:
+            measures.append((mode, run('bench-%s' % mode)))
+    finally:
+        engine.stop()
+        api.stop()
+    print("%d plugins calling an API answering after %.2fs for %.1fs, "
+          "limited to %.1f calls/s, bursts of %d" % (
+              args.plugins, args.latency, args.duration, args.rate,
+              args.burst))
+    print("%-10s %8s %10s %10s %10s" % ('limit', 'calls', 'calls/s',
+                                        'peak/s', 'skipped'))
+    for name, (times, skipped) in measures:
+        print("%-10s %8d %10.1f %10d %10d" % (
+            name, len(times), len(times) / args.duration, peak(times),
+            skipped))
+    for mode in ratelimit.MODES:
+        print("%s [allowed, delayed, skipped]: %s" % (
+            mode, ratelimit.limiter('bench-%s' % mode).metrics()))
+
+
+def bench_exposition(args):
+    """Scrapes of an exporter listing the API and of the exposition,
+    rendered after a read and cached"""
+    api = fakeapi.FakeAPI({'servers': args.count},
+                          latency=args.latency).start()
+    projection = load_plugin('collectd-instances-stats.py')['SERVER']
+    client = rest.RestClient(api.endpoint, 'token')
+    records = [([i, i * 2, i * 3], 'cinder', 'volumes', 'tenant-%d' % i,
+                'backend-%d' % (i % 10), 'openstack', 0)
+               for i in range(args.values)]
+    shared = exposition.Exposition()
+    source = shared.source('bench')
+    server = exposition.serve(shared, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+
+    def scrapes(before):
+        latencies = []
+        requests = api.requests
+        for _ in range(args.scrapes):
+            start = time.time()
+            before()
+            urlopen(url).read()
+            latencies.append(time.time() - start)
+        return latencies, api.requests - requests
+
+    def relist():
+        # an exporter of its own, counting the servers at each scrape
+        len(list(client.listing('servers/detail', 'servers', projection)))
+
+    try:
+        measures = [('relist', scrapes(relist)),
+                    ('rendered', scrapes(lambda: source.update(records))),
+                    ('cached', scrapes(lambda: None))]
+    finally:
+        server.shutdown()
+        server.server_close()
+        client.close()
+        api.stop()
+    print("%d scrapes of %d values, an API listing %d servers after %.2fs" %
+          (args.scrapes, args.values, args.count, args.latency))
+    print("%-10s %10s %10s %10s" % ('path', 'p50 (ms)', 'p99 (ms)',
+                                    'requests'))
+    for name, (latencies, requests) in measures:
+        print("%-10s %10.2f %10.2f %10d" % (
+            name, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, requests))
+
+
+def bench_sharding(args):
+    """Reads of the nodes of a shard, listing the servers of their
+    tenants or their part of the paginated listing"""
+    plugin = load_plugin('collectd-instances-stats.py')
+    api = fakeapi.FakeAPI({'servers': args.count}, latency=args.latency,
+                          max_limit=args.max_limit,
+                          tenants=args.tenants).start()
+    tenants = [fakeapi._uuid('tenant', i) for i in range(args.tenants)]
+
+    def by_tenant(index, client):
+        # the listings of the tenants hashing to the node, as before
+        for tenant in tenants:
+            if zlib.crc32(tenant.encode('utf-8')) % args.nodes != index:
+                continue
+            for vm in client.listing('servers/detail', 'servers',
+                                     plugin['SERVER'],
+                                     {'all_tenants': 1, 'tenant_id': tenant}):
+                yield vm
+
+    def by_part(index, client):
+        utils = plugin['OpenstackUtils'](sharding.Sharding(
+            'bench', index, args.nodes, sharding.LocalTransport()))
+        utils.rest_client = client
+        return utils._list_servers(None)
+
+    def read(listing):
+        """Servers, requests and worst time of the reads of the nodes"""
+        servers = requests = worst = 0
+        for index in range(args.nodes):
+            client = rest.RestClient(api.endpoint, 'token', stream=True)
+            before = api.requests
+            start = time.time()
+            servers += len(list(listing(index, client)))
+            worst = max(worst, time.time() - start)
+            requests += api.requests - before
+            client.close()
+        return servers, requests, worst
+
+    try:
+        measures = [('tenants', read(by_tenant)), ('pages', read(by_part))]
+    finally:
+        api.stop()
+    print("%d servers of %d tenants on %d nodes, pages of %d, %.2fs per "
+          "request" % (args.count, len(tenants), args.nodes, args.max_limit,
+                       args.latency))
+    print("%-10s %10s %10s %16s" % ('listing', 'servers', 'requests',
+                                    'worst read (ms)'))
+    for name, (servers, requests, worst) in measures:
+        print("%-10s %10d %10d %16.1f" % (name, servers, requests,
+                                          worst * 1000))
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmarks of the collectd plugins')
+subparsers = parser.add_subparsers()
+
+import_parser = subparsers.add_parser(
+    'import', help='Startup cost of the plugins')
+import_parser.add_argument('scripts', metavar='script', nargs='*',
+                           help='Plugins to measure, all of lib/ by default')
+import_parser.add_argument('--output', metavar='FILE', type=str,
+                           help='Record the results as JSON in FILE')
+import_parser.set_defaults(func=bench_import)
+
+rest_parser = subparsers.add_parser(
+    'rest', help='Client library against the REST fast path')
+rest_parser.add_argument('--count', metavar='N', type=int, default=20000,
+                         help='Number of servers in the listing')
+rest_parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                         help='Number of runs, the best one is kept')
+rest_parser.set_defaults(func=bench_rest)
+
+transfer_parser = subparsers.add_parser(
+    'transfer', help='Listings fetched with and without compression')
+transfer_parser.add_argument('--count', metavar='N', type=int, default=5000,
+                             help='Number of servers in the listing')
+transfer_parser.add_argument('--limit', metavar='N', type=int, default=1000,
+                             help='Number of servers in each page')
+transfer_parser.add_argument('--bandwidth', metavar='KB', type=int,
+                             default=10240,
+                             help='Bandwidth of the API in kB/s')
+transfer_parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                             help='Number of runs, the best one is kept')
+transfer_parser.set_defaults(func=bench_transfer)
+
+dispatch_parser = subparsers.add_parser(
+    'dispatch', help='Values dispatched per second')
+dispatch_parser.add_argument('--count', metavar='N', type=int, default=5000,
+                             help='Number of images and of flavors')
+dispatch_parser.add_argument('--repeat', metavar='N', type=int, default=20,
+                             help='Number of runs, the best one is kept')
+dispatch_parser.set_defaults(func=bench_dispatch)
+
+topk_parser = subparsers.add_parser(
+    'topk', help='Overhead of the per tenant usage')
+topk_parser.add_argument('--count', metavar='N', type=int, default=50000,
+                         help='Number of servers in the listing')
+topk_parser.add_argument('--tenants', metavar='N', type=int, default=5000,
+                         help='Number of tenants owning the servers')
+topk_parser.add_argument('-k', metavar='N', type=int, default=20,
+                         help='Number of tenants dispatched')
+topk_parser.add_argument('--capacity', metavar='N', type=int,
+                         help='Number of counters of the sketch')
+topk_parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                         help='Number of runs, the best one is kept')
+topk_parser.set_defaults(func=bench_topk)
+
+churn_parser = subparsers.add_parser(
+    'churn', help='Churn of a listing between two reads')
+churn_parser.add_argument('--count', metavar='N', type=int, default=200000,
+                          help='Number of servers in the listing')
+churn_parser.add_argument('--changes', metavar='N', type=int, default=5,
+                          help='Number of servers created, deleted and '
+                          'changed between the reads')
+churn_parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                          help='Number of runs, the best one is kept')
+churn_parser.set_defaults(func=bench_churn)
+
+notifications_parser = subparsers.add_parser(
+    'notifications', help='Counters from a listing or from notifications')
+notifications_parser.add_argument('--count', metavar='N', type=int,
+                                  default=100000,
+                                  help='Number of servers')
+notifications_parser.add_argument('--events', metavar='N', type=int,
+                                  default=1000,
+                                  help='Number of notifications per read')
+notifications_parser.add_argument('-k', metavar='N', type=int, default=20,
+                                  help='Number of tenants dispatched')
+notifications_parser.add_argument('--repeat', metavar='N', type=int,
+                                  default=3,
+                                  help='Number of runs, the best one is kept')
+notifications_parser.set_defaults(func=bench_notifications)
+
+resilience_parser = subparsers.add_parser(
+    'resilience', help='Reads of a hung API with timeouts and breaker')
+resilience_parser.add_argument('--reads', metavar='N', type=int, default=10,
+                               help='Number of reads')
+resilience_parser.add_argument('--hang', metavar='SECONDS', type=float,
+                               default=3,
+                               help='Time taken by the API to answer')
+resilience_parser.add_argument('--timeout', metavar='SECONDS', type=float,
+                               default=0.5, help='Read timeout')
+resilience_parser.add_argument('--threshold', metavar='N', type=int,
+                               default=3,
+                               help='Failed reads opening the breaker')
+resilience_parser.set_defaults(func=bench_resilience)
+
+engine_parser = subparsers.add_parser(
+    'engine', help='Listings of a read made one after the other and at once')
+engine_parser.add_argument('--count', metavar='N', type=int, default=1000,
+                           help='Number of records in each listing')
+engine_parser.add_argument('--latency', metavar='SECONDS', type=float,
+                           default=0.4,
+                           help='Time taken by the API to answer the '
+                           'slowest listing')
+engine_parser.add_argument('--workers', metavar='N', type=int, default=8,
+                           help='Number of threads of the engine')
+engine_parser.add_argument('--limit', metavar='N', type=int, default=4,
+                           help='Number of calls of the endpoint at once')
+engine_parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                           help='Number of runs, the best one is kept')
+engine_parser.set_defaults(func=bench_engine)
+
+worker_parser = subparsers.add_parser(
+    'worker', help='Stall of the other plugins during a heavy read')
+worker_parser.add_argument('--count', metavar='N', type=int, default=50000,
+                           help='Number of servers in the listing')
+worker_parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                           help='Number of runs, the best one is kept')
+worker_parser.set_defaults(func=bench_worker)
+
+schedule_parser = subparsers.add_parser(
+    'schedule', help='API latency under a fleet of collectors')
+schedule_parser.add_argument('--collectors', metavar='N', type=int,
+                             default=40, help='Number of collectors')
+schedule_parser.add_argument('--interval', metavar='SECONDS', type=float,
+                             default=2, help='Interval of the reads')
+schedule_parser.add_argument('--cycles', metavar='N', type=int, default=3,
+                             help='Number of intervals')
+schedule_parser.add_argument('--jitter', metavar='SECONDS', type=float,
+                             default=0.1, help='Jitter of the starts')
+schedule_parser.add_argument('--count', metavar='N', type=int, default=100,
+                             help='Number of servers in the listing')
+schedule_parser.add_argument('--latency', metavar='SECONDS', type=float,
+                             default=0.02,
+                             help='Time taken by the API to answer')
+schedule_parser.add_argument('--capacity', metavar='N', type=int, default=4,
+                             help='Number of requests answered at once')
+schedule_parser.set_defaults(func=bench_schedule)
+
+adaptive_parser = subparsers.add_parser(
+    'adaptive', help='Reads at a fixed interval and adaptive')
+adaptive_parser.add_argument('--hours', metavar='N', type=float, default=24,
+                             help='Simulated duration')
+adaptive_parser.add_argument('--interval', metavar='SECONDS', type=int,
+                             default=60, help='Fixed interval')
+adaptive_parser.add_argument('--min-interval', metavar='SECONDS', type=int,
+                             default=10, help='Shortest adaptive interval')
+adaptive_parser.add_argument('--max-interval', metavar='SECONDS', type=int,
+                             default=600, help='Longest adaptive interval')
+adaptive_parser.set_defaults(func=bench_adaptive)
+
+snapshot_parser = subparsers.add_parser(
+    'snapshot', help='Values passed through a snapshot file')
+snapshot_parser.add_argument('--count', metavar='N', type=int, default=5000,
+                             help='Number of values of the read')
+snapshot_parser.add_argument('--repeat', metavar='N', type=int, default=5,
+                             help='Number of runs, the best one is kept')
+snapshot_parser.set_defaults(func=bench_snapshot)
+
+ratelimit_parser = subparsers.add_parser(
+    'ratelimit', help='Calls of the plugins of a node under a rate limit')
+ratelimit_parser.add_argument('--plugins', metavar='N', type=int, default=8,
+                              help='Number of plugins calling the API')
+ratelimit_parser.add_argument('--duration', metavar='SECONDS', type=float,
+                              default=3, help='Duration of each run')
+ratelimit_parser.add_argument('--rate', metavar='N', type=float, default=20,
+                              help='Calls per second of the rate limit')
+ratelimit_parser.add_argument('--burst', metavar='N', type=int, default=10,
+                              help='Calls of a burst of the rate limit')
+ratelimit_parser.add_argument('--count', metavar='N', type=int, default=100,
+                              help='Number of servers in the listing')
+ratelimit_parser.add_argument('--latency', metavar='SECONDS', type=float,
+                              default=0.01,
+                              help='Time taken by the API to answer')
+ratelimit_parser.set_defaults(func=bench_ratelimit)
+
+exposition_parser = subparsers.add_parser(
+    'exposition', help='Scrapes of the values of the last read')
+exposition_parser.add_argument('--scrapes', metavar='N', type=int,
+                               default=200, help='Number of scrapes')
+exposition_parser.add_argument('--values', metavar='N', type=int,
+                               default=1000,
+                               help='Number of values of the read')
+exposition_parser.add_argument('--count', metavar='N', type=int,
+                               default=1000,
+                               help='Number of servers in the listing')
+exposition_parser.add_argument('--latency', metavar='SECONDS', type=float,
+                               default=0.05,
+                               help='Time taken by the API to answer')
+exposition_parser.set_defaults(func=bench_exposition)
+
+sharding_parser = subparsers.add_parser(
+    'sharding', help='Listings of the nodes of a shard')
+sharding_parser.add_argument('--count', metavar='N', type=int, default=20000,
+                             help='Number of servers in the listing')
+sharding_parser.add_argument('--tenants', metavar='N', type=int,
+                             default=1000, help='Number of tenants')
+sharding_parser.add_argument('--nodes', metavar='N', type=int, default=3,
+                             help='Number of nodes of the shard')
+sharding_parser.add_argument('--max-limit', metavar='N', type=int,
+                             default=1000,
+                             help='Number of servers in each page')
+sharding_parser.add_argument('--latency', metavar='SECONDS', type=float,
+                             default=0.05,
+                             help='Time taken by the API to answer')
+sharding_parser.set_defaults(func=bench_sharding)
+
+import_one_parser = subparsers.add_parser('import-one')
+import_one_parser.add_argument('script')
+import_one_parser.set_defaults(func=bench_import_one)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -5,7 +5,11 @@
 #
 # A litle utility is given to run the plugin on the command line in the bin
 # directory. To use it give the collectd script as argument and some other
-# required parameters.
+# required parameters.  Several scripts can be given, and read again every
+# --interval seconds for --iterations reads, the latency of their reads,
+# the values they dispatched and their peak memory are reported at the end.
+# The HTTP exchanges of the scripts can be recorded to a cassette, then
+# replayed without a cloud.
 #
 # Copyright © 2014 eNovance <licensing@enovance.com>
 #
@@ -27,11 +31,27 @@
 #
 import argparse
 import datetime
+import os
+import sys
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 parser = argparse.ArgumentParser(
     description='Run the collectd at the command line')
 parser.add_argument('--script', metavar='script', type=str,
-                    help='Which script to load. ')
+                    action='append', dest='scripts', required=True,
+                    help='Which script to load.  Can be given several '
+                    'times, the scripts are loaded in one process.')
 
 parser.add_argument('--auth_url', metavar='URL', type=str,
                     required=True,
@@ -54,18 +74,57 @@ parser.add_argument('--endpoint_type', metavar='endpoint_type', type=str,
                     help='Endpoint type in the catalog request. '
                     + 'Public by default.')
 
+parser.add_argument('--interval', metavar='SECONDS', type=float, default=10,
+                    help='Seconds between the starts of two reads of the '
+                    'scripts, 10 by default.')
+
+parser.add_argument('--iterations', metavar='N', type=int, default=1,
+                    help='Number of reads of each script, 1 by default, '
+                    '0 to read until interrupted.')
+
+parser.add_argument('--quiet', action='store_true',
+                    help='Do not print the dispatched values.')
+
+parser.add_argument('--trace-memory', action='store_true',
+                    help='Trace the peak memory of each read, at the cost '
+                    'of slower reads.  Python 3 only.')
+
+parser.add_argument('--exposition', metavar='PORT', type=int,
+                    help='Serve the values of the last reads to Prometheus '
+                    'on this port.')
+
+parser.add_argument('--exposition-address', metavar='ADDRESS', type=str,
+                    default='127.0.0.1', help='Address of the exposition, '
+                    '127.0.0.1 by default.')
 
-args = parser.parse_args()
+cassette_group = parser.add_mutually_exclusive_group()
+cassette_group.add_argument('--record', metavar='CASSETTE', type=str,
+                            help='Record the HTTP exchanges of the scripts '
+                            'to this cassette file.')
+cassette_group.add_argument('--replay', metavar='CASSETTE', type=str,
+                            help='Answer the HTTP requests of the scripts '
+                            'from this cassette file, without any network.')
+
+parser.add_argument('--replay-latency', action='store_true',
+                    help='Replay the answers after the time they took when '
+                    'recorded, at once by default.')
+
+parser.add_argument('--multiply', metavar='N', type=int, default=1,
+                    help='Replay each record of the listings N times, to '
+                    'simulate a bigger cloud.')
 
 
 class Collectd:
     """Proxy class """
 
-    def __init__(self):
+    def __init__(self, quiet=False):
         self.values = []
         self.config = None
         self.init = None
         self.read = None
+        self.shutdown = None
+        self.quiet = quiet
+        self.dispatched = 0
 
     def register_config(self, function):
         self.config = function
@@ -73,11 +132,14 @@ class Collectd:
     def register_init(self, function):
         self.init = function
 
-    def register_read(self, function):
+    def register_read(self, function, interval=None):
         self.read = function
 
+    def register_shutdown(self, function):
+        self.shutdown = function
+
     def Values(self, **args):
-        return Values(**args)
+        return Values(self, **args)
 
     def warning(self, msg):
         print(msg)
@@ -96,23 +158,31 @@ class Configuration:
             Node({'Tenant': args.tenant}),
             Node({'EndpointType': args.endpoint_type}),
         ]
+        if args.exposition:
+            # one server shared by the scripts, like in collectd
+            self.children.append(Node({'Exposition': None}, [
+                Node({'Address': args.exposition_address}),
+                Node({'Port': args.exposition}),
+            ]))
 
 
 class Node:
     """Proxy node class for configuration"""
-    def __init__(self, entry):
-        self.key = entry.keys()[0]
-        self.values = entry.values()
+    def __init__(self, entry, children=()):
+        self.key = list(entry.keys())[0]
+        self.values = [value for value in entry.values() if value is not None]
+        self.children = list(children)
 
 
 class Values:
-    def __init__(self, **args):
+    def __init__(self, collectd=None, **args):
+        self.collectd = collectd
         self.host = ""
         self.plugin = ""
         self.plugin_instance = ""
         self.type = ""
         self.type_instance = ""
-        self.time = datetime.utcnow()
+        self.time = datetime.datetime.utcnow()
         self.values = []
 
     def __str__(self):
@@ -126,14 +196,143 @@ class Values:
             self.values)
 
     def dispatch(self):
+        if self.collectd is not None:
+            self.collectd.dispatched += 1
+            if self.collectd.quiet:
+                return
         print(self)
 
-collectd = Collectd()
 
-execfile(args.script)
+def add_plugin_dir(script):
+    # The plugins import the collectd_openstack package living next to them.
+    plugin_dir = os.path.dirname(os.path.abspath(script))
+    if plugin_dir not in sys.path:
+        sys.path.insert(0, plugin_dir)
+
+
+def load_plugin(script, collectd):
+    """Run a plugin script with the proxy collectd, return its namespace"""
+    add_plugin_dir(script)
+    namespace = {'__name__': '__main__',
+                 '__file__': script,
+                 'collectd': collectd}
+    with open(script) as f:
+        exec(compile(f.read(), script, 'exec'), namespace)
+    return namespace
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Plugin:
+    """A script loaded with a proxy collectd of its own, and the measures
+    of its reads"""
+
+    def __init__(self, script, args):
+        self.name = os.path.splitext(os.path.basename(script))[0]
+        self.collectd = Collectd(quiet=args.quiet)
+        self.trace_memory = args.trace_memory and tracemalloc is not None
+        load_plugin(script, self.collectd)
+        self.collectd.config(Configuration(args))
+        self.collectd.init()
+        self.latencies = []
+        self.peaks = []
+        self.errors = 0
+
+    def read(self):
+        if self.trace_memory:
+            current = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.clear_traces()
+                current = 0
+        start = time.time()
+        try:
+            self.collectd.read()
+        except Exception:
+            self.errors += 1
+            print("Read of %s failed: %s" % (self.name,
+                                              traceback.format_exc()))
+        self.latencies.append(time.time() - start)
+        if self.trace_memory:
+            self.peaks.append(tracemalloc.get_traced_memory()[1] - current)
+
+    def stop(self):
+        if self.collectd.shutdown is not None:
+            self.collectd.shutdown()
+
+    def report(self):
+        reads = len(self.latencies)
+        latencies = self.latencies or [0]
+        peak = self.peaks and "%d" % (max(self.peaks) // 1024) or 'n/a'
+        return "%-32s %6d %6d %9.1f %9.1f %9.1f %9.1f %11d %14s" % (
+            self.name, reads, self.errors,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, max(latencies) * 1000,
+            self.collectd.dispatched // max(1, reads), peak)
+
+
+def report(plugins):
+    print("%-32s %6s %6s %9s %9s %9s %9s %11s %14s" % (
+        'script', 'reads', 'errors', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)',
+        'max (ms)', 'values/read', 'peak mem (kB)'))
+    for plugin in plugins:
+        print(plugin.report())
+    if resource is not None:
+        # kilobytes on linux
+        print("peak memory of the process: %d kB" %
+              resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def open_cassette(args):
+    """The Recorder or Player of the HTTP exchanges, installed"""
+    for script in args.scripts:
+        add_plugin_dir(script)
+    # the package of the repository, for the scripts living elsewhere
+    sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'lib'))
+    from collectd_openstack import cassette
+    if args.record:
+        return cassette.install(cassette.Recorder(args.record))
+    return cassette.install(cassette.Player(args.replay,
+                                            latency=args.replay_latency,
+                                            multiply=args.multiply))
+
+
+def main():
+    args = parser.parse_args()
+    recorded = None
+    if args.record or args.replay:
+        # before the plugins connect
+        recorded = open_cassette(args)
+    if args.trace_memory and tracemalloc is not None:
+        tracemalloc.start()
+    plugins = [Plugin(script, args) for script in args.scripts]
+
+    iteration = 0
+    try:
+        while not args.iterations or iteration < args.iterations:
+            start = time.time()
+            for plugin in plugins:
+                plugin.read()
+            iteration += 1
+            if iteration != args.iterations:
+                time.sleep(max(0, start + args.interval - time.time()))
+    except KeyboardInterrupt:
+        pass
+    for plugin in plugins:
+        plugin.stop()
+    report(plugins)
+    if recorded is not None:
+        recorded.close()
+        print("%d HTTP exchanges %s" % (
+            recorded.count, args.record and 'recorded' or 'replayed'))
+    return 1 if any(plugin.errors for plugin in plugins) else 0
 
-conf = Configuration(args)
 
-collectd.config(conf)
-collectd.init()
-collectd.read()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Generate the types.db files of the plugins
+#
+# The types of each plugin are defined by its TYPES, see
+# collectd_openstack/typesdb.py.  This script loads all the plugins with
+# the proxy collectd of collectd-cli.py and writes share/<db>-types.db.
+# With --check it only reports the files that are not up to date.
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import glob
+import os
+import sys
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BIN_DIR)
+LIB_DIR = os.path.join(ROOT_DIR, 'lib')
+
+HEADER = "# Generated by bin/collectd-types.py from the TYPES of %s\n"
+
+parser = argparse.ArgumentParser(
+    description='Generate share/*-types.db from the plugins')
+parser.add_argument('--output', metavar='DIR', type=str,
+                    default=os.path.join(ROOT_DIR, 'share'),
+                    help='Directory of the types.db files')
+parser.add_argument('--check', action='store_true',
+                    help='Only check that the files are up to date')
+
+
+def load_cli():
+    path = os.path.join(BIN_DIR, 'collectd-cli.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('collectd_cli', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('collectd_cli', path)
+
+
+def collect_types():
+    """Return {db: ([source names], [types])} of all the plugins"""
+    cli = load_cli()
+    sources = []
+    for script in sorted(glob.glob(os.path.join(LIB_DIR, 'collectd-*.py'))):
+        namespace = cli.load_plugin(script, cli.Collectd())
+        if 'TYPES' in namespace:
+            sources.append((os.path.basename(script), namespace['TYPES']))
+    # the shared modules dispatching types of their own
+    for name, module in sorted(sys.modules.items()):
+        if name.startswith('collectd_openstack.') and \
+                hasattr(module, 'TYPES'):
+            sources.append((name, module.TYPES))
+
+    dbs = {}
+    defined = {}
+    for source, types in sources:
+        names, db_types = dbs.setdefault(types.db, ([], []))
+        names.append(source)
+        for type_ in types:
+            if type_.name in defined:
+                other_source, other = defined[type_.name]
+                if type_ != other:
+                    raise ValueError("Type %s of %s differs from %s" %
+                                     (type_.name, source, other_source))
+                if other in db_types:
+                    continue
+                raise ValueError("Type %s of %s already in another db" %
+                                 (type_.name, source))
+            defined[type_.name] = (source, type_)
+            db_types.append(type_)
+    return dbs
+
+
+def render(sources, types):
+    width = max(len(type_.name) for type_ in types)
+    return HEADER % ", ".join(sources) + \
+        "".join(type_.line(width) + "\n" for type_ in types)
+
+
+def main():
+    args = parser.parse_args()
+    outdated = []
+    for db, (sources, types) in sorted(collect_types().items()):
+        path = os.path.join(args.output, "%s-types.db" % db)
+        content = render(sources, types)
+        current = None
+        if os.path.exists(path):
+            with open(path) as f:
+                current = f.read()
+        if current == content:
+            continue
+        outdated.append(path)
+        if not args.check:
+            with open(path, 'w') as f:
+                f.write(content)
+            print("Wrote %s" % path)
+    if args.check and outdated:
+        for path in outdated:
+            print("%s is not up to date" % path)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
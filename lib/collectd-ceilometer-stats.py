@@ -26,13 +26,23 @@
 if __name__ != "__main__":
     import collectd
 
-from ceilometerclient.client import get_client
-
 from datetime import datetime
 from time import mktime
 from pprint import pformat
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import ratelimit
+from collectd_openstack import resilience
+from collectd_openstack import schedule
+from collectd_openstack import shm
+from collectd_openstack import typesdb
 from string import find
 
+ceilometer = clients.lazy('ceilometerclient.client')
+
 plugin_name = 'collectd-ceilometer-stats'
 
 version = '0.1.0'
@@ -41,24 +51,34 @@ config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
 }
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Types dispatched, generated into share/ceilometer-types.db
+TYPES = typesdb.Types('ceilometer', [
+    typesdb.Type('alarms', ['ok', 'alarm', 'insufficient_data']),
+    typesdb.Type('meters'),
+])
 
 
 class OpenstackUtils:
-    def __init__(self, client):
+    def __init__(self, client, engine=None):
         self.client = client
+        self.engine = engine or concurrency.Engine(workers=0)
         self.last_stats = None
         self.connection_done = None
         self.stats = {}
 
     def get_stats(self):
-        alarms = self.client.alarms.list()
+        alarms, meters = self.engine.gather([
+            self.engine.submit('metering', self.client.alarms.list),
+            self.engine.submit('metering', self.client.meters.list)])
         self.last_stats = int(mktime(datetime.now().timetuple()))
         self.stats = {'alarms': {
                           'ok': len(filter(lambda x: x.state == 'ok', alarms)),
                           'alarm': len(filter(lambda x: x.state == 'alarm', alarms)),
                           'insufficient_data': len(filter(lambda x: x.state == 'insufficient data', alarms))
                       }, 
-                      'meters': len(self.client.meters.list())}
+                      'meters': len(meters)}
         return self.stats
 
 
@@ -77,49 +97,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, plugin_name, date=None, type_name='',
-                   type_instance='', plugin_instance='',
-                   host=''):
-    """Dispatch a value"""
-    # host "/" plugin ["-" plugin instance] "/" type ["-" type instance]
-
-    log_verbose('Dispatch value:\nhost: %s\nplugin_name: %s\n'
-                'plugin_instance: %s\ntype_name: %s\n'
-                'type_instance: %s\nvalue: %s\n' %
-                (host, plugin_name, str(plugin_instance),
-                 type_name, type_instance, value))
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + str(plugin_instance) +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_name:
-        val.type = type_name
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    if type(value) == dict:
-        for type_inst in value:
-            val.type_instance = type_inst
-            val.values = [int(value[type_inst])]
-            val.dispatch()
-    elif type(value) == list:
-        val.values = value
-        val.dispatch()
-    else:
-        val.values = [int(value)]
-        val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -136,6 +113,20 @@ def configure_callback(conf):
             config['endpoint_type'] = node.values[0]
         elif node.key == 'Verbose':
             config['verbose_logging'] = node.values[0]
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -166,12 +157,13 @@ def connect(config):
     # this shouldn't raise any exception as no connection is done when
     # creating the object.  But It may change, so I catch everything.
     try:
-        client = get_client('2',
-                            os_username=config['username'],
-                            os_tenant_name=config['tenant'],
-                            os_password=config['password'],
-                            os_auth_url=config['auth_url'],
-                            os_endpoint_type=config['endpoint_type'])
+        client = ceilometer.get_client('2',
+                                       os_username=config['username'],
+                                       os_tenant_name=config['tenant'],
+                                       os_password=config['password'],
+                                       os_auth_url=config['auth_url'],
+                                       os_endpoint_type=config['endpoint_type'],
+                                       timeout=config['guard'].read_timeout)
     except Exception as e:
         log_error("Connection failed: %s" % e)
     return client
@@ -179,30 +171,93 @@ def connect(config):
 
 def init_callback():
     """Initialization block"""
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
+    config['guard'] = resilience.guard_from_config(
+        'metering', config.get('resilience'))
+    config['engine'] = concurrency.engine_from_config(
+        config.get('concurrency'), tenant=config['tenant'],
+        log=log_warning)
     ceilometer_client = connect(config)
     log_verbose('Got a valid connection to ceilometer API')
-    config['util'] = OpenstackUtils(ceilometer_client)
+    config['util'] = OpenstackUtils(ceilometer_client,
+                                    engine=config['engine'])
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Give the leadership up for another node to take it at once"""
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     if 'util' not in config:
         log_error("Problem during initialization, fix and restart collectd.")
-    info = config['util'].get_stats()
+    info = config['guard'].call(config['util'].get_stats)
+    dispatcher.add(config['guard'].metrics(),
+                   'ceilometer',
+                   'circuit_breaker',
+                   config['guard'].name,
+                   'self',
+                   'openstack')
+    limiter = ratelimit.limiter('metering')
+    if limiter is not None:
+        dispatcher.add(limiter.metrics(),
+                       'ceilometer',
+                       'rate_limit',
+                       'metering',
+                       'self',
+                       'openstack')
+    if 'scheduler' in config:
+        dispatcher.add(config['scheduler'].metrics(),
+                       'ceilometer',
+                       'schedule',
+                       '',
+                       'self',
+                       'openstack')
+    if info is None:
+        log_verbose("The circuit of %s is open or a call was throttled, "
+                    "skipping this read"
+                    % config['guard'].name)
+        dispatcher.flush()
+        return
     log_verbose(pformat(info))
-    # plugin instance
-    for plugin_instance in info:
-        # instance name
-        for type_name in info[plugin_instance]:
-            dispatch_value(info[plugin_instance][type_name],
-                           'ceilometer',
-                           config['util'].last_stats,
-                           type_name,
-                           '',
-                           plugin_instance,
-                           'openstack')
+    for key in info:
+        type_name, value = TYPES.group(key, info[key])
+        dispatcher.add(value,
+                       'ceilometer',
+                       type_name,
+                       '',
+                       '',
+                       'openstack',
+                       date=config['util'].last_stats)
+    log_verbose("Dispatched %d values" % dispatcher.flush())
 
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
 
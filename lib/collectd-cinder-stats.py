@@ -24,26 +24,47 @@
 # Requirments: python-cinderclient, collectd
 if __name__ != "__main__":
     import collectd
-from cinderclient.client import Client
 from datetime import datetime
 from time import mktime
 from pprint import pformat
+from collectd_openstack import churn
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import notifications
+from collectd_openstack import ratelimit
+from collectd_openstack import resilience
+from collectd_openstack import rest
+from collectd_openstack import warmstart
+from collectd_openstack import services
+from collectd_openstack import sharding
+from collectd_openstack import topk
+from collectd_openstack import schedule
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+from collectd_openstack import worker
 from string import find
 from functools import partial
 from itertools import chain
+import time
+
+cinder = clients.lazy('cinderclient.client')
 
 plugin_name = 'collectd-cinder-stats'
 version = '0.1.0'
 config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
+    'fast_path': False,
+    'streaming': False,
+    'compression': False,
+    'top_tenants': 0,
+    'churn': False,
+    'service_stale_after': 60,
 }
-
-CINDER_SERVICES = (
-    "cinder-backup",
-    "cinder-scheduler",
-    "cinder-volume"
-)
+dispatcher = dispatch.Dispatcher(collectd)
 
 STATUSES = {
     'backups': [
@@ -74,6 +95,55 @@ num_attachments = lambda x, y: x + len(y.attachments)
 sum_bootable = lambda x, y: x + (getattr(y, 'bootable', 0) in [ 'true', 'True' ])
 count_status = lambda status, x, y: x + (y.status == status)
 
+# Fields of the volumes and snapshots used by get_stats
+VOLUME = rest.Projection('Volume', [
+    ('id', 'id'),
+    ('volume_type', 'volume_type'),
+    ('size', 'size'),
+    ('attachments', 'attachments'),
+    ('bootable', 'bootable'),
+    ('status', 'status'),
+    ('tenant_id', 'os-vol-tenant-attr:tenant_id'),
+])
+
+SNAPSHOT = rest.Projection('Snapshot', [
+    ('id', 'id'),
+    ('volume_id', 'volume_id'),
+    ('volume_type', 'volume_type'),
+    ('size', 'size'),
+    ('status', 'status'),
+])
+
+# Fields of the listings without the details, enough to split the
+# listings between shards, and to link the snapshots of a part to the
+# types of the volumes of the other parts
+VOLUME_INDEX = rest.Projection('VolumeIndex', [
+    ('id', 'id'),
+    ('volume_type', 'volume_type'),
+])
+
+SNAPSHOT_INDEX = rest.Projection('SnapshotIndex', [('id', 'id')])
+
+# Same fields in the payload of the volume and snapshot notifications,
+# the volume type is the id of the type
+VOLUME_EVENT = rest.Projection('Volume', [
+    ('id', 'volume_id'),
+    ('volume_type', 'volume_type'),
+    ('size', 'size'),
+    ('attachments', 'volume_attachment'),
+    ('bootable', 'bootable'),
+    ('status', 'status'),
+    ('tenant_id', 'tenant_id'),
+])
+
+SNAPSHOT_EVENT = rest.Projection('Snapshot', [
+    ('id', 'snapshot_id'),
+    ('volume_id', 'volume_id'),
+    ('volume_type', 'volume_type'),
+    ('size', 'volume_size'),
+    ('status', 'status'),
+])
+
 PROPERTIES = {
     'backups': {
         'count' : count,
@@ -92,44 +162,193 @@ PROPERTIES = {
 }
 
 
+def stats_type(name, kind):
+    """Multi-value type of the properties and statuses of a kind"""
+    return typesdb.Type(name,
+                        sorted(PROPERTIES[kind]) +
+                        [(status.replace('-', '_'), "status_" + status)
+                         for status in STATUSES[kind]],
+                        stats_key=kind)
+
+
+# Types dispatched, generated into share/cinder-types.db
+TYPES = typesdb.Types('cinder', [
+    stats_type('volume_stats', 'volumes'),
+    stats_type('snapshot_stats', 'snapshots'),
+    stats_type('backup_stats', 'backups'),
+    typesdb.Type('tenant_volumes'),
+    typesdb.Type('tenant_gigabytes'),
+])
+
+
 class OpenstackUtils:
-    def __init__(self, cinder_client):
+    def __init__(self, cinder_client, sharding=None, engine=None):
         self.cinder_client = cinder_client
         self.last_stats = None
         self.connection_done = None
         self.stats = {}
+        self.sharding = sharding
+        # sharding.Part of the last listings of the volumes and the
+        # snapshots, and the types of all the volumes
+        self.parts = {}
+        self.volume_index = {}
+        self.engine = engine or concurrency.Engine(workers=0)
+        self.rest_client = None
+        self.churn = churn.Churn()
+        # notifications.Consumer in the notification mode, and the
+        # names of the volume types of the notifications
+        self.events = None
+        self.volume_types = {}
+
+    def _owns(self, key, item_id):
+        """Whether an item of the listing `key` is in our shard"""
+        if not self.sharding:
+            return True
+        part = self.parts.get(key)
+        return part is not None and part.owns(item_id)
+
+    def _list(self, manager, key, projection, index):
+        """Call of the engine listing all the items, or the ones of the
+        part of our shard cut from the `index` listing of their ids.
+
+        The items are projected tuples, read directly from the API on
+        the fast path.
+        """
+        if self.rest_client:
+            def search(search_opts, path=key + '/detail',
+                       projection=projection):
+                return self.rest_client.listing(path, key, projection,
+                                                params=search_opts)
+
+            def ids(search_opts):
+                return list(search(search_opts, key, index))
+        else:
+            def page(search_opts):
+                with self.engine.calls('volume'):
+                    return [projection.from_resource(item) for item in
+                            manager.list(search_opts=search_opts)]
+
+            def search(search_opts):
+                if not self.sharding:
+                    return page(search_opts)
+                # page by page, the listing of a part stops at the next
+                return sharding.pages(page, search_opts)
+
+            def ids(search_opts):
+                return [index.from_resource(item) for item in
+                        manager.list(detailed=False, search_opts=search_opts)]
+
+        def listing():
+            search_opts = {'all_tenants': 1}
+            if not self.sharding:
+                return list(search(search_opts))
+            items = ids(search_opts)
+            if index is VOLUME_INDEX:
+                self.volume_index = dict(items)
+            part = self.parts[key] = self.sharding.part(
+                [item.id for item in items])
+            if part.marker is not None:
+                search_opts['marker'] = part.marker
+            return list(part.take(search(search_opts)))
+        return self.engine.submit('volume', listing)
+
+    def dump_state(self, info):
+        return {'info': info, 'churn': self.churn.dump()}
+
+    def load_state(self, state):
+        self.stats = state['info']
+        self.churn.load(state['churn'])
 
     def get_stats(self):
+        if self.events and not self.events.due():
+            self.last_stats = int(mktime(datetime.now().timetuple()))
+            self.events.drain()
+            return self._event_stats()
+        stats = self._list_stats()
+        if self.events:
+            return self._event_stats()
+        return stats
+
+    def _list_stats(self):
+        start = time.time()
         volumes = {}
         volume_types = set()
-        kwargs = {'search_opts':{'all_tenants': 1}}
+        # backups and services are not split between shards
+        unsharded = not self.sharding or self.sharding.is_merger()
 
         log_verbose("Authenticating to keystone")
         self.cinder_client.authenticate()
+        if self.rest_client:
+            self.rest_client.close()
+        if config['fast_path']:
+            self.rest_client = rest.RestClient(
+                self.cinder_client.client.management_url,
+                self.cinder_client.client.auth_token,
+                timeout=config['guard'].timeout,
+                stream=config['streaming'],
+                compress=config['compression'],
+                service='volume', tenant=config['tenant'])
 
-        self.stats = { "backups" : {} }
+        self.stats = {}
         self.last_stats = int(mktime(datetime.now().timetuple()))
-
-        for volume in self.cinder_client.volumes.list(**kwargs):
+        usage = None
+        if config['top_tenants']:
+            usage = topk.Usage(config['top_tenants'], ['volumes', 'gigabytes'])
+            tenants = usage.counters
+        if config['churn']:
+            self.churn.start()
+
+        # the listings do not depend on each other, they are made at once
+        volume_call = self._list(self.cinder_client.volumes, 'volumes',
+                                 VOLUME, VOLUME_INDEX)
+        snapshot_call = self._list(self.cinder_client.volume_snapshots,
+                                   'snapshots', SNAPSHOT, SNAPSHOT_INDEX)
+        if unsharded:
+            backup_call = self.engine.submit(
+                'volume', self.cinder_client.backups.list)
+            services_call = self.engine.submit(
+                'volume', self.cinder_client.services.list)
+
+        for volume in volume_call.result():
             volumes[volume.id] = volume
+            # inline usage.add, a method call per volume costs more than
+            # the rest of the loop
+            if usage is not None:
+                tenant = volume.tenant_id or "unknown"
+                counts = tenants.get(tenant)
+                if counts is None:
+                    usage.insert(tenant, [1, volume.size or 0])
+                else:
+                    counts[0] += 1
+                    counts[1] += volume.size or 0
+            if config['churn']:
+                self.churn.add(volume.id, volume.status)
 
             # TODO: "None" type are all the volumes before the
             # switch to multi-backend.  Cannot do a thing about
             # them.  Maybe add a DefaultBackend option to the
             # script.  Or Just add the proper property to the
             # volume.
-            volume_types.add(getattr(volume, 'volume_type', None))
+            volume_types.add(volume.volume_type)
 
         # Link the snapshots to their respective backend type
-        snapshots = self.cinder_client.volume_snapshots.list(**kwargs)
-        for item in snapshots:
-            if not volumes.has_key(item.volume_id):
-                item.volume_type = None
+        snapshots = []
+        for item in snapshot_call.result():
+            volume = volumes.get(item.volume_id)
+            if volume:
+                volume_type = volume.volume_type
             else:
-                item.volume_type = volumes[item.volume_id].volume_type
+                # a volume of another part
+                volume_type = self.volume_index.get(item.volume_id)
+            snapshots.append(item._replace(volume_type=volume_type))
+
+        if self.events:
+            self._reconcile(volumes, snapshots, start)
 
         # Link the backup to the fake 'backups' backend type
-        backups = self.cinder_client.backups.list()
+        backups = []
+        if unsharded:
+            backups = backup_call.result()
         for backup in backups:
             backup.volume_type = "backups"
 
@@ -141,7 +360,9 @@ class OpenstackUtils:
             for prop, func in PROPERTIES[kind].items():
                 hash[prop] = reduce(func, items, 0)
 
-        fetch_stats("backups", self.stats["backups"], backups)
+        if unsharded:
+            self.stats["backups"] = {}
+            fetch_stats("backups", self.stats["backups"], backups)
         for volume_type in volume_types:
             self.stats[volume_type] = { "volumes" : {}, "snapshots" : {} }
             fetch_stats("volumes", self.stats[volume_type]["volumes"],
@@ -150,19 +371,110 @@ class OpenstackUtils:
             fetch_stats("snapshots", self.stats[volume_type]["snapshots"],
                         filter(lambda x: x.volume_type == volume_type,
                                snapshots))
+        if usage:
+            self.stats["tenants"] = usage.top()
+        if config['churn']:
+            changes = self.churn.finish()
+            if changes:
+                self.stats["churn"] = changes
+
+        if not unsharded:
+            return self.stats
 
         # Fetch the service states
-        services = []
-        fetched_services = self.cinder_client.services.list()
-        for service in CINDER_SERVICES:
-            instances = filter(lambda s: s.binary == service, fetched_services)
-            services.append(len(instances))
-            services.append(len(filter(lambda s: s.status == "enabled", instances)))
-            services.append(len(filter(lambda s: s.state == "up", instances)))
-
-        self.stats["cinder-services"] = services
+        health = services.ServiceHealth(config['service_stale_after'])
+        self.stats["cinder-services"] = health.summary(
+            map(services.from_resource, services_call.result()))
         return self.stats
 
+    def _reconcile(self, volumes, snapshots, start):
+        """Reset the counters of the notifications to the listings"""
+        try:
+            with self.engine.calls('volume'):
+                self.volume_types = dict(
+                    (volume_type.id, volume_type.name)
+                    for volume_type in self.cinder_client.volume_types.list())
+        except Exception as e:
+            log_warning("Cannot list the volume types: %s" % e)
+        self.events.reconcile(chain(volumes.items(),
+                                    ((item.id, item) for item in snapshots)),
+                              start)
+
+    def interpret(self, event_type, payload):
+        """Changes of the volumes and snapshots of a notification"""
+        if not event_type.endswith('.end'):
+            return None
+        if event_type.startswith('volume.'):
+            volume = VOLUME.tuple._make(VOLUME_EVENT(payload))
+            if not self._owns('volumes', volume.id):
+                return None
+            if event_type == 'volume.delete.end':
+                return [(notifications.REMOVE, volume.id, None)]
+            volume = volume._replace(volume_type=self.volume_types.get(
+                volume.volume_type, volume.volume_type))
+            if volume.attachments is None and volume.status:
+                volume = volume._replace(
+                    attachments=[None] if volume.status == 'in-use' else [])
+            return [(notifications.UPDATE, volume.id, volume)]
+        if event_type.startswith('snapshot.'):
+            snapshot = SNAPSHOT.tuple._make(SNAPSHOT_EVENT(payload))
+            if not self._owns('snapshots', snapshot.id):
+                return None
+            if event_type == 'snapshot.delete.end':
+                return [(notifications.REMOVE, snapshot.id, None)]
+            volume = self.events.tally.get(snapshot.volume_id)
+            if volume:
+                snapshot = snapshot._replace(volume_type=volume.volume_type)
+            elif snapshot.volume_id in self.volume_index:
+                snapshot = snapshot._replace(
+                    volume_type=self.volume_index[snapshot.volume_id])
+            return [(notifications.UPDATE, snapshot.id, snapshot)]
+        return None
+
+    def contribution(self, item):
+        """Counters of a volume or a snapshot, see notifications.Tally"""
+        kind = 'volumes' if isinstance(item, VOLUME.tuple) else 'snapshots'
+        prefix = ('types', item.volume_type, kind)
+        counters = [
+            (prefix + ('count',), 1),
+            (prefix + ('size',), item.size or 0),
+        ]
+        if item.status in STATUSES[kind]:
+            counters.append((prefix + ('status_' + item.status,), 1))
+        if kind == 'snapshots':
+            return counters
+        counters.append((prefix + ('attached',), len(item.attachments or [])))
+        counters.append((prefix + ('bootable',),
+                         int(item.bootable in ['true', 'True', True])))
+        if config['top_tenants']:
+            tenant = item.tenant_id or "unknown"
+            counters.append((('tenant_volumes', tenant), 1))
+            counters.append((('tenant_gigabytes', tenant), item.size or 0))
+        return counters
+
+    def _event_stats(self):
+        """Stats of the counters of the notifications, the backups and
+        the services are the ones of the last listing"""
+        counters = self.events.tally.nested()
+        stats = dict((key, value) for key, value in self.stats.items()
+                     if key in ('backups', 'cinder-services'))
+        for volume_type, kinds in counters.get('types', {}).items():
+            stats[volume_type] = {}
+            for kind in ('volumes', 'snapshots'):
+                group = dict((prop, 0) for prop in PROPERTIES[kind])
+                group.update(('status_' + status, 0)
+                             for status in STATUSES[kind])
+                group.update(kinds.get(kind, {}))
+                stats[volume_type][kind] = group
+        if config['top_tenants']:
+            stats['tenants'] = dict(
+                (resource, topk.trim(counters.get('tenant_' + resource, {}),
+                                     config['top_tenants']))
+                for resource in ('volumes', 'gigabytes'))
+        if config['churn']:
+            stats['churn'] = self.events.tally.pop_churn()
+        return stats
+
 
 def log_verbose(msg):
     if not config['verbose_logging']:
@@ -179,43 +491,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, plugin_name, date=None, type_name='',
-                   type_instance='', plugin_instance='',
-                   host=''):
-    """Dispatch a value"""
-    # host "/" plugin ["-" plugin instance] "/" type ["-" type instance]
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + str(plugin_instance) +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_name:
-        val.type = type_name
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    if type(value) == dict:
-        for type_inst in value:
-            val.type_instance = type_inst
-            val.values = [int(value[type_inst])]
-            val.dispatch()
-    elif type(value) == list:
-        val.values = value
-        val.dispatch()
-    else:
-        val.values = [int(value)]
-        val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -232,6 +507,41 @@ def configure_callback(conf):
             config['endpoint_type'] = node.values[0]
         elif node.key == 'Verbose':
             config['verbose_logging'] = node.values[0]
+        elif node.key == 'FastPath':
+            config['fast_path'] = bool(node.values[0])
+        elif node.key == 'Streaming':
+            config['streaming'] = bool(node.values[0])
+        elif node.key == 'Compression':
+            config['compression'] = bool(node.values[0])
+        elif node.key == 'TopTenants':
+            config['top_tenants'] = int(node.values[0])
+        elif node.key == 'Churn':
+            config['churn'] = bool(node.values[0])
+        elif node.key == 'ServiceStaleAfter':
+            config['service_stale_after'] = float(node.values[0])
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
+        elif node.key == 'Worker':
+            config['worker'] = worker.parse_config(node)
+            config['worker_config'] = worker.dump_config(conf)
+        elif node.key == 'Notifications':
+            config['notifications'] = notifications.parse_config(node)
+        elif node.key == 'WarmStart':
+            config['warm_start'] = warmstart.parse_config(node)
+        elif node.key == 'Sharding':
+            config['sharding'] = sharding.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -262,12 +572,13 @@ def connect(config):
     # this shouldn't raise any exception as no connection is done when
     # creating the object.  But It may change, so I catch everything.
     try:
-        cinder_client = Client('1',
-                               username=config['username'],
-                               project_id=config['tenant'],
-                               api_key=config['password'],
-                               auth_url=config['auth_url'],
-                               endpoint_type=config['endpoint_type'])
+        cinder_client = cinder.Client('1',
+                                      username=config['username'],
+                                      project_id=config['tenant'],
+                                      api_key=config['password'],
+                                      auth_url=config['auth_url'],
+                                      endpoint_type=config['endpoint_type'],
+                                      timeout=config['guard'].read_timeout)
         cinder_client.authenticate()
     except Exception as e:
         log_error("Connection failed: %s" % e)
@@ -277,40 +588,234 @@ def connect(config):
 def init_callback():
     """Initialization block"""
     global config
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'worker' in config:
+        # the reads are made by a process of their own
+        config['process'] = worker.worker_from_config(
+            __file__, config['worker_config'], config['worker'], collectd)
+        return
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
+    config['guard'] = resilience.guard_from_config(
+        'volume', config.get('resilience'))
+    config['engine'] = concurrency.engine_from_config(
+        config.get('concurrency'), tenant=config['tenant'],
+        log=log_warning)
     cinder_client = connect(config)
     log_verbose('Got a valid connection to cinder API')
-    config['util'] = OpenstackUtils(cinder_client)
+    if 'sharding' in config:
+        config['util'] = OpenstackUtils(
+            cinder_client,
+            sharding=sharding.sharding_from_config(
+                plugin_name, config['sharding'], config.get('schedule')),
+            engine=config['engine'])
+    else:
+        config['util'] = OpenstackUtils(cinder_client,
+                                        engine=config['engine'])
+    if 'notifications' in config:
+        config['util'].events = notifications.consumer_from_config(
+            plugin_name, config['notifications'], config['util'].interpret,
+            config['util'].contribution, ['cinder'])
+    if 'warm_start' in config:
+        config['warmstart'] = warmstart.warmstart_from_config(
+            plugin_name, version, config['warm_start'])
+        try:
+            state = config['warmstart'].load()
+        except Exception as e:
+            log_warning("Cannot load the warm start snapshot: %s" % e)
+            state = None
+        if state:
+            log_verbose("Warm start from a snapshot saved %ds ago"
+                        % state['age'])
+            config['util'].load_state(state)
+            config['warm_info'] = state['info']
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Stop the worker process, give the leadership up"""
+    if 'process' in config:
+        config['process'].stop()
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
     global config
+    if 'process' in config:
+        values = config['process'].read()
+        if values is None:
+            log_warning("The worker is waiting to restart, skipping this read")
+        for value in values or ():
+            dispatcher.add(*value)
+        dispatcher.add(config['process'].metrics(),
+                       'cinder',
+                       'worker',
+                       'volumes',
+                       'self',
+                       'openstack')
+        if 'scheduler' in config:
+            dispatcher.add(config['scheduler'].metrics(),
+                           'cinder',
+                           'schedule',
+                           '',
+                           'self',
+                           'openstack')
+        dispatcher.flush()
+        return
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     if 'util' not in config:
         log_error("Problem during initialization, fix and restart collectd.")
-    info = config['util'].get_stats()
+    if 'warm_info' in config:
+        log_verbose("Dispatching the stats of the warm start snapshot")
+        info = config.pop('warm_info')
+        config['util'].last_stats = int(mktime(datetime.now().timetuple()))
+    else:
+        info = config['guard'].call(config['util'].get_stats)
+        dispatcher.add(config['guard'].metrics(),
+                       'cinder',
+                       'circuit_breaker',
+                       config['guard'].name,
+                       'self',
+                       'openstack')
+        limiter = ratelimit.limiter('volume')
+        if limiter is not None:
+            dispatcher.add(limiter.metrics(),
+                           'cinder',
+                           'rate_limit',
+                           'volume',
+                           'self',
+                           'openstack')
+        if 'scheduler' in config:
+            dispatcher.add(config['scheduler'].metrics(),
+                           'cinder',
+                           'schedule',
+                           '',
+                           'self',
+                           'openstack')
+        if info is None:
+            log_verbose("The circuit of %s is open or a call was throttled, "
+                        "skipping this read"
+                        % config['guard'].name)
+            dispatcher.flush()
+            return
+        if config['util'].sharding:
+            info = config['util'].sharding.exchange(info)
+            if info is None:
+                if config['util'].sharding.missing:
+                    log_warning("Missing partial stats from shards %s"
+                                % config['util'].sharding.missing)
+                # the self metrics of this node, not left for a later read
+                dispatcher.flush()
+                return
+        if 'warmstart' in config:
+            try:
+                config['warmstart'].save(config['util'].dump_state(info))
+            except Exception as e:
+                log_warning("Cannot save the warm start snapshot: %s" % e)
     log_verbose(pformat(info))
 
     # plugin instance
     for plugin_instance in info:
         # instance name
-        if plugin_instance in ('cinder-services', 'backups'):
-            dispatch_value(info[plugin_instance],
+        if plugin_instance == 'cinder-services':
+            for binary, health in info[plugin_instance].items():
+                dispatcher.add(health,
+                               'cinder',
+                               'service_health',
+                               binary,
+                               '',
+                               'openstack',
+                               date=config['util'].last_stats)
+        elif plugin_instance == 'tenants':
+            # the heaviest tenants of each resource, and the other ones
+            for resource, top in info[plugin_instance].items():
+                dispatcher.add(topk.trim(top, config['top_tenants']),
+                               'cinder',
+                               'tenant_' + resource,
+                               '',
+                               '',
+                               'openstack',
+                               date=config['util'].last_stats)
+        elif plugin_instance == 'churn':
+            dispatcher.add(info[plugin_instance],
+                           'cinder',
+                           'churn',
+                           'volumes',
+                           '',
+                           'openstack',
+                           date=config['util'].last_stats)
+        elif plugin_instance == 'backups':
+            type_name, value = TYPES.group(plugin_instance,
+                                           info[plugin_instance])
+            dispatcher.add(value,
                            'cinder',
-                           config['util'].last_stats,
-                           plugin_instance,
+                           type_name,
                            '',
                            '',
-                           'openstack')
+                           'openstack',
+                           date=config['util'].last_stats)
         else:
-            for type_name in info[plugin_instance]:
-                dispatch_value(info[plugin_instance][type_name],
+            for key in info[plugin_instance]:
+                type_name, value = TYPES.group(key,
+                                               info[plugin_instance][key])
+                dispatcher.add(value,
                                'cinder',
-                               config['util'].last_stats,
                                type_name,
                                '',
                                plugin_instance,
-                               'openstack')
+                               'openstack',
+                               date=config['util'].last_stats)
+
+    if config['util'].rest_client:
+        transfers = config['util'].rest_client.pop_transfers()
+        for listing, transfer in transfers.items():
+            dispatcher.add(transfer,
+                           'cinder',
+                           'http_transfer',
+                           listing,
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+    if config['util'].events:
+        dispatcher.add(config['util'].events.metrics(),
+                       'cinder',
+                       'notifications',
+                       'volumes',
+                       'self',
+                       'openstack',
+                       date=config['util'].last_stats)
+        if config['util'].events.drift is not None:
+            dispatcher.add(config['util'].events.drift,
+                           'cinder',
+                           'reconciliation_drift',
+                           'volumes',
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+    log_verbose("Dispatched %d values" % dispatcher.flush())
 
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
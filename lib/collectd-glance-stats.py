@@ -25,12 +25,26 @@
 # Requirments: python-neutronclient, python-keystoneclient, collectd
 if __name__ != "__main__":
     import collectd
-import glanceclient.client as glance
-from keystoneclient.v2_0 import client as keystone
+from collections import namedtuple
 from datetime import datetime
 from time import mktime
 from pprint import pformat
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import notifications
+from collectd_openstack import ratelimit
+from collectd_openstack import resilience
+from collectd_openstack import schedule
+from collectd_openstack import shm
+from collectd_openstack import typesdb
 import re
+import time
+
+glance = clients.lazy('glanceclient.client')
+keystone = clients.lazy('keystoneclient.v2_0.client')
 
 
 plugin_name = 'collectd-glance-stats'
@@ -39,28 +53,82 @@ config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
 }
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Types dispatched, generated into share/glance-types.db
+TYPES = typesdb.Types('glance', [
+    typesdb.Type('image_visibility', ['public', 'private', 'shared'],
+                 stats_key='images'),
+])
+
+VISIBILITIES = ('public', 'private', 'shared')
+
+Image = namedtuple('Image', ['visibility'])
+
+
+def interpret(event_type, payload):
+    """Changes of the images of a notification"""
+    if event_type == 'image.delete':
+        return [(notifications.REMOVE, payload.get('id'), None)]
+    if event_type not in ('image.create', 'image.update', 'image.upload',
+                          'image.activate'):
+        return None
+    visibility = payload.get('visibility')
+    if visibility is None and 'is_public' in payload:
+        # notifications of the v1 API
+        visibility = 'public' if payload['is_public'] else 'private'
+    return [(notifications.UPDATE, payload.get('id'), Image(visibility))]
+
+
+def contribution(image):
+    """Counters of an image, see notifications.Tally"""
+    if image.visibility in VISIBILITIES:
+        return [(('images', image.visibility), 1)]
+    return []
 
 
 class OpenstackUtils:
-    def __init__(self, client):
+    def __init__(self, client, events=None, engine=None):
         self.client = client
+        self.engine = engine or concurrency.Engine(workers=0)
         self.last_stats = None
         self.connection_done = None
+        # notifications.Consumer in the notification mode
+        self.events = events
 
     def get_stats(self):
+        if self.events and not self.events.due():
+            self.last_stats = int(mktime(datetime.now().timetuple()))
+            self.events.drain()
+            return self._event_stats()
+        start = time.time()
         stats = {}
         self.last_stats = int(mktime(datetime.now().timetuple()))
         # This is not very smart as we could just fetch all the images
         # and filter on the client...
-        stats['public'] = len(list(self.client.images.list(
-            filters={'visibility': 'public', 'member_status': 'all'})))
-        stats['private'] = len(list(self.client.images.list(
-            filters={'visibility': 'private', 'member_status': 'all'})))
-        stats['shared'] = len(list(self.client.images.list(
-            filters={'visibility': 'shared', 'member_status': 'all'})))
-
+        stats['images'] = {}
+        listed = []
+        listings = self.engine.map(
+            'image', lambda visibility: list(self.client.images.list(
+                filters={'visibility': visibility, 'member_status': 'all'})),
+            VISIBILITIES)
+        for visibility, images in zip(VISIBILITIES, listings):
+            stats['images'][visibility] = len(images)
+            if self.events:
+                listed.extend((image.id, Image(visibility))
+                              for image in images)
+
+        if self.events:
+            self.events.reconcile(listed, start)
+            return self._event_stats()
         return stats
 
+    def _event_stats(self):
+        """Stats of the counters of the notifications"""
+        images = dict((visibility, 0) for visibility in VISIBILITIES)
+        images.update(self.events.tally.nested().get('images', {}))
+        return {'images': images}
+
 
 def log_verbose(msg):
     if not config['verbose_logging']:
@@ -77,32 +145,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, type_name, plugin_name, date=None,
-                   type_instance=None, plugin_instance=None,
-                   host=None):
-    """Dispatch a value"""
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + plugin_instance +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-    val.type = type_name
-    val.values = [value]
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     for node in conf.children:
@@ -118,6 +160,22 @@ def configure_callback(conf):
             config['endpoint_type'] = node.values[0]
         elif node.key == 'Verbose':
             config['verbose_logging'] = bool(node.values[0])
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
+        elif node.key == 'Notifications':
+            config['notifications'] = notifications.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -145,12 +203,20 @@ def configure_callback(conf):
 
 
 def connect(config):
+    # the breaker and the engine outlive the reconnections
+    if 'guard' not in config:
+        config['guard'] = resilience.guard_from_config(
+            'image', config.get('resilience'))
+        config['engine'] = concurrency.engine_from_config(
+            config.get('concurrency'), tenant=config['tenant'],
+            log=log_warning)
     # The Glance client is not able to query Keystone
     # for the endpoint, neither authenticate itself
     ksclient = keystone.Client(username=config['username'],
                                tenant_name=config['tenant'],
                                password=config['password'],
-                               auth_url=config['auth_url'])
+                               auth_url=config['auth_url'],
+                               timeout=config['guard'].read_timeout)
 
     endpoint = ksclient.service_catalog.url_for(
                    service_type='image',
@@ -168,31 +234,114 @@ def connect(config):
 
     client = glance.Client('2',
                            endpoint=endpoint,
-                           token=ksclient.auth_token)
+                           token=ksclient.auth_token,
+                           timeout=config['guard'].read_timeout)
 
-    config['util'] = OpenstackUtils(client)
+    # the notifications outlive the reconnections too
+    if 'notifications' in config and 'events' not in config:
+        config['events'] = notifications.consumer_from_config(
+            plugin_name, config['notifications'], interpret, contribution,
+            ['glance'])
+    config['util'] = OpenstackUtils(client, events=config.get('events'),
+                                    engine=config['engine'])
 
 
 def init_callback():
     """Initialization block"""
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
     connect(config)
     log_verbose('Got a valid connection to glance API')
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Give the leadership up for another node to take it at once"""
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     connect(config)
 
     try:
-        info = config['util'].get_stats()
+        info = config['guard'].call(config['util'].get_stats)
+        dispatcher.add(config['guard'].metrics(),
+                       'glance',
+                       'circuit_breaker',
+                       config['guard'].name,
+                       'self',
+                       'openstack')
+        limiter = ratelimit.limiter('image')
+        if limiter is not None:
+            dispatcher.add(limiter.metrics(),
+                           'glance',
+                           'rate_limit',
+                           'image',
+                           'self',
+                           'openstack')
+        if 'scheduler' in config:
+            dispatcher.add(config['scheduler'].metrics(),
+                           'glance',
+                           'schedule',
+                           '',
+                           'self',
+                           'openstack')
+        if info is None:
+            log_verbose("The circuit of %s is open or a call was throttled, "
+                        "skipping this read"
+                        % config['guard'].name)
+            dispatcher.flush()
+            return
         log_verbose(pformat(info))
         for key, value in info.items():
-            dispatch_value(value,
-                           key,
+            type_name, value = TYPES.group(key, value)
+            dispatcher.add(value,
                            'glance',
-                           config['util'].last_stats,
+                           type_name,
                            '',
                            '',
-                           'openstack')
+                           'openstack',
+                           date=config['util'].last_stats)
+        if config['util'].events:
+            dispatcher.add(config['util'].events.metrics(),
+                           'glance',
+                           'notifications',
+                           'images',
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+            if config['util'].events.drift is not None:
+                dispatcher.add(config['util'].events.drift,
+                               'glance',
+                               'reconciliation_drift',
+                               'images',
+                               'self',
+                               'openstack',
+                               date=config['util'].last_stats)
+        log_verbose("Dispatched %d values" % dispatcher.flush())
     except Exception as e:
         log_warning(
             "Problem while reading, trying to authenticate (%s)" % e)
@@ -202,4 +351,4 @@ def read_callback(data=None):
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
@@ -26,38 +26,144 @@
 
 if __name__ != "__main__":
     import collectd
-from heatclient import client as heat
-from keystoneclient.v2_0 import client as keystone
 from datetime import datetime
 from time import mktime
 from pprint import pformat
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import notifications
+from collectd_openstack import ratelimit
+from collectd_openstack import resilience
+from collectd_openstack import schedule
+from collectd_openstack import services
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+from collectd_openstack import rest
 import re
+import time
+
+heat = clients.lazy('heatclient.client')
+keystone = clients.lazy('keystoneclient.v2_0.client')
 
 
 plugin_name = 'collectd-heat-stats'
 version = '0.0.1'
 config = {
     'endpoint_type': "internalURL",
-    'verbose_logging': False
+    'verbose_logging': False,
+    'fast_path': False,
+    'streaming': False,
+    'compression': False,
+    'service_stale_after': 60,
 }
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Types dispatched, generated into share/heat-types.db
+TYPES = typesdb.Types('heat', [
+    typesdb.Type('stacks', ['count', 'success', 'failed']),
+])
+
+# Fields of the stacks used by get_stats
+STACK = rest.Projection('Stack', [
+    ('id', 'id'),
+    ('stack_status', 'stack_status'),
+])
+
+# Same fields in the payload of the orchestration.stack notifications,
+# the id is at the end of the identity
+STACK_EVENT = rest.Projection('Stack', [
+    ('id', 'stack_identity'),
+    ('stack_status', 'state'),
+])
+
+
+def interpret(event_type, payload):
+    """Changes of the stacks of a notification"""
+    if not event_type.startswith('orchestration.stack.') or \
+            event_type.endswith('.start'):
+        return None
+    stack = STACK_EVENT(payload)
+    stack = stack._replace(id=notifications.last_segment(stack.id))
+    if event_type == 'orchestration.stack.delete.end':
+        return [(notifications.REMOVE, stack.id, None)]
+    return [(notifications.UPDATE, stack.id, stack)]
+
+
+def contribution(stack):
+    """Counters of a stack, see notifications.Tally"""
+    return [(('count',), 1), (('status', stack.stack_status), 1)]
 
 
 class OpenstackUtils:
-    def __init__(self, heat_client):
+    def __init__(self, heat_client, rest_client=None, events=None,
+                 engine=None):
         self.heat_client = heat_client
+        self.rest_client = rest_client
+        self.engine = engine or concurrency.Engine(workers=0)
         self.last_stats = None
         self.connection_done = None
+        self.list_engines = True
+        # notifications.Consumer in the notification mode, and the stats
+        # of the last listing
+        self.events = events
+        self.stats = {}
 
     def get_stats(self):
+        if self.events and not self.events.due():
+            self.last_stats = int(mktime(datetime.now().timetuple()))
+            self.events.drain()
+            return self._event_stats()
+        start = time.time()
         stats = {}
         self.last_stats = int(mktime(datetime.now().timetuple()))
         kwargs = {'global_tenant': True}
-        stacks = list(self.heat_client.stacks.list(**kwargs))
+        # the engines are listed meanwhile
+        if self.list_engines:
+            engines = self.engine.submit('orchestration',
+                                         self.heat_client.services.list)
+        if self.rest_client:
+            stacks = list(self.rest_client.listing('stacks', 'stacks', STACK,
+                                                   params=kwargs))
+        else:
+            with self.engine.calls('orchestration'):
+                stacks = [STACK.from_resource(stack) for stack in
+                          self.heat_client.stacks.list(**kwargs)]
         stats['stacks'] = [
             len(stacks),
             len(filter(lambda s: s.stack_status == "CREATE_COMPLETE", stacks)),
             len(filter(lambda s: s.stack_status == "CREATE_FAILED", stacks))
         ]
+        if self.list_engines:
+            try:
+                engines = engines.result()
+            except Exception as e:
+                # needs a recent heat and an admin account
+                log_warning("Cannot list the heat engines, skipping them: %s"
+                            % e)
+                self.list_engines = False
+            else:
+                health = services.ServiceHealth(config['service_stale_after'])
+                stats['engines'] = health.summary(
+                    map(services.from_engine, engines))
+        self.stats = stats
+        if self.events:
+            self.events.reconcile(((stack.id, stack) for stack in stacks),
+                                  start)
+            return self._event_stats()
+        return stats
+
+    def _event_stats(self):
+        """Stats of the counters of the notifications, the engines are the
+        ones of the last listing"""
+        counters = self.events.tally.nested()
+        statuses = counters.get('status', {})
+        stats = dict(self.stats)
+        stats['stacks'] = [counters.get('count', 0),
+                           statuses.get('CREATE_COMPLETE', 0),
+                           statuses.get('CREATE_FAILED', 0)]
         return stats
 
 
@@ -76,32 +182,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, type_name, plugin_name, date=None,
-                   type_instance=None, plugin_instance=None,
-                   host=None):
-    """Dispatch a value"""
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + plugin_instance +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-    val.type = type_name
-    val.values = value
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -118,6 +198,30 @@ def configure_callback(conf):
             config['endpoint_type'] = node.values[0]
         elif node.key == 'Verbose':
             config['verbose_logging'] = bool(node.values[0])
+        elif node.key == 'FastPath':
+            config['fast_path'] = bool(node.values[0])
+        elif node.key == 'Streaming':
+            config['streaming'] = bool(node.values[0])
+        elif node.key == 'Compression':
+            config['compression'] = bool(node.values[0])
+        elif node.key == 'ServiceStaleAfter':
+            config['service_stale_after'] = float(node.values[0])
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
+        elif node.key == 'Notifications':
+            config['notifications'] = notifications.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -145,10 +249,18 @@ def configure_callback(conf):
 
 
 def connect(config):
+    # the breaker and the engine outlive the reconnections
+    if 'guard' not in config:
+        config['guard'] = resilience.guard_from_config(
+            'orchestration', config.get('resilience'))
+        config['engine'] = concurrency.engine_from_config(
+            config.get('concurrency'), tenant=config['tenant'],
+            log=log_warning)
     ksclient = keystone.Client(username=config['username'],
                                tenant_name=config['tenant'],
                                password=config['password'],
-                               auth_url=config['auth_url'])
+                               auth_url=config['auth_url'],
+                               timeout=config['guard'].read_timeout)
 
     endpoint = ksclient.service_catalog.url_for(
                    service_type='orchestration',
@@ -157,35 +269,150 @@ def connect(config):
 
     heat_client = heat.Client('1',
                               endpoint=endpoint,
-                              token=ksclient.auth_token)
-
-    config['util'] = OpenstackUtils(heat_client=heat_client)
+                              token=ksclient.auth_token,
+                              timeout=config['guard'].read_timeout)
+
+    rest_client = None
+    if config['fast_path']:
+        rest_client = rest.RestClient(endpoint, ksclient.auth_token,
+                                      timeout=config['guard'].timeout,
+                                      stream=config['streaming'],
+                                      compress=config['compression'],
+                                      service='orchestration',
+                                      tenant=config['tenant'])
+    if 'util' in config and config['util'].rest_client:
+        config['util'].rest_client.close()
+    # the notifications outlive the reconnections too
+    if 'notifications' in config and 'events' not in config:
+        config['events'] = notifications.consumer_from_config(
+            plugin_name, config['notifications'], interpret, contribution,
+            ['heat'])
+    config['util'] = OpenstackUtils(heat_client=heat_client,
+                                    rest_client=rest_client,
+                                    events=config.get('events'),
+                                    engine=config['engine'])
 
 
 def init_callback():
     """Initialization block"""
     global config
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
     connect(config)
     log_verbose('Got a valid connection to Heat API')
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Give the leadership up for another node to take it at once"""
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
     global config
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     if 'util' not in config:
         log_warning("Connection has not been done. Retrying")
         connect(config)
 
     try:
-        info = config['util'].get_stats()
+        info = config['guard'].call(config['util'].get_stats)
+        dispatcher.add(config['guard'].metrics(),
+                       'heat',
+                       'circuit_breaker',
+                       config['guard'].name,
+                       'self',
+                       'openstack')
+        limiter = ratelimit.limiter('orchestration')
+        if limiter is not None:
+            dispatcher.add(limiter.metrics(),
+                           'heat',
+                           'rate_limit',
+                           'orchestration',
+                           'self',
+                           'openstack')
+        if 'scheduler' in config:
+            dispatcher.add(config['scheduler'].metrics(),
+                           'heat',
+                           'schedule',
+                           '',
+                           'self',
+                           'openstack')
+        if info is None:
+            log_verbose("The circuit of %s is open or a call was throttled, "
+                        "skipping this read"
+                        % config['guard'].name)
+            dispatcher.flush()
+            return
         log_verbose(pformat(info))
         for key, value in info.items():
-            dispatch_value(value,
-                           key,
+            if key == 'engines':
+                for binary, health in value.items():
+                    dispatcher.add(health,
+                                   'heat',
+                                   'service_health',
+                                   binary,
+                                   '',
+                                   'openstack',
+                                   date=config['util'].last_stats)
+                continue
+            type_name, value = TYPES.group(key, value)
+            dispatcher.add(value,
                            'heat',
-                           config['util'].last_stats,
+                           type_name,
                            '',
                            '',
-                           'openstack')
+                           'openstack',
+                           date=config['util'].last_stats)
+        if config['util'].rest_client:
+            transfers = config['util'].rest_client.pop_transfers()
+            for listing, transfer in transfers.items():
+                dispatcher.add(transfer,
+                               'heat',
+                               'http_transfer',
+                               listing,
+                               'self',
+                               'openstack',
+                               date=config['util'].last_stats)
+        if config['util'].events:
+            dispatcher.add(config['util'].events.metrics(),
+                           'heat',
+                           'notifications',
+                           'stacks',
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+            if config['util'].events.drift is not None:
+                dispatcher.add(config['util'].events.drift,
+                               'heat',
+                               'reconciliation_drift',
+                               'stacks',
+                               'self',
+                               'openstack',
+                               date=config['util'].last_stats)
+        log_verbose("Dispatched %d values" % dispatcher.flush())
     except Exception as e:
         log_warning(
             "Problem while reading, trying to authenticate (%s)" % e)
@@ -195,4 +422,4 @@ def read_callback(data=None):
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
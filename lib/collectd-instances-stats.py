@@ -24,13 +24,33 @@
 # Requirments: python-cinderclient, collectd
 if __name__ != "__main__":
     import collectd
-import novaclient.client as nova
-import glanceclient.client as glance
-from keystoneclient.v2_0 import client as keystone
 from datetime import datetime
 from time import mktime
 from pprint import pformat
+from collectd_openstack import churn
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import notifications
+from collectd_openstack import ratelimit
+from collectd_openstack import refcache
+from collectd_openstack import resilience
+from collectd_openstack import rest
+from collectd_openstack import warmstart
+from collectd_openstack import sharding
+from collectd_openstack import topk
+from collectd_openstack import schedule
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+from collectd_openstack import worker
 import itertools
+import time
+
+nova = clients.lazy('novaclient.client')
+glance = clients.lazy('glanceclient.client')
+keystone = clients.lazy('keystoneclient.v2_0.client')
 
 plugin_name = 'collectd-instances-stats'
 
@@ -39,8 +59,60 @@ version = '0.1.0'
 config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
-    'image_filters': {}
+    'image_filters': {},
+    'fast_path': False,
+    'streaming': False,
+    'compression': False,
+    'top_tenants': 0,
+    'churn': False,
+}
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Fields of the servers used by get_stats
+SERVER = rest.Projection('Server', [
+    ('id', 'id'),
+    ('status', 'status'),
+    ('flavor_id', 'flavor.id'),
+    ('image_id', 'image.id'),
+    ('tenant_id', 'tenant_id'),
+])
+
+# The ids of the servers listed to split the listing between shards
+SERVER_ID = rest.Projection('ServerId', [('id', 'id')])
+
+# Same fields in the payload of the compute.instance notifications
+SERVER_EVENT = rest.Projection('Server', [
+    ('id', 'instance_id'),
+    ('status', 'state'),
+    ('flavor_id', 'instance_flavor_id'),
+    ('image_id', 'image_meta.base_image_ref'),
+    ('tenant_id', 'tenant_id'),
+])
+
+# Status of the API of each vm_state of the notifications
+VM_STATES = {
+    'active': 'ACTIVE',
+    'building': 'BUILD',
+    'deleted': 'DELETED',
+    'error': 'ERROR',
+    'paused': 'PAUSED',
+    'rescued': 'RESCUE',
+    'resized': 'VERIFY_RESIZE',
+    'shelved': 'SHELVED',
+    'shelved_offloaded': 'SHELVED_OFFLOADED',
+    'soft-delete': 'SOFT_DELETED',
+    'stopped': 'SHUTOFF',
+    'suspended': 'SUSPENDED',
 }
+# the servers deleted, or soft deleted until they are reclaimed
+DELETED_STATES = ('deleted', 'soft-delete')
+
+
+def flavor_spec(flavor):
+    """(vcpus, ram, disk, extra_specs) of a flavor, extra_specs are only
+    in the flavor records since the compute API 2.61"""
+    return (flavor.vcpus, flavor.ram, flavor.disk,
+            getattr(flavor, 'extra_specs', None) or {})
 
 
 class OpenstackUtils:
@@ -61,15 +133,30 @@ class OpenstackUtils:
         'VERIFY_RESIZE'
     ]
 
-    def __init__(self):
+    def __init__(self, sharding=None, cache=None, engine=None):
         self.last_stats = None
         self.connection_done = None
+        self.sharding = sharding
+        # sharding.Part of the last listing of the servers
+        self.part = None
+        self.images = None
+        self.flavors = None
+        self.flavor_specs = None
+        # flavors missing from the listings, deleted ones
+        self.missing_flavors = {}
+        self.churn = churn.Churn()
+        self.cache = cache or refcache.RefCache()
+        self.engine = engine or concurrency.Engine(workers=0)
+        self.rest_client = None
+        # notifications.Consumer in the notification mode
+        self.events = None
 
     def connect(self, config):
         ksclient = keystone.Client(username=config['username'],
                                    tenant_name=config['tenant'],
                                    password=config['password'],
-                                   auth_url=config['auth_url'])
+                                   auth_url=config['auth_url'],
+                                   timeout=config['guard'].read_timeout)
 
         compute_endpoint = ksclient.service_catalog.url_for(
                                service_type='compute',
@@ -87,29 +174,57 @@ class OpenstackUtils:
                                   api_key='',
                                   project_id=config['tenant'],
                                   bypass_url=compute_endpoint,
-                                  auth_token=ksclient.auth_token)
+                                  auth_token=ksclient.auth_token,
+                                  timeout=config['guard'].read_timeout)
 
         glance_client = glance.Client('1',
                                       endpoint=image_endpoint,
-                                      token=ksclient.auth_token)
-
-        return nova_client, glance_client
+                                      token=ksclient.auth_token,
+                                      timeout=config['guard'].read_timeout)
+
+        if self.rest_client:
+            self.rest_client.close()
+        if config['fast_path']:
+            self.rest_client = rest.RestClient(compute_endpoint,
+                                               ksclient.auth_token,
+                                               timeout=config['guard'].timeout,
+                                               stream=config['streaming'],
+                                               compress=config['compression'],
+                                               service='compute',
+                                               tenant=config['tenant'])
+
+        return nova_client, glance_client, ksclient
 
     def get_stats(self):
-        nova_client, glance_client = self.connect(config)
+        if self.events and not self.events.due():
+            self.last_stats = int(mktime(datetime.now().timetuple()))
+            self.events.drain()
+            return self._event_stats()
+
+        nova_client, glance_client, ksclient = self.connect(config)
 
         self.last_stats = int(mktime(datetime.now().timetuple()))
 
-        images = {}
-        for image in glance_client.images.list(
-                         filters={'visibility': 'public',
-                                  'properties': config['image_filters'],
-                                  'member_status': 'all'}):
-            images[image.id] = image.name
-
-        flavors = {}
-        for flavor in nova_client.flavors.list():
-            flavors[flavor.id] = flavor.name
+        # from two APIs, listed at once
+        images, (flavors, flavor_specs) = self.engine.gather([
+            self.engine.submit('image', self.cache.get, 'images', 'public',
+                               lambda: self._list_images(glance_client)),
+            self.engine.submit('compute', self.cache.get, 'flavors', 'all',
+                               lambda: self._list_flavors(nova_client))])
+        self.images, self.flavors = images, flavors
+        self.flavor_specs = flavor_specs
+        if self.events:
+            self._reconcile(nova_client)
+            return self._event_stats()
+        # copies, the missing flavors are only added for this read
+        flavors, flavor_specs = dict(flavors), dict(flavor_specs)
+        usage = None
+        if config['top_tenants']:
+            usage = topk.Usage(config['top_tenants'],
+                               ['servers', 'vcpus', 'ram'])
+            tenants = usage.counters
+        if config['churn']:
+            self.churn.start()
 
         stats = {
             'instances': {k.lower():0 for k in OpenstackUtils.STATUS},
@@ -117,23 +232,251 @@ class OpenstackUtils:
             'flavors': {k:0 for k in flavors.values()},
             'boot': {'ephemeral': 0, 'volume': 0}
         }
+        # vcpus, ram and disk of the servers of each flavor
+        resources = dict((k, [0, 0, 0]) for k in flavors.values())
 
-        for vm in nova_client.servers.list(search_opts={'all_tenants':1}):
+        for vm in self._list_servers(nova_client):
             status = vm.status.lower()
             stats['instances'][status] = stats['instances'].setdefault(status, 0) + 1
             stats['instances']['total_count'] = \
                 stats['instances'].setdefault('total_count', 0) + 1
-            flavor = flavors[vm.flavor['id']]
+            if vm.flavor_id not in flavors:
+                flavors[vm.flavor_id], flavor_specs[vm.flavor_id] = \
+                    self._missing_flavor(nova_client, vm.flavor_id)
+            flavor = flavors[vm.flavor_id]
             stats['flavors'][flavor] = stats['flavors'].setdefault(flavor, 0) + 1
-            if type(vm.image) is dict and vm.image.has_key('id') and images.has_key(vm.image['id']):
-                image = images[vm.image['id']]
+            specs = flavor_specs[vm.flavor_id]
+            sums = resources.get(flavor)
+            if sums is None:
+                sums = resources[flavor] = [0, 0, 0]
+            sums[0] += specs[0]
+            sums[1] += specs[1]
+            sums[2] += specs[2]
+            if vm.image_id in images:
+                image = images[vm.image_id]
                 stats["images"][image] = stats["images"].setdefault(image, 0) + 1
                 stats['boot']['ephemeral'] += 1
             else:
                 stats['boot']['volume'] += 1
+            # the counters of the tenant updated in place, without a
+            # call of usage.add per server, see topk
+            if usage is not None:
+                counts = tenants.get(vm.tenant_id)
+                if counts is None:
+                    usage.insert(vm.tenant_id, [1, specs[0], specs[1]])
+                else:
+                    counts[0] += 1
+                    counts[1] += specs[0]
+                    counts[2] += specs[1]
+            if config['churn']:
+                self.churn.add(vm.id, vm.status)
+
+        resources['total'] = [sum(sums[i] for sums in resources.values())
+                              for i in range(3)]
+        stats['flavor_resources'] = resources
+        if usage:
+            stats['tenants'] = usage.top()
+        if config['churn']:
+            changes = self.churn.finish()
+            if changes:
+                stats['churn'] = changes
+        return stats
 
+    def _reconcile(self, nova_client):
+        """Reset the counters of the notifications to a listing"""
+        start = time.time()
+        servers = []
+        for vm in self._list_servers(nova_client):
+            if vm.flavor_id not in self.flavors:
+                self._missing_flavor(nova_client, vm.flavor_id)
+            servers.append((vm.id, vm))
+        self.events.reconcile(servers, start)
+
+    def interpret(self, event_type, payload):
+        """Changes of the servers of a notification"""
+        # not the hourly compute.instance.exists audits, sent for the
+        # servers deleted during the hour too
+        if not event_type.startswith('compute.instance.') or \
+                not (event_type.endswith('.end') or
+                     event_type == 'compute.instance.update'):
+            return None
+        vm = SERVER_EVENT(payload)
+        if self.sharding and not (self.part and self.part.owns(vm.id)):
+            return None
+        if event_type == 'compute.instance.delete.end' or \
+                vm.status in DELETED_STATES:
+            return [(notifications.REMOVE, vm.id, None)]
+        if vm.image_id is None and 'image_ref_url' in payload:
+            vm = vm._replace(image_id=notifications.last_segment(
+                payload['image_ref_url']))
+        if vm.status:
+            vm = vm._replace(status=VM_STATES.get(vm.status,
+                                                  vm.status.upper()))
+        return [(notifications.UPDATE, vm.id, vm)]
+
+    def contribution(self, vm):
+        """Counters of a server, see notifications.Tally"""
+        if vm.flavor_id in self.flavors:
+            flavor = self.flavors[vm.flavor_id]
+            specs = self.flavor_specs[vm.flavor_id]
+        else:
+            flavor, specs = self.missing_flavors.get(
+                vm.flavor_id, (vm.flavor_id, (0, 0, 0, {})))
+        counters = [
+            (('instances', (vm.status or 'unknown').lower()), 1),
+            (('instances', 'total_count'), 1),
+            (('flavors', flavor), 1),
+            (('flavor_vcpus', flavor), specs[0]),
+            (('flavor_ram', flavor), specs[1]),
+            (('flavor_disk', flavor), specs[2]),
+        ]
+        if vm.image_id in self.images:
+            counters.append((('images', self.images[vm.image_id]), 1))
+            counters.append((('boot', 'ephemeral'), 1))
+        else:
+            counters.append((('boot', 'volume'), 1))
+        if config['top_tenants']:
+            counters.append((('tenant_servers', vm.tenant_id), 1))
+            counters.append((('tenant_vcpus', vm.tenant_id), specs[0]))
+            counters.append((('tenant_ram', vm.tenant_id), specs[1]))
+        return counters
+
+    def _event_stats(self):
+        """Stats of the counters of the notifications, same as the ones
+        of a listing"""
+        counters = self.events.tally.nested()
+        stats = {
+            'instances': dict((k.lower(), 0) for k in OpenstackUtils.STATUS),
+            'images': dict((k, 0) for k in self.images.values()),
+            'flavors': dict((k, 0) for k in self.flavors.values()),
+            'boot': {'ephemeral': 0, 'volume': 0},
+        }
+        for group in stats:
+            stats[group].update(counters.get(group, {}))
+        resources = dict((k, [0, 0, 0]) for k in self.flavors.values())
+        for i, group in enumerate(('flavor_vcpus', 'flavor_ram',
+                                   'flavor_disk')):
+            for flavor, value in counters.get(group, {}).items():
+                resources.setdefault(flavor, [0, 0, 0])[i] = value
+        resources['total'] = [sum(sums[i] for sums in resources.values())
+                              for i in range(3)]
+        stats['flavor_resources'] = resources
+        if config['top_tenants']:
+            stats['tenants'] = dict(
+                (resource, topk.trim(counters.get('tenant_' + resource, {}),
+                                     config['top_tenants']))
+                for resource in ('servers', 'vcpus', 'ram'))
+        if config['churn']:
+            stats['churn'] = self.events.tally.pop_churn()
         return stats
 
+    def _list_images(self, glance_client):
+        images = {}
+        for image in glance_client.images.list(
+                         filters={'visibility': 'public',
+                                  'properties': config['image_filters'],
+                                  'member_status': 'all'}):
+            images[image.id] = image.name
+        return images
+
+    def _list_flavors(self, nova_client):
+        flavors = {}
+        flavor_specs = {}
+        for flavor in nova_client.flavors.list():
+            flavors[flavor.id] = flavor.name
+            flavor_specs[flavor.id] = flavor_spec(flavor)
+        return flavors, flavor_specs
+
+    def _missing_flavor(self, nova_client, flavor_id):
+        """Name and specs of a flavor missing from the listing.
+
+        The flavors deleted since their servers were booted are fetched
+        by id once, then kept.  When the fetch fails, the id is used as
+        name until the next read.
+        """
+        if flavor_id not in self.missing_flavors:
+            try:
+                flavor = nova_client.flavors.get(flavor_id)
+            except Exception as e:
+                log_warning("Cannot get the flavor %s: %s" % (flavor_id, e))
+                return flavor_id, (0, 0, 0, {})
+            self.missing_flavors[flavor_id] = (flavor.name,
+                                               flavor_spec(flavor))
+        return self.missing_flavors[flavor_id]
+
+    def _list_servers(self, nova_client):
+        """All the servers, or the ones of the part of our shard.
+
+        The servers are SERVER tuples, read directly from the API on
+        the fast path.  The listing is read as it is received.
+        """
+        if self.rest_client:
+            def search(search_opts, path='servers/detail', projection=SERVER):
+                return self.rest_client.listing(path, 'servers', projection,
+                                                params=search_opts)
+
+            def ids(search_opts):
+                return [server.id for server in
+                        search(search_opts, 'servers', SERVER_ID)]
+        else:
+            def page(search_opts):
+                with self.engine.calls('compute'):
+                    return [SERVER.from_resource(vm) for vm in
+                            nova_client.servers.list(search_opts=search_opts)]
+
+            def search(search_opts):
+                if not self.sharding:
+                    return (SERVER.from_resource(vm) for vm in
+                            nova_client.servers.list(search_opts=search_opts))
+                # page by page, the listing of a part stops at the next
+                return sharding.pages(page, search_opts)
+
+            def ids(search_opts):
+                return [vm.id for vm in nova_client.servers.list(
+                    detailed=False, search_opts=search_opts)]
+        if not self.sharding:
+            # the client library lists all the pages in the block, the
+            # fast path throttles its own requests
+            with self.engine.calls('compute'):
+                return search({'all_tenants': 1})
+        with self.engine.calls('compute'):
+            self.part = self.sharding.part(ids({'all_tenants': 1}))
+        search_opts = {'all_tenants': 1}
+        if self.part.marker is not None:
+            search_opts['marker'] = self.part.marker
+        return self.part.take(search(search_opts))
+
+    def dump_state(self, info):
+        return {'info': info, 'images': self.images, 'flavors': self.flavors,
+                'flavor_specs': self.flavor_specs,
+                'missing_flavors': self.missing_flavors,
+                'churn': self.churn.dump()}
+
+    def load_state(self, state):
+        # Reuse the reference data of the warm start snapshot until it
+        # expires from the cache
+        self.cache.put('images', 'public', state['images'])
+        self.cache.put('flavors', 'all',
+                       (state['flavors'], state['flavor_specs']))
+        self.missing_flavors = state['missing_flavors']
+        self.churn.load(state['churn'])
+
+
+# Types dispatched, the statuses and the boot sources are fixed groups
+TYPES = typesdb.Types('nova', [
+    typesdb.Type('instance_states',
+                 [status.lower() for status in OpenstackUtils.STATUS] +
+                 [('total', 'total_count')],
+                 other='other', stats_key='instances', default=0),
+    typesdb.Type('boot_sources', ['ephemeral', 'volume'], stats_key='boot'),
+    typesdb.Type('images'),
+    typesdb.Type('flavors'),
+    typesdb.Type('flavor_resources', ['vcpus', 'ram', 'disk']),
+    typesdb.Type('tenant_servers'),
+    typesdb.Type('tenant_vcpus'),
+    typesdb.Type('tenant_ram'),
+])
+
 
 def log_verbose(msg):
     if not config['verbose_logging']:
@@ -150,43 +493,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, plugin_name, date=None, type_name='',
-                   type_instance='', plugin_instance='',
-                   host=''):
-    """Dispatch a value"""
-    # host "/" plugin ["-" plugin instance] "/" type ["-" type instance]
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + str(plugin_instance) +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_name:
-        val.type = type_name
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    if type(value) == dict:
-        for type_inst in value:
-            val.type_instance = type_inst
-            val.values = [int(value[type_inst])]
-            val.dispatch()
-    elif type(value) == list:
-        val.values = value
-        val.dispatch()
-    else:
-        val.values = [int(value)]
-        val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -203,8 +509,43 @@ def configure_callback(conf):
             config['endpoint_type'] = node.values[0]
         elif node.key == 'Verbose':
             config['verbose_logging'] = node.values[0]
+        elif node.key == 'FastPath':
+            config['fast_path'] = bool(node.values[0])
+        elif node.key == 'Streaming':
+            config['streaming'] = bool(node.values[0])
+        elif node.key == 'Compression':
+            config['compression'] = bool(node.values[0])
+        elif node.key == 'TopTenants':
+            config['top_tenants'] = int(node.values[0])
+        elif node.key == 'Churn':
+            config['churn'] = bool(node.values[0])
         elif node.key == 'ImageFilter':
             config['image_filters'][node.values[0]] = node.values[1]
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
+        elif node.key == 'Worker':
+            config['worker'] = worker.parse_config(node)
+            config['worker_config'] = worker.dump_config(conf)
+        elif node.key == 'Notifications':
+            config['notifications'] = notifications.parse_config(node)
+        elif node.key == 'ReferenceCache':
+            config['reference_cache'] = refcache.parse_config(node)
+        elif node.key == 'WarmStart':
+            config['warm_start'] = warmstart.parse_config(node)
+        elif node.key == 'Sharding':
+            config['sharding'] = sharding.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -233,27 +574,227 @@ def configure_callback(conf):
 
 def init_callback():
     """Initialization block"""
-    config['util'] = OpenstackUtils()
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'worker' in config:
+        # the reads are made by a process of their own
+        config['process'] = worker.worker_from_config(
+            __file__, config['worker_config'], config['worker'], collectd)
+        return
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
+    config['guard'] = resilience.guard_from_config(
+        'compute', config.get('resilience'))
+    config['engine'] = concurrency.engine_from_config(
+        config.get('concurrency'), tenant=config['tenant'],
+        log=log_warning)
+    shard = None
+    if 'sharding' in config:
+        shard = sharding.sharding_from_config(
+            plugin_name, config['sharding'], config.get('schedule'))
+    config['util'] = OpenstackUtils(
+        shard, refcache.cache_from_config(config.get('reference_cache')),
+        engine=config['engine'])
     config['util'].connect(config)
+    if 'notifications' in config:
+        config['util'].events = notifications.consumer_from_config(
+            plugin_name, config['notifications'], config['util'].interpret,
+            config['util'].contribution, ['nova'])
+    if 'warm_start' in config:
+        config['warmstart'] = warmstart.warmstart_from_config(
+            plugin_name, version, config['warm_start'])
+        try:
+            state = config['warmstart'].load()
+        except Exception as e:
+            log_warning("Cannot load the warm start snapshot: %s" % e)
+            state = None
+        if state:
+            log_verbose("Warm start from a snapshot saved %ds ago"
+                        % state['age'])
+            config['util'].load_state(state)
+            config['warm_info'] = state['info']
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Stop the worker process, give the leadership up"""
+    if 'process' in config:
+        config['process'].stop()
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
+    if 'process' in config:
+        values = config['process'].read()
+        if values is None:
+            log_warning("The worker is waiting to restart, skipping this read")
+        for value in values or ():
+            dispatcher.add(*value)
+        dispatcher.add(config['process'].metrics(),
+                       'nova',
+                       'worker',
+                       'instances',
+                       'self',
+                       'openstack')
+        if 'scheduler' in config:
+            dispatcher.add(config['scheduler'].metrics(),
+                           'nova',
+                           'schedule',
+                           '',
+                           'self',
+                           'openstack')
+        dispatcher.flush()
+        return
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     log_verbose("read_callback called")
     if 'util' not in config:
         log_error("Problem during initialization, fix and restart collectd.")
-    info = config['util'].get_stats()
+    if 'warm_info' in config:
+        log_verbose("Dispatching the stats of the warm start snapshot")
+        info = config.pop('warm_info')
+        config['util'].last_stats = int(mktime(datetime.now().timetuple()))
+    else:
+        info = config['guard'].call(config['util'].get_stats)
+        dispatcher.add(config['guard'].metrics(),
+                       'nova',
+                       'circuit_breaker',
+                       config['guard'].name,
+                       'self',
+                       'openstack')
+        limiter = ratelimit.limiter('compute')
+        if limiter is not None:
+            dispatcher.add(limiter.metrics(),
+                           'nova',
+                           'rate_limit',
+                           'compute',
+                           'self',
+                           'openstack')
+        if 'scheduler' in config:
+            dispatcher.add(config['scheduler'].metrics(),
+                           'nova',
+                           'schedule',
+                           '',
+                           'self',
+                           'openstack')
+        if info is None:
+            log_verbose("The circuit of %s is open or a call was throttled, "
+                        "skipping this read"
+                        % config['guard'].name)
+            dispatcher.flush()
+            return
+        if config['util'].sharding:
+            info = config['util'].sharding.exchange(info)
+            if info is None:
+                if config['util'].sharding.missing:
+                    log_warning("Missing partial stats from shards %s"
+                                % config['util'].sharding.missing)
+                # the self metrics of this node, not left for a later read
+                dispatcher.flush()
+                return
+        if 'warmstart' in config:
+            try:
+                config['warmstart'].save(config['util'].dump_state(info))
+            except Exception as e:
+                log_warning("Cannot save the warm start snapshot: %s" % e)
     log_verbose(pformat(info))
-    for type_instance in info:
-        dispatch_value(info[type_instance],
+    for key in info:
+        if key == 'tenants':
+            # the heaviest tenants of each resource, and the other ones
+            for resource, top in info[key].items():
+                dispatcher.add(topk.trim(top, config['top_tenants']),
+                               'nova',
+                               'tenant_' + resource,
+                               '',
+                               '',
+                               'openstack',
+                               date=config['util'].last_stats)
+            continue
+        if key == 'flavor_resources':
+            for flavor, resources in info[key].items():
+                dispatcher.add(resources,
+                               'nova',
+                               'flavor_resources',
+                               flavor,
+                               '',
+                               'openstack',
+                               date=config['util'].last_stats)
+            continue
+        if key == 'churn':
+            dispatcher.add(info[key],
+                           'nova',
+                           'churn',
+                           'instances',
+                           '',
+                           'openstack',
+                           date=config['util'].last_stats)
+            continue
+        type_name, value = TYPES.group(key, info[key])
+        dispatcher.add(value,
                        'nova',
-                       config['util'].last_stats,
-                       type_instance,
-                       type_instance,
+                       type_name,
                        '',
-                       'openstack')
+                       '',
+                       'openstack',
+                       date=config['util'].last_stats)
+
+    if config['util'].rest_client:
+        transfers = config['util'].rest_client.pop_transfers()
+        for listing, transfer in transfers.items():
+            dispatcher.add(transfer,
+                           'nova',
+                           'http_transfer',
+                           listing,
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+    for kind, counters in config['util'].cache.stats().items():
+        dispatcher.add(counters,
+                       'nova',
+                       'reference_cache',
+                       kind,
+                       'self',
+                       'openstack',
+                       date=config['util'].last_stats)
+    if config['util'].events:
+        dispatcher.add(config['util'].events.metrics(),
+                       'nova',
+                       'notifications',
+                       'instances',
+                       'self',
+                       'openstack',
+                       date=config['util'].last_stats)
+        if config['util'].events.drift is not None:
+            dispatcher.add(config['util'].events.drift,
+                           'nova',
+                           'reconciliation_drift',
+                           'instances',
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+    log_verbose("Dispatched %d values" % dispatcher.flush())
     log_verbose("Leaving read_callback")
 
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
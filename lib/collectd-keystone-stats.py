@@ -24,11 +24,21 @@
 # Requirements:  python-keystoneclient, collectd
 if __name__ != "__main__":
     import collectd
-from keystoneclient.v2_0 import client
 from datetime import datetime
 from time import mktime
 from pprint import pformat
-from string import find
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import ratelimit
+from collectd_openstack import resilience
+from collectd_openstack import schedule
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+
+client = clients.lazy('keystoneclient.v2_0.client')
 
 plugin_name = 'collectd-keystone-stats'
 
@@ -38,11 +48,20 @@ config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
 }
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Types dispatched, generated into share/keystone-types.db
+TYPES = typesdb.Types('keystone', [
+    typesdb.Type('accounts', ['count', 'enabled', 'disabled'],
+                 stats_key='users'),
+    typesdb.Type('tenants'),
+])
 
 
 class OpenstackUtils:
-    def __init__(self, keystone_client):
+    def __init__(self, keystone_client, engine=None):
         self.keystone_client = keystone_client
+        self.engine = engine or concurrency.Engine(workers=0)
         self.last_stats = None
         self.connection_done = None
         self.stats = {}
@@ -52,11 +71,13 @@ class OpenstackUtils:
         self.last_stats = int(mktime(datetime.now().timetuple()))
         log_verbose("Authenticating to keystone")
         self.keystone_client.authenticate()
-        users = self.keystone_client.users.list()
+        users, tenants = self.engine.gather([
+            self.engine.submit('identity', self.keystone_client.users.list),
+            self.engine.submit('identity', self.keystone_client.tenants.list)])
         count = len(users)
         enabled = reduce(lambda x, y: x + int(y.enabled), users, 0)
         stats['users'] = [ count, enabled, count - enabled ]
-        stats['tenants'] = [ len(self.keystone_client.tenants.list()) ]
+        stats['tenants'] = [ len(tenants) ]
         return stats
 
 
@@ -75,32 +96,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(key, value, type_name, plugin_name, date=None,
-                   type_instance='', plugin_instance='',
-                   host=''):
-    """Dispatch a value"""
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + plugin_instance +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-    val.type = type_name
-    val.values = value
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -117,6 +112,20 @@ def configure_callback(conf):
             config['endpoint_type'] = node.values[0]
         elif node.key == 'Verbose':
             config['verbose_logging'] = node.values[0]
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -150,6 +159,7 @@ def connect(config):
             tenant_name=config['tenant'],
             password=config['password'],
             auth_url=config['auth_url'],
+            timeout=config['guard'].read_timeout,
         )
         keystone_client.authenticate()
         if not keystone_client.tenants.list():
@@ -162,43 +172,91 @@ def connect(config):
 def init_callback():
     """Initialization block"""
     global config
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
+    config['guard'] = resilience.guard_from_config(
+        'identity', config.get('resilience'))
+    config['engine'] = concurrency.engine_from_config(
+        config.get('concurrency'), tenant=config['tenant'],
+        log=log_warning)
     client = connect(config)
-    config['util'] = OpenstackUtils(client)
+    config['util'] = OpenstackUtils(client, engine=config['engine'])
     log_verbose('Got a valid connection to keystone API')
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
 
 
-def _naming(key, info):
-    global config
-    names = {
-        'plugin_name': '',
-        'plugin_instance': '',
-        'type_name': '',
-        'type_instance': ''
-    }
-    if find(key, 'users') >= 0:
-        names['type_name'] = 'accounts'
-    else:
-        names['type_name'] = 'tenants'
-    return names
+def shutdown_callback():
+    """Give the leadership up for another node to take it at once"""
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
     global config
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     if 'util' not in config:
         log_error("Problem during initialization, fix and restart collectd.")
-    info = config['util'].get_stats()
+    info = config['guard'].call(config['util'].get_stats)
+    dispatcher.add(config['guard'].metrics(),
+                   'keystone',
+                   'circuit_breaker',
+                   config['guard'].name,
+                   'self',
+                   'openstack')
+    limiter = ratelimit.limiter('identity')
+    if limiter is not None:
+        dispatcher.add(limiter.metrics(),
+                       'keystone',
+                       'rate_limit',
+                       'identity',
+                       'self',
+                       'openstack')
+    if 'scheduler' in config:
+        dispatcher.add(config['scheduler'].metrics(),
+                       'keystone',
+                       'schedule',
+                       '',
+                       'self',
+                       'openstack')
+    if info is None:
+        log_verbose("The circuit of %s is open or a call was throttled, "
+                    "skipping this read"
+                    % config['guard'].name)
+        dispatcher.flush()
+        return
     log_verbose(pformat(info))
     for key in info:
-        names = _naming(key, info)
-        dispatch_value(key,
-                       info[key],
-                       names['type_name'],
+        type_name, value = TYPES.group(key, info[key])
+        dispatcher.add(value,
                        'keystone',
-                       config['util'].last_stats,
+                       type_name,
                        '',
                        '',
-                       'openstack')
+                       'openstack',
+                       date=config['util'].last_stats)
+    log_verbose("Dispatched %d values" % dispatcher.flush())
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
@@ -24,11 +24,28 @@
 # Requirments: python-neutronclient, python-keystoneclient, collectd
 if __name__ != "__main__":
     import collectd
-from neutronclient.neutron import client as neutron
+from collections import namedtuple
 from datetime import datetime
 from time import mktime
 from pprint import pformat
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import notifications
+from collectd_openstack import ratelimit
+from collectd_openstack import refcache
+from collectd_openstack import resilience
+from collectd_openstack import schedule
+from collectd_openstack import services
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+from collectd_openstack import warmstart
 import re
+import time
+
+neutron = clients.lazy('neutronclient.neutron.client')
 
 
 plugin_name = 'collectd-neutron-stats'
@@ -36,16 +53,75 @@ version = '0.1.0'
 config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
-    'public_network': 'public'
+    'public_network': 'public',
+    'service_stale_after': 60,
+}
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Types dispatched, generated into share/neutron-types.db
+TYPES = typesdb.Types('neutron', [
+    typesdb.Type('networks'),
+    typesdb.Type('ports'),
+    typesdb.Type('routers'),
+    typesdb.Type('floatingips', ['used', 'total_ips_estimate']),
+    typesdb.Type('lbaas', ['vips', 'pools']),
+    typesdb.Type('snat_external_gateway'),
+])
+
+# Counted resources of the notifications, and their stats
+KINDS = {
+    'network': 'networks',
+    'port': 'ports',
+    'router': 'routers',
+    'floatingip': 'floatingips',
+    'vip': 'vips',
+    'pool': 'pools',
 }
 
+Resource = namedtuple('Resource', ['kind', 'snat'])
+
+
+def has_snat(router):
+    gateway = router.get('external_gateway_info')
+    return bool(gateway and gateway.get('enable_snat'))
+
+
+def interpret(event_type, payload):
+    """Changes of the resources of a notification"""
+    parts = event_type.split('.')
+    if len(parts) != 3 or parts[0] not in KINDS or parts[2] != 'end':
+        return None
+    kind = parts[0]
+    if parts[1] == 'delete':
+        return [(notifications.REMOVE, payload.get(kind + '_id'), None)]
+    record = payload.get(kind) or {}
+    return [(notifications.UPDATE, record.get('id'),
+             Resource(KINDS[kind], has_snat(record) if kind == 'router'
+                      else None))]
+
+
+def contribution(resource):
+    """Counters of a resource, see notifications.Tally"""
+    if resource.snat:
+        return [((resource.kind,), 1), (('snat_external_gateway',), 1)]
+    return [((resource.kind,), 1)]
+
 
 class OpenstackUtils:
-    def __init__(self, neutron_client, public_network=None):
+    def __init__(self, neutron_client, public_network=None, cache=None,
+                 events=None, engine=None):
         self.neutron_client = neutron_client
         self.last_stats = None
         self.connection_done = None
         self.public_network = public_network
+        # (subnet ids, estimate of their IPs) of the public network
+        self.subnets = None
+        self.cache = cache or refcache.RefCache()
+        self.engine = engine or concurrency.Engine(workers=0)
+        # notifications.Consumer in the notification mode, and the stats
+        # of the last listing
+        self.events = events
+        self.stats = {}
 
     def check_connection(self, force=False):
         if not self.connection_done or force:
@@ -57,43 +133,134 @@ class OpenstackUtils:
 
     def get_stats(self):
         global config
+        if self.events and not self.events.due():
+            self.last_stats = int(mktime(datetime.now().timetuple()))
+            self.events.drain()
+            return self._event_stats()
+        start = time.time()
         stats = {}
         self.last_stats = int(mktime(datetime.now().timetuple()))
         kwargs = {'retrieve_all': True, 'fields': 'id'}
-        stats['networks'] = [ len(self.neutron_client.list_networks(**kwargs)['networks']) ]
-        stats['ports'] = [ len(self.neutron_client.list_ports(**kwargs)["ports"]) ]
-        stats['routers'] = [ len(self.neutron_client.list_routers(**kwargs)["routers"]) ]
-        stats['floatingips'] = [ len(self.neutron_client.list_floatingips(**kwargs)['floatingips']) ]
+        neutron_client = self.neutron_client
+        submit = self.engine.submit
+        # the listings do not depend on each other, they are made at once
+        calls = {
+            'networks': submit('network', neutron_client.list_networks,
+                               **kwargs),
+            'ports': submit('network', neutron_client.list_ports, **kwargs),
+            # all the fields, for the SNAT gateways
+            'routers': submit('network', neutron_client.list_routers),
+            'floatingips': submit('network', neutron_client.list_floatingips,
+                                  **kwargs),
+        }
+        extensions = submit('network', self.cache.get, 'extensions', 'all',
+                            lambda: set(e['alias'] for e in
+                                        neutron_client.list_extensions()['extensions']))
+        if self.public_network:
+            # meanwhile, its subnets are listed by the engine too
+            total_ip = self._total_ip()
+        extensions = extensions.result()
+        if 'lbaas' in extensions:
+            calls['vips'] = submit('network', neutron_client.list_vips,
+                                   **kwargs)
+            calls['pools'] = submit('network', neutron_client.list_pools,
+                                    **kwargs)
+        if 'agent' in extensions:
+            calls['agents'] = submit('network', neutron_client.list_agents)
+        names = list(calls)
+        results = dict(zip(names, self.engine.gather([calls[name]
+                                                      for name in names])))
+        listings = {}
+        for kind in ('networks', 'ports', 'routers', 'floatingips', 'vips',
+                     'pools'):
+            if kind in results:
+                listings[kind] = results[kind][kind]
+        stats['networks'] = [ len(listings['networks']) ]
+        stats['ports'] = [ len(listings['ports']) ]
+        stats['routers'] = [ len(listings['routers']) ]
+        stats['floatingips'] = [ len(listings['floatingips']) ]
         if self.public_network:
-            total_ip = self._estimate_total_ip()
             stats['floatingips'].append(total_ip)
-        if any(e['alias'] == 'lbaas' for e in self.neutron_client.list_extensions()['extensions']):
-            stats['lbaas'] = [ len(self.neutron_client.list_vips(**kwargs)["vips"]) ]
-            stats['lbaas'].append(len(self.neutron_client.list_pools(**kwargs)["pools"]))
+        if 'lbaas' in extensions:
+            stats['lbaas'] = [ len(listings['vips']), len(listings['pools']) ]
         snat = 0
-        for router in self.neutron_client.list_routers()['routers']:
+        for router in listings['routers']:
           if router['external_gateway_info'] and router['external_gateway_info']['enable_snat']:
             snat += 1
         stats['snat_external_gateway'] = [ snat ]
+        if 'agent' in extensions:
+            health = services.ServiceHealth(config['service_stale_after'])
+            stats['agents'] = health.summary(map(
+                services.from_agent, results['agents']['agents']))
+
+        self.stats = stats
+        if self.events:
+            self.events.reconcile(
+                ((item['id'], Resource(kind, has_snat(item)
+                                       if kind == 'routers' else None))
+                 for kind, items in listings.items() for item in items),
+                start)
+            return self._event_stats()
+        return stats
 
+    def _event_stats(self):
+        """Stats of the counters of the notifications, the agents and
+        the estimate of the public IPs are the ones of the last listing"""
+        counters = self.events.tally.nested()
+        stats = dict(self.stats)
+        for kind in ('networks', 'ports', 'routers',
+                     'snat_external_gateway'):
+            stats[kind] = [counters.get(kind, 0)]
+        stats['floatingips'] = [counters.get('floatingips', 0)] + \
+            self.stats.get('floatingips', [0])[1:]
+        if 'lbaas' in self.stats:
+            stats['lbaas'] = [counters.get('vips', 0),
+                              counters.get('pools', 0)]
         return stats
 
-    def _estimate_total_ip(self):
-        total_ip = 0
-        subnet_mask = re.compile('[^/]+/(\d{1,2})')
-        subnets_from_public_network = []
+    def dump_state(self, info):
+        return {'info': info, 'subnets': self.subnets}
+
+    def load_state(self, state):
+        # Reuse the subnets estimate of the snapshot until it expires
+        # from the cache
+        if state['subnets'] and self.public_network:
+            self.cache.put('subnets', self.public_network, state['subnets'])
+
+    def _total_ip(self):
+        """Estimate of the public IPs, kept while the subnets are the same"""
         try:
-            subnets_from_public_network = self.neutron_client.list_networks(
-                name=self.public_network)['networks'][0]['subnets']
+            self.subnets = self.cache.get('subnets', self.public_network,
+                                          self._public_subnets,
+                                          revalidate=self._same_subnets)
         except Exception as e:
             log_warning("Cannot get subnets associated with %s network: %s" %
                         (self.public_network, e))
             return None
+        return self.subnets[1]
+
+    def _public_subnet_ids(self):
+        with self.engine.calls('network'):
+            return self.neutron_client.list_networks(
+                name=self.public_network)['networks'][0]['subnets']
+
+    def _public_subnets(self):
+        subnet_ids = self._public_subnet_ids()
+        return subnet_ids, self._estimate_total_ip(subnet_ids)
+
+    def _same_subnets(self, subnets):
+        return sorted(self._public_subnet_ids()) == sorted(subnets[0])
 
-        for public_subnet_id in subnets_from_public_network:
-            net_info = self.neutron_client.list_subnets(
-                id=public_subnet_id,
-                fields=['cidr', 'gateway_ip'])['subnets'][0]
+    def _estimate_total_ip(self, subnets_from_public_network):
+        total_ip = 0
+        subnet_mask = re.compile('[^/]+/(\d{1,2})')
+
+        subnets = self.engine.map(
+            'network', lambda subnet_id: self.neutron_client.list_subnets(
+                id=subnet_id, fields=['cidr', 'gateway_ip'])['subnets'][0],
+            subnets_from_public_network)
+        for public_subnet_id, net_info in zip(subnets_from_public_network,
+                                              subnets):
             subnet_match = subnet_mask.match(net_info['cidr'])
             if not subnet_match:
                 log_warning("Cannot retrieve the subnet mask of subnet_id %s" %
@@ -123,32 +290,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, type_name, plugin_name, date=None,
-                   type_instance=None, plugin_instance=None,
-                   host=None):
-    """Dispatch a value"""
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + plugin_instance +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-    val.type = type_name
-    val.values = value
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -167,6 +308,28 @@ def configure_callback(conf):
             config['verbose_logging'] = bool(node.values[0])
         elif node.key == 'PublicNetwork':
             config['public_network'] = node.values[0]
+        elif node.key == 'ServiceStaleAfter':
+            config['service_stale_after'] = float(node.values[0])
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
+        elif node.key == 'Notifications':
+            config['notifications'] = notifications.parse_config(node)
+        elif node.key == 'ReferenceCache':
+            config['reference_cache'] = refcache.parse_config(node)
+        elif node.key == 'WarmStart':
+            config['warm_start'] = warmstart.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -197,13 +360,30 @@ def configure_callback(conf):
 def connect(config):
     # Neutron-client tries to re-authenticate if it gets an unauthorized error
     # https://github.com/openstack/python-neutronclient/blob/752423483304572f00dacfcffce35a268fa3e5d4/neutronclient/client.py#L180
+    # the breaker, the engine, the cache and the notifications outlive
+    # the reconnections
+    if 'guard' not in config:
+        config['guard'] = resilience.guard_from_config(
+            'network', config.get('resilience'))
+        config['engine'] = concurrency.engine_from_config(
+            config.get('concurrency'), tenant=config['tenant'],
+            log=log_warning)
     neutron_client = neutron.Client('2.0',
                                     username=config['username'],
                                     tenant_name=config['tenant'],
                                     password=config['password'],
                                     auth_url=config['auth_url'],
-                                    endpoint_type=config['endpoint_type'])
-    conf = {'neutron_client': neutron_client}
+                                    endpoint_type=config['endpoint_type'],
+                                    timeout=config['guard'].read_timeout)
+    if 'cache' not in config:
+        config['cache'] = refcache.cache_from_config(
+            config.get('reference_cache'))
+    if 'notifications' in config and 'events' not in config:
+        config['events'] = notifications.consumer_from_config(
+            plugin_name, config['notifications'], interpret, contribution,
+            ['neutron'])
+    conf = {'neutron_client': neutron_client, 'cache': config['cache'],
+            'events': config.get('events'), 'engine': config['engine']}
     if config['public_network'] and config['public_network'] != 'none':
         conf['public_network'] = config['public_network']
     config['util'] = OpenstackUtils(**conf)
@@ -213,27 +393,144 @@ def connect(config):
 def init_callback():
     """Initialization block"""
     global config
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
     connect(config)
     log_verbose('Got a valid connection to neutron API')
+    if 'warm_start' in config:
+        config['warmstart'] = warmstart.warmstart_from_config(
+            plugin_name, version, config['warm_start'])
+        try:
+            state = config['warmstart'].load()
+        except Exception as e:
+            log_warning("Cannot load the warm start snapshot: %s" % e)
+            state = None
+        if state:
+            log_verbose("Warm start from a snapshot saved %ds ago"
+                        % state['age'])
+            config['util'].load_state(state)
+            config['warm_info'] = state['info']
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Give the leadership up for another node to take it at once"""
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
     global config
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     if 'util' not in config:
         log_warning("Connection has not been done. Retrying")
         connect(config)
 
     try:
-        info = config['util'].get_stats()
+        if 'warm_info' in config:
+            log_verbose("Dispatching the stats of the warm start snapshot")
+            info = config.pop('warm_info')
+            config['util'].last_stats = int(mktime(datetime.now().timetuple()))
+        else:
+            info = config['guard'].call(config['util'].get_stats)
+            dispatcher.add(config['guard'].metrics(),
+                           'neutron',
+                           'circuit_breaker',
+                           config['guard'].name,
+                           'self',
+                           'openstack')
+            limiter = ratelimit.limiter('network')
+            if limiter is not None:
+                dispatcher.add(limiter.metrics(),
+                               'neutron',
+                               'rate_limit',
+                               'network',
+                               'self',
+                               'openstack')
+            if 'scheduler' in config:
+                dispatcher.add(config['scheduler'].metrics(),
+                               'neutron',
+                               'schedule',
+                               '',
+                               'self',
+                               'openstack')
+            if info is None:
+                log_verbose("The circuit of %s is open or a call was "
+                            "throttled, skipping this read"
+                            % config['guard'].name)
+                dispatcher.flush()
+                return
+            if 'warmstart' in config:
+                try:
+                    config['warmstart'].save(config['util'].dump_state(info))
+                except Exception as e:
+                    log_warning("Cannot save the warm start snapshot: %s" % e)
         log_verbose(pformat(info))
         for key, value in info.items():
-            dispatch_value(value,
-                           key,
+            if key == 'agents':
+                for binary, health in value.items():
+                    dispatcher.add(health,
+                                   'neutron',
+                                   'service_health',
+                                   binary,
+                                   '',
+                                   'openstack',
+                                   date=config['util'].last_stats)
+                continue
+            type_name, value = TYPES.group(key, value)
+            dispatcher.add(value,
                            'neutron',
-                           config['util'].last_stats,
+                           type_name,
                            '',
                            '',
-                           'openstack')
+                           'openstack',
+                           date=config['util'].last_stats)
+        for kind, counters in config['util'].cache.stats().items():
+            dispatcher.add(counters,
+                           'neutron',
+                           'reference_cache',
+                           kind,
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+        if config['util'].events:
+            dispatcher.add(config['util'].events.metrics(),
+                           'neutron',
+                           'notifications',
+                           'resources',
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+            if config['util'].events.drift is not None:
+                dispatcher.add(config['util'].events.drift,
+                               'neutron',
+                               'reconciliation_drift',
+                               'resources',
+                               'self',
+                               'openstack',
+                               date=config['util'].last_stats)
+        log_verbose("Dispatched %d values" % dispatcher.flush())
     except Exception as e:
         log_warning(
             "Problem while reading, trying to authenticate (%s)" % e)
@@ -242,4 +539,4 @@ def read_callback(data=None):
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
@@ -24,10 +24,20 @@
 # Requirments: python-novaclient, collectd
 if __name__ != "__main__":
     import collectd
-from novaclient.client import Client
 from datetime import datetime
 from time import mktime
 from pprint import pformat
+from collectd_openstack import clients
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import ratelimit
+from collectd_openstack import resilience
+from collectd_openstack import schedule
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+
+nova = clients.lazy('novaclient.client')
 
 
 class OpenstackUtils:
@@ -39,7 +49,8 @@ class OpenstackUtils:
         self.last_stats = int(mktime(datetime.now().timetuple()))
         log_verbose("Authenticating to keystone")
         self.nova_client.authenticate()
-        data = self.nova_client.hypervisors.statistics()._info
+        with ratelimit.calls('compute', config['tenant']):
+            data = self.nova_client.hypervisors.statistics()._info
         vcpu_multiplier = 1
         memory_multiplier = 1
         if 'overcommit' in config:
@@ -69,6 +80,18 @@ config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
 }
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Types dispatched, shared with collectd-nova-stats
+TYPES = typesdb.Types('nova', [
+    typesdb.Type('servers', ['count', 'load']),
+    typesdb.Type('disk', ['local', 'local_used', 'free',
+                          'disk_available_least']),
+    typesdb.Type('instances'),
+    typesdb.Type('memory_usage', ['total', 'real', 'used', 'used_real',
+                                  'free', 'free_real'], stats_key='memory'),
+    typesdb.Type('vcpu_usage', ['total', 'real', 'used'], stats_key='vcpus'),
+])
 
 
 def log_verbose(msg):
@@ -86,42 +109,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, plugin_name, date=None, type_name='',
-                   type_instance='', plugin_instance='',
-                   host=''):
-    """Dispatch a value"""
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + plugin_instance +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_name:
-        val.type = type_name
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    if type(value) == dict:
-        for type_inst in value:
-            val.type_instance = type_inst
-            val.values = [int(value[type_inst])]
-            val.dispatch()
-    elif type(value) == list:
-        val.values = value
-        val.dispatch()
-    else:
-        val.values = int(value)
-        val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -154,6 +141,18 @@ def configure_callback(conf):
                 if required_param not in config['overcommit']:
                     log_error('%s not defined for Overcommit'
                               % (required_param))
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -181,12 +180,13 @@ def configure_callback(conf):
 
 
 def connect(config):
-    nova_client = Client('1.1',
-                         username=config['username'],
-                         project_id=config['tenant'],
-                         api_key=config['password'],
-                         auth_url=config['auth_url'],
-                         endpoint_type=config['endpoint_type'])
+    nova_client = nova.Client('1.1',
+                              username=config['username'],
+                              project_id=config['tenant'],
+                              api_key=config['password'],
+                              auth_url=config['auth_url'],
+                              endpoint_type=config['endpoint_type'],
+                              timeout=config['guard'].read_timeout)
     try:
         nova_client.authenticate()
     except Exception as e:
@@ -197,29 +197,91 @@ def connect(config):
 def init_callback():
     """Initialization block"""
     global config
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
+    config['guard'] = resilience.guard_from_config(
+        'compute', config.get('resilience'))
     nova_client = connect(config)
     log_verbose('Got a valid connection to nova API')
     config['util'] = OpenstackUtils(nova_client)
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Give the leadership up for another node to take it at once"""
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
     global config
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     if 'util' not in config:
         log_error("Problem during initialization, fix and restart collectd.")
-    info = config['util'].get_stats()
+    info = config['guard'].call(config['util'].get_stats)
+    dispatcher.add(config['guard'].metrics(),
+                   'hypervisors',
+                   'circuit_breaker',
+                   config['guard'].name,
+                   'self',
+                   'openstack')
+    limiter = ratelimit.limiter('compute')
+    if limiter is not None:
+        dispatcher.add(limiter.metrics(),
+                       'hypervisors',
+                       'rate_limit',
+                       'compute',
+                       'self',
+                       'openstack')
+    if 'scheduler' in config:
+        dispatcher.add(config['scheduler'].metrics(),
+                       'hypervisors',
+                       'schedule',
+                       '',
+                       'self',
+                       'openstack')
+    if info is None:
+        log_verbose("The circuit of %s is open or a call was throttled, "
+                    "skipping this read"
+                    % config['guard'].name)
+        dispatcher.flush()
+        return
     log_verbose(pformat(info))
     for key in info:
-        dispatch_value(info[key],
+        type_name, value = TYPES.group(key, info[key])
+        dispatcher.add(value,
                        'hypervisors',
-                       config['util'].last_stats,
-                       key,
+                       type_name,
                        '',
                        '',
-                       'openstack')
+                       'openstack',
+                       date=config['util'].last_stats)
+    log_verbose("Dispatched %d values" % dispatcher.flush())
 
 
 plugin_name = 'collectd-nova-hypervisor-stats'
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
@@ -25,11 +25,26 @@
 if __name__ != "__main__":
     import collectd
 
-from novaclient.client import Client
 from datetime import datetime
 from time import mktime
 from pprint import pformat
-from novaclient import exceptions
+from collectd_openstack import clients
+from collectd_openstack import concurrency
+from collectd_openstack import coordination
+from collectd_openstack import dispatch
+from collectd_openstack import exposition
+from collectd_openstack import ratelimit
+from collectd_openstack import refcache
+from collectd_openstack import resilience
+from collectd_openstack import rest
+from collectd_openstack import services
+from collectd_openstack import warmstart
+from collectd_openstack import schedule
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+
+nova = clients.lazy('novaclient.client')
+exceptions = clients.lazy('novaclient.exceptions')
 
 
 plugin_name = 'collectd-nova-stats'
@@ -37,22 +52,50 @@ version = '0.1.0'
 config = {
     'endpoint_type': "internalURL",
     'verbose_logging': False,
+    'fast_path': False,
+    'streaming': False,
+    'compression': False,
+    'service_stale_after': 60,
 }
-
-NOVA_SERVICES = (
-    "nova-cert",
-    "nova-compute",
-    "nova-conductor",
-    "nova-consoleauth",
-    "nova-scheduler"
-)
+dispatcher = dispatch.Dispatcher(collectd)
+
+# Types dispatched, the hypervisor ones are shared with
+# collectd-nova-hypervisor-stats
+TYPES = typesdb.Types('nova', [
+    typesdb.Type('servers', ['count', 'load']),
+    typesdb.Type('disk', ['local', 'local_used', 'free',
+                          'disk_available_least']),
+    typesdb.Type('instances'),
+    typesdb.Type('memory_usage', ['total', 'real', 'used', 'used_real',
+                                  'free', 'free_real'], stats_key='memory'),
+    typesdb.Type('vcpu_usage', ['total', 'real', 'used'], stats_key='vcpus'),
+])
+
+# Fields of the hypervisors used by get_stats
+HYPERVISOR = rest.Projection('Hypervisor', [
+    ('service_host', 'service.host'),
+    ('running_vms', 'running_vms'),
+    ('local_gb', 'local_gb'),
+    ('local_gb_used', 'local_gb_used'),
+    ('free_disk_gb', 'free_disk_gb'),
+    ('disk_available_least', 'disk_available_least'),
+    ('memory_mb', 'memory_mb'),
+    ('memory_mb_used', 'memory_mb_used'),
+    ('free_ram_mb', 'free_ram_mb'),
+    ('vcpus', 'vcpus'),
+    ('vcpus_used', 'vcpus_used'),
+    ('current_workload', 'current_workload'),
+])
 
 
 class OpenstackUtils:
-    def __init__(self, nova_client):
+    def __init__(self, nova_client, cache=None, engine=None):
         self.nova_client = nova_client
+        self.cache = cache or refcache.RefCache()
+        self.engine = engine or concurrency.Engine(workers=0)
         self.last_stats = None
         self.hypervisors = None
+        self.rest_client = None
 
     def get_stats(self):
         aggregates = {}
@@ -60,7 +103,24 @@ class OpenstackUtils:
         self.last_stats = int(mktime(datetime.now().timetuple()))
         log_verbose("Authenticating to keystone")
         self.nova_client.authenticate()
-        hosts_by_aggregate = self._hosts_by_aggregate()
+        if self.rest_client:
+            self.rest_client.close()
+        if config['fast_path']:
+            self.rest_client = rest.RestClient(
+                self.nova_client.client.management_url,
+                self.nova_client.client.auth_token,
+                timeout=config['guard'].timeout,
+                stream=config['streaming'],
+                compress=config['compression'],
+                service='compute', tenant=config['tenant'])
+        # the hypervisors and the services are listed meanwhile
+        hypervisors = self.engine.submit('compute', self._list_hypervisors)
+        nova_services = self.engine.submit('compute',
+                                           self.nova_client.services.list)
+        aggregates_hosts = self.cache.get('aggregates', 'all',
+                                          self._list_aggregates)
+        self.hypervisors = hypervisors.result()
+        hosts_by_aggregate = self._hosts_by_aggregate(aggregates_hosts)
         for aggregate, hosts in hosts_by_aggregate.items():
             vcpu_multiplier = 1
             memory_multiplier = 1
@@ -114,24 +174,20 @@ class OpenstackUtils:
                     aggregates[aggregate]['servers'][1] // \
                     aggregates[aggregate]['servers'][0]
 
-        services = []
-        fetched_services = self.nova_client.services.list()
-        for service in NOVA_SERVICES:
-            instances = filter(lambda s: s.binary == service, fetched_services)
-            services.append(len(instances))
-            services.append(len(filter(lambda s: s.state == "up", instances)))
-            services.append(len(filter(lambda s: s.status == "enabled", instances)))
+        health = services.ServiceHealth(config['service_stale_after'])
+        nova_services = health.summary(
+            map(services.from_resource, nova_services.result()))
 
         return { 'aggregates' : aggregates,
-                 'nova-services' : services }
+                 'nova-services' : nova_services }
 
-    def _hosts_by_aggregate(self):
+    def _hosts_by_aggregate(self, aggregates):
         hba = {}
-        for aggregate in self.nova_client.aggregates.list():
-            hba[aggregate.name] = []
-            for hypervisor in aggregate.hosts:
+        for name, hosts in aggregates:
+            hba[name] = []
+            for hypervisor in hosts:
                 try:
-                    hba[aggregate.name].append(self._search_hypervisor_by_name(hypervisor))
+                    hba[name].append(self._search_hypervisor_by_name(hypervisor))
                 except exceptions.NotFound as e:
                     log_warning("Cannot find %s hypervisor: %s" %
                                 (hypervisor, e))
@@ -139,18 +195,35 @@ class OpenstackUtils:
                     log_error("Problem retrieving hypervisor: %s" % e)
         return hba
 
+    def _list_aggregates(self):
+        with self.engine.calls('compute'):
+            aggregates = self.nova_client.aggregates.list()
+        return [(aggregate.name, list(aggregate.hosts))
+                for aggregate in aggregates]
+
+    def _list_hypervisors(self):
+        """The hypervisors by host, listed once to minimize the calls"""
+        if self.rest_client:
+            hypervisors = self.rest_client.listing(
+                'os-hypervisors/detail', 'hypervisors', HYPERVISOR)
+        else:
+            hypervisors = [HYPERVISOR.from_resource(hypervisor) for
+                           hypervisor in self.nova_client.hypervisors.list()]
+        return dict((hypervisor.service_host, hypervisor)
+                    for hypervisor in hypervisors)
+
     def _search_hypervisor_by_name(self, name):
-        """ Replace search to minimize the number of calls. """
-        if not self.hypervisors:
-            self.hypervisors = {}
-            hypervisors = self.nova_client.hypervisors.list()
-            for hypervisor in hypervisors:
-                self.hypervisors[hypervisor.service['host']] = hypervisor
         if name in self.hypervisors:
             return self.hypervisors[name]
         else:
             raise(exceptions.NotFound("'%s' is not on hypervisors list" % name))
 
+    def dump_state(self, info):
+        return {'info': info}
+
+    def load_state(self, state):
+        pass
+
 
 def log_verbose(msg):
     if not config['verbose_logging']:
@@ -167,42 +240,6 @@ def log_error(msg):
     raise(Exception(error))
 
 
-def dispatch_value(value, plugin_name, date=None, type_name='',
-                   type_instance='', plugin_instance='',
-                   host=''):
-    """Dispatch a value"""
-
-    log_verbose('Sending value: %s=%s' %
-                (host + '.' + plugin_name + '-' + plugin_instance +
-                 '.' + type_name + '-' + type_instance, value))
-
-    val = collectd.Values()
-    val.plugin = plugin_name
-
-    if plugin_instance:
-        val.plugin_instance = plugin_instance
-    if type_name:
-        val.type = type_name
-    if type_instance:
-        val.type_instance = type_instance
-    if host:
-        val.host = host
-    if date:
-        val.time = date
-
-    if type(value) == dict:
-        for type_inst in value:
-            val.type_instance = type_inst
-            val.values = [int(value[type_inst])]
-            val.dispatch()
-    elif type(value) == list:
-        val.values = value
-        val.dispatch()
-    else:
-        val.values = [int(value)]
-        val.dispatch()
-
-
 def configure_callback(conf):
     """Receive configuration block"""
     global config
@@ -239,6 +276,32 @@ def configure_callback(conf):
             config['endpoint_type'] = node.values[0]
         elif node.key == 'Verbose':
             config['verbose_logging'] = node.values[0]
+        elif node.key == 'FastPath':
+            config['fast_path'] = bool(node.values[0])
+        elif node.key == 'Streaming':
+            config['streaming'] = bool(node.values[0])
+        elif node.key == 'Compression':
+            config['compression'] = bool(node.values[0])
+        elif node.key == 'ServiceStaleAfter':
+            config['service_stale_after'] = float(node.values[0])
+        elif node.key == 'Coordination':
+            config['coordination'] = coordination.parse_config(node)
+        elif node.key == 'Resilience':
+            config['resilience'] = resilience.parse_config(node)
+        elif node.key == 'Concurrency':
+            config['concurrency'] = concurrency.parse_config(node)
+        elif node.key == 'Snapshot':
+            config['snapshot'] = shm.parse_config(node)
+        elif node.key == 'Schedule':
+            config['schedule'] = schedule.parse_config(node)
+        elif node.key == 'RateLimit':
+            config['rate_limit'] = ratelimit.parse_config(node)
+        elif node.key == 'Exposition':
+            config['exposition'] = exposition.parse_config(node)
+        elif node.key == 'ReferenceCache':
+            config['reference_cache'] = refcache.parse_config(node)
+        elif node.key == 'WarmStart':
+            config['warm_start'] = warmstart.parse_config(node)
         else:
             collectd.warning('%s plugin: Unknown config key: %s.'
                              % (plugin_name, node.key))
@@ -266,12 +329,13 @@ def configure_callback(conf):
 
 
 def connect(config):
-    nova_client = Client('1.1',
-                         username=config['username'],
-                         project_id=config['tenant'],
-                         api_key=config['password'],
-                         auth_url=config['auth_url'],
-                         endpoint_type=config['endpoint_type'])
+    nova_client = nova.Client('1.1',
+                              username=config['username'],
+                              project_id=config['tenant'],
+                              api_key=config['password'],
+                              auth_url=config['auth_url'],
+                              endpoint_type=config['endpoint_type'],
+                              timeout=config['guard'].read_timeout)
     try:
         nova_client.authenticate()
     except Exception as e:
@@ -281,35 +345,146 @@ def connect(config):
 
 def init_callback():
     """Initialization block"""
+    if 'schedule' in config:
+        # registered with the tick, the schedule tells when to read
+        config['scheduler'] = schedule.schedule_from_config(
+            plugin_name, config['schedule'])
+        collectd.register_read(
+            config['scheduler'].wrap(read_callback, dispatcher),
+            config['scheduler'].tick)
+    else:
+        collectd.register_read(read_callback)
+    if 'exposition' in config:
+        # the scrapes are served the values of the last read
+        dispatcher.exposition = exposition.source_from_config(
+            plugin_name, config['exposition'], TYPES)
+    if 'snapshot' in config:
+        dispatcher.snapshot = shm.writer_from_config(plugin_name,
+                                                     config['snapshot'])
+    if 'rate_limit' in config:
+        ratelimit.limiters_from_config(config['rate_limit'])
+    config['guard'] = resilience.guard_from_config(
+        'compute', config.get('resilience'))
+    config['engine'] = concurrency.engine_from_config(
+        config.get('concurrency'), tenant=config['tenant'],
+        log=log_warning)
     nova_client = connect(config)
     log_verbose('Got a valid connection to nova API')
-    config['util'] = OpenstackUtils(nova_client)
+    config['util'] = OpenstackUtils(
+        nova_client, refcache.cache_from_config(config.get('reference_cache')),
+        engine=config['engine'])
+    if 'warm_start' in config:
+        config['warmstart'] = warmstart.warmstart_from_config(
+            plugin_name, version, config['warm_start'])
+        try:
+            state = config['warmstart'].load()
+        except Exception as e:
+            log_warning("Cannot load the warm start snapshot: %s" % e)
+            state = None
+        if state:
+            log_verbose("Warm start from a snapshot saved %ds ago"
+                        % state['age'])
+            config['util'].load_state(state)
+            config['warm_info'] = state['info']
+    if 'coordination' in config:
+        config['elector'] = coordination.elector_from_config(
+            plugin_name, config['coordination'], log=log_warning,
+            schedule=config.get('schedule'))
+
+
+def shutdown_callback():
+    """Give the leadership up for another node to take it at once"""
+    if 'elector' in config:
+        config['elector'].release()
 
 
 def read_callback(data=None):
+    if 'elector' in config and not config['elector'].is_leader():
+        log_verbose("Not the leader, skipping this read")
+        return
     if 'util' not in config:
         log_error("Problem during initialization, fix and restart collectd.")
-    info = config['util'].get_stats()
+    if 'warm_info' in config:
+        log_verbose("Dispatching the stats of the warm start snapshot")
+        info = config.pop('warm_info')
+        config['util'].last_stats = int(mktime(datetime.now().timetuple()))
+    else:
+        info = config['guard'].call(config['util'].get_stats)
+        dispatcher.add(config['guard'].metrics(),
+                       'nova',
+                       'circuit_breaker',
+                       config['guard'].name,
+                       'self',
+                       'openstack')
+        limiter = ratelimit.limiter('compute')
+        if limiter is not None:
+            dispatcher.add(limiter.metrics(),
+                           'nova',
+                           'rate_limit',
+                           'compute',
+                           'self',
+                           'openstack')
+        if 'scheduler' in config:
+            dispatcher.add(config['scheduler'].metrics(),
+                           'nova',
+                           'schedule',
+                           '',
+                           'self',
+                           'openstack')
+        if info is None:
+            log_verbose("The circuit of %s is open or a call was throttled, "
+                        "skipping this read"
+                        % config['guard'].name)
+            dispatcher.flush()
+            return
+        if 'warmstart' in config:
+            try:
+                config['warmstart'].save(config['util'].dump_state(info))
+            except Exception as e:
+                log_warning("Cannot save the warm start snapshot: %s" % e)
     log_verbose(pformat(info))
     for aggregate in info['aggregates']:
         for key in info['aggregates'][aggregate]:
-            dispatch_value(info['aggregates'][aggregate][key],
+            type_name, value = TYPES.group(key,
+                                           info['aggregates'][aggregate][key])
+            dispatcher.add(value,
                            'hypervisors',
-                           config['util'].last_stats,
-                           key,
+                           type_name,
                            '',
                            aggregate,
-                           'openstack')
-
-    dispatch_value(info['nova-services'],
-                   'nova',
-                    config['util'].last_stats,
-                    'nova-services',
-                    '',
-                    '',
-                    'openstack')
+                           'openstack',
+                           date=config['util'].last_stats)
+
+    for binary, health in info['nova-services'].items():
+        dispatcher.add(health,
+                       'nova',
+                       'service_health',
+                       binary,
+                       '',
+                       'openstack',
+                       date=config['util'].last_stats)
+
+    if config['util'].rest_client:
+        transfers = config['util'].rest_client.pop_transfers()
+        for listing, transfer in transfers.items():
+            dispatcher.add(transfer,
+                           'nova',
+                           'http_transfer',
+                           listing,
+                           'self',
+                           'openstack',
+                           date=config['util'].last_stats)
+    for kind, counters in config['util'].cache.stats().items():
+        dispatcher.add(counters,
+                       'nova',
+                       'reference_cache',
+                       kind,
+                       'self',
+                       'openstack',
+                       date=config['util'].last_stats)
+    log_verbose("Dispatched %d values" % dispatcher.flush())
 
 
 collectd.register_config(configure_callback)
 collectd.register_init(init_callback)
-collectd.register_read(read_callback)
+collectd.register_shutdown(shutdown_callback)
@@ -0,0 +1,26 @@
+# -*- encoding: utf-8 -*-
+#
+# Shared helpers for the openstack collectd plugins
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Code shared by the collectd-*-stats.py plugins.
+
+The plugins are loaded by the collectd python plugin from the same
+ModulePath as this package, so they can simply import it.  Nothing in
+here imports the collectd module: logging and dispatching stay in the
+plugins.
+"""
@@ -0,0 +1,354 @@
+# -*- encoding: utf-8 -*-
+#
+# Record and replay of the HTTP exchanges of the plugins
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Cassettes of the HTTP exchanges of the plugins.
+
+Profiling a slow read needs a cloud, and its answers differ from one
+run to the next.  A `Recorder` writes the exchanges of the plugins with
+the APIs to a cassette file, a `Player` answers the requests with the
+recorded answers, without any network: the reads of a cassette can be
+profiled again and again, before and after a change.
+
+The exchanges are caught where the plugins make them: the `send` of the
+HTTPAdapter of requests, used by the python-*client libraries, and
+`rest.RestClient.request`, the fast path.
+
+A cassette is a file of JSON lines, one per exchange: the method, the
+URL, the status, the headers, the time the answer took and the body,
+zlib compressed.  The tokens and passwords are redacted from the
+headers and bodies, the bodies of the requests are not recorded.
+
+The answers to a request are replayed in the order they were recorded,
+then again from the first one.  They are answered at once, or after the
+time they took when recorded with `latency`.  With `multiply`, each
+record of the listings of resources is replayed `multiply` times, with
+different ids, to look like a bigger cloud.
+"""
+import base64
+import io
+import json
+import threading
+import time
+import zlib
+
+try:
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+except ImportError:
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from collectd_openstack import rest
+
+FORMAT = 1
+REDACTED = 'REDACTED'
+
+SECRET_HEADERS = ('x-auth-token', 'x-subject-token', 'authorization',
+                  'cookie', 'set-cookie')
+SECRET_KEYS = ('password', 'adminPass', 'secret', 'access_token')
+# decoded by the client libraries before they are recorded
+DROPPED_HEADERS = ('content-encoding', 'content-length',
+                   'transfer-encoding')
+# the listings multiplied: the tenants, users and services listed by
+# the plugins are not, their ids are requested again
+RESOURCES = ('servers', 'volumes', 'snapshots', 'images', 'stacks',
+             'networks', 'subnets', 'ports', 'routers', 'floatingips',
+             'vips', 'pools')
+
+
+class CassetteError(Exception):
+    pass
+
+
+def normalize(method, url):
+    """Key of a request, the same for the same query in any order"""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return "%s %s" % (method.upper(), urlunsplit(
+        (parts.scheme, parts.netloc, parts.path, query, '')))
+
+
+def redact_headers(headers):
+    return [[name, name.lower() in SECRET_HEADERS and REDACTED or value]
+            for name, value in headers]
+
+
+def redact(document):
+    """Remove the tokens and passwords of a JSON document"""
+    if isinstance(document, dict):
+        for key, value in document.items():
+            if key in SECRET_KEYS:
+                document[key] = REDACTED
+            elif key == 'token' and isinstance(value, dict) and 'id' in value:
+                value['id'] = REDACTED
+                redact(value)
+            else:
+                redact(value)
+    elif isinstance(document, list):
+        for item in document:
+            redact(item)
+    return document
+
+
+def redact_body(body):
+    try:
+        document = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return body
+    return json.dumps(redact(document)).encode('utf-8')
+
+
+def multiply(body, factor):
+    """The body of a listing of resources with each record `factor`
+    times"""
+    try:
+        document = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return body
+    if not isinstance(document, dict):
+        return body
+    for key, records in document.items():
+        if key not in RESOURCES or not isinstance(records, list) or \
+                not all(isinstance(record, dict) and 'id' in record
+                        for record in records):
+            continue
+        copies = list(records)
+        for copy in range(1, factor):
+            copies.extend(dict(record, id="%s-%d" % (record['id'], copy))
+                          for record in records)
+        document[key] = copies
+    return json.dumps(document).encode('utf-8')
+
+
+class Recorder:
+    """Writer of the exchanges to the cassette `path`"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+        self.count = 0
+        self._write({'format': FORMAT, 'recorded': time.time()})
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def record(self, method, url, status, reason, headers, body, elapsed,
+               encoding=''):
+        """Record an exchange, `body` being encoded with `encoding`"""
+        if encoding:
+            # decoded like the fast path does, raw deflate included
+            body = rest.Body(Response(status, reason,
+                                      [('Content-Encoding', encoding)],
+                                      body)).read()
+        entry = {
+            'method': method,
+            'url': url,
+            'status': status,
+            'reason': reason,
+            'headers': redact_headers(headers),
+            'elapsed': elapsed,
+            'encoding': encoding,
+            'body': base64.b64encode(
+                zlib.compress(redact_body(body))).decode('ascii'),
+        }
+        with self.lock:
+            self._write(entry)
+            self.count += 1
+
+    def send(self, send, adapter, request, **kwargs):
+        """HTTPAdapter.send recording its exchange"""
+        start = time.time()
+        response = send(adapter, request, **kwargs)
+        body = response.content
+        self.record(request.method, request.url, response.status_code,
+                    response.reason, [(name, value) for name, value in
+                                      response.headers.items()
+                                      if name.lower() not in DROPPED_HEADERS],
+                    body, time.time() - start)
+        return response
+
+    def request(self, request, client, path):
+        """RestClient.request recording its exchange"""
+        url = "%s://%s%s" % (client.scheme, client.netloc, path)
+        start = time.time()
+        try:
+            body = request(client, path)
+        except rest.RestError as e:
+            self.record('GET', url, e.status, e.reason, [], b'',
+                        time.time() - start)
+            raise
+        # the body as received, replayed through the same decoding
+        data = body.response.read()
+        headers = body.response.getheaders()
+        self.record('GET', url, body.response.status, body.response.reason,
+                    [(name, value) for name, value in headers
+                     if name.lower() not in DROPPED_HEADERS],
+                    data, time.time() - start, body.encoding)
+        body.response = Response(body.response.status, body.response.reason,
+                                 headers, data)
+        return body
+
+    def close(self):
+        self.file.close()
+
+
+class Response:
+    """Recorded response, like the ones of httplib"""
+
+    def __init__(self, status, reason, headers, data):
+        self.status = status
+        self.reason = reason
+        self.headers = dict((name.lower(), value) for name, value in headers)
+        self.stream = io.BytesIO(data)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+    def read(self, size=None):
+        if size is None:
+            return self.stream.read()
+        return self.stream.read(size)
+
+
+class Replayed:
+    """Connection of a replayed response, for the pool of the RestClient"""
+
+    def close(self):
+        pass
+
+
+class Player:
+    """Answers to the requests from the cassette `path`"""
+
+    def __init__(self, path, latency=False, multiply=1, sleep=time.sleep):
+        self.path = path
+        self.latency = latency
+        self.multiply = multiply
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        # key -> [entries, next one]
+        self.exchanges = {}
+        with open(path) as f:
+            header = json.loads(f.readline())
+            if header.get('format') != FORMAT:
+                raise CassetteError("%s is not a cassette of format %d" %
+                                    (path, FORMAT))
+            for line in f:
+                entry = json.loads(line)
+                key = normalize(entry['method'], entry['url'])
+                self.exchanges.setdefault(key, [[], 0])[0].append(entry)
+        self.count = 0
+
+    def answer(self, method, url):
+        """The next recorded answer to a request, its body decoded"""
+        key = normalize(method, url)
+        with self.lock:
+            if key not in self.exchanges:
+                raise CassetteError("No answer to %s in %s" % (key, self.path))
+            exchange = self.exchanges[key]
+            entries, index = exchange
+            exchange[1] = (index + 1) % len(entries)
+            entry = entries[index]
+            if 'data' not in entry:
+                data = zlib.decompress(base64.b64decode(entry['body']))
+                if self.multiply > 1:
+                    data = multiply(data, self.multiply)
+                entry['data'] = data
+            self.count += 1
+        if self.latency:
+            self.sleep(entry['elapsed'])
+        return entry
+
+    def send(self, send, adapter, request, **kwargs):
+        """HTTPAdapter.send answering from the cassette"""
+        import requests
+        entry = self.answer(request.method, request.url)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(
+            entry['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = entry['data']
+        response._content_consumed = True
+        response.raw = io.BytesIO(entry['data'])
+        response.url = request.url
+        response.request = request
+        response.connection = adapter
+        return response
+
+    def request(self, request, client, path):
+        """RestClient.request answering from the cassette"""
+        entry = self.answer('GET', "%s://%s%s" % (client.scheme,
+                                                  client.netloc, path))
+        if entry['status'] >= 400:
+            raise rest.RestError(entry['status'], entry['reason'], path)
+        data = entry['data']
+        headers = list(entry['headers'])
+        if entry.get('encoding'):
+            # replayed through the same decoding as recorded
+            if 'encoded' not in entry:
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                entry['encoded'] = compressor.compress(data) + \
+                    compressor.flush()
+            data = entry['encoded']
+            headers.append(['Content-Encoding', 'gzip'])
+        return rest.Body(Response(entry['status'], entry['reason'], headers,
+                                  data), Replayed())
+
+    def close(self):
+        pass
+
+
+_installed = []
+
+
+def install(cassette):
+    """Route the HTTP exchanges of the plugins through a Recorder or a
+    Player"""
+    uninstall()
+    request = rest.RestClient.__dict__['request']
+
+    def patched_request(client, path):
+        return cassette.request(request, client, path)
+    rest.RestClient.request = patched_request
+    _installed.append((rest.RestClient, 'request', request))
+    try:
+        from requests import adapters
+    except ImportError:
+        return cassette
+    send = adapters.HTTPAdapter.__dict__['send']
+
+    def patched_send(adapter, request, **kwargs):
+        return cassette.send(send, adapter, request, **kwargs)
+    adapters.HTTPAdapter.send = patched_send
+    _installed.append((adapters.HTTPAdapter, 'send', send))
+    return cassette
+
+
+def uninstall():
+    while _installed:
+        owner, name, function = _installed.pop()
+        setattr(owner, name, function)
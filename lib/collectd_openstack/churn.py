@@ -0,0 +1,165 @@
+# -*- encoding: utf-8 -*-
+#
+# Resources created, deleted and changed between two reads
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Churn of the resources between two reads.
+
+`Churn` keeps the ids and statuses of the resources seen at the last
+read as one bytes string of 17-byte records: the 16 bytes of the UUID
+and the code of the status, about 3.4 MB for 200000 resources instead
+of the strings and tuples of the listing.  Ids that are not UUIDs are
+hashed to 16 bytes.
+
+At the end of a read the records of both reads are compared in the
+order of the listings, which is stable from one read to the next: runs
+of identical records are skipped block by block, a record with the same
+id and another status is a changed resource, and a record whose id is
+not found in the rest of the other read is a created or deleted one.
+A handful of resources change between two reads, so this takes a few
+milliseconds for 200000 resources.  When the listings differ too much,
+past `MAX_STEPS` differences, the rest of them is differenced as sets
+of records, a few hundred milliseconds for 200000 resources.
+"""
+import binascii
+import hashlib
+
+from collectd_openstack import typesdb
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('churn', ['created', 'deleted', 'changed']),
+])
+
+RECORD_SIZE = 17
+ID_SIZE = 16
+# Records compared at once when skipping the unchanged ones
+BLOCK = 256 * RECORD_SIZE
+MAX_STEPS = 64
+
+
+def pack(resource_id):
+    """16 bytes of a resource id"""
+    if len(resource_id) == 36:
+        try:
+            return binascii.unhexlify(resource_id.replace('-', ''))
+        except (TypeError, ValueError):
+            pass
+    return hashlib.md5(resource_id.encode('utf-8')).digest()
+
+
+class Churn:
+    """Resources created, deleted and changed of status between reads"""
+
+    def __init__(self):
+        self.records = None
+        self.current = None
+        self.codes = {}
+
+    def start(self):
+        """Start recording the resources of a read"""
+        self.current = bytearray()
+
+    def add(self, resource_id, status):
+        code = self.codes.get(status)
+        if code is None:
+            # past 255 statuses they share the last code
+            code = self.codes[status] = min(len(self.codes), 255)
+        self.current += pack(resource_id)
+        self.current.append(code)
+
+    def finish(self):
+        """[created, deleted, changed] since the last read, None at first"""
+        records, self.records = self.records, bytes(self.current)
+        self.current = None
+        if records is None:
+            return None
+        return difference(records, self.records)
+
+    def dump(self):
+        return {'records': self.records, 'codes': self.codes}
+
+    def load(self, state):
+        self.records = state['records']
+        self.codes = state['codes']
+
+
+def find(records, resource_id, start):
+    """Whether the id is in a record of `records` from `start`"""
+    position = records.find(resource_id, start)
+    while position != -1 and position % RECORD_SIZE:
+        position = records.find(resource_id, position + 1)
+    return position != -1
+
+
+def common(old, i, new, j):
+    """Size of the identical records of old from i and new from j"""
+    end = min(len(old) - i, len(new) - j)
+    size = 0
+    while size + BLOCK <= end and \
+            old[i + size:i + size + BLOCK] == new[j + size:j + size + BLOCK]:
+        size += BLOCK
+    while size < end and old[i + size:i + size + RECORD_SIZE] == \
+            new[j + size:j + size + RECORD_SIZE]:
+        size += RECORD_SIZE
+    return size
+
+
+def difference(old, new):
+    """[created, deleted, changed] from the records old to the records new"""
+    created = deleted = changed = 0
+    i = j = 0
+    for _ in range(MAX_STEPS):
+        size = common(old, i, new, j)
+        i += size
+        j += size
+        if i >= len(old) or j >= len(new):
+            created += (len(new) - j) // RECORD_SIZE
+            deleted += (len(old) - i) // RECORD_SIZE
+            return [created, deleted, changed]
+        old_id = old[i:i + ID_SIZE]
+        new_id = new[j:j + ID_SIZE]
+        if old_id == new_id:
+            changed += 1
+            i += RECORD_SIZE
+            j += RECORD_SIZE
+        elif not find(old, new_id, i + RECORD_SIZE):
+            created += 1
+            j += RECORD_SIZE
+        elif not find(new, old_id, j + RECORD_SIZE):
+            deleted += 1
+            i += RECORD_SIZE
+        else:
+            # reordered listing
+            break
+    rest = difference_sets(old[i:], new[j:])
+    return [created + rest[0], deleted + rest[1], changed + rest[2]]
+
+
+def split(records):
+    """Set of the records of a bytes string"""
+    return set(records[i:i + RECORD_SIZE]
+               for i in range(0, len(records), RECORD_SIZE))
+
+
+def difference_sets(old, new):
+    """Same as difference, for records in any order"""
+    old = split(old)
+    new = split(new)
+    added = set(record[:ID_SIZE] for record in new - old)
+    removed = set(record[:ID_SIZE] for record in old - new)
+    changed = len(added & removed)
+    return [len(added) - changed, len(removed) - changed, changed]
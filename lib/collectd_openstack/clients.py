@@ -0,0 +1,80 @@
+# -*- encoding: utf-8 -*-
+#
+# Deferred import of the OpenStack client libraries
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Lazy imports of the python-*client libraries.
+
+The client libraries pull hundreds of modules.  The plugins get a proxy
+from `lazy()` at load time and the real module is only imported when
+one of its attributes is first used, usually when connecting.  Proxies
+are shared: all the plugins of the collectd process asking for the same
+module get the same proxy, and the module is imported once.
+"""
+import importlib
+import threading
+import time
+
+_proxies = {}
+_lock = threading.Lock()
+
+# Seconds spent importing each module, filled at first use
+import_times = {}
+
+
+class LazyModule(object):
+    """Proxy of a module imported at the first attribute access"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with _lock:
+                module = self.__dict__['_module']
+                if module is None:
+                    start = time.time()
+                    module = importlib.import_module(self._name)
+                    import_times[self._name] = time.time() - start
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = self._module is None and "not loaded" or "loaded"
+        return "<lazy module %s (%s)>" % (self._name, state)
+
+
+def lazy(name):
+    """Return the shared proxy of the module `name`"""
+    with _lock:
+        if name not in _proxies:
+            _proxies[name] = LazyModule(name)
+        return _proxies[name]
+
+
+def load_all():
+    """Import all the modules requested so far"""
+    for proxy in list(_proxies.values()):
+        proxy._load()
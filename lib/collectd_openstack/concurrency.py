@@ -0,0 +1,291 @@
+# -*- encoding: utf-8 -*-
+#
+# Concurrent API calls of the reads
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Concurrent API calls.
+
+The calls of a read were made one after the other: the read of
+collectd-neutron-stats waited for the networks, then for the ports,
+the routers, ... each call costing a round trip and the time the API
+takes to answer, when most of them do not depend on each other.
+
+`Engine` runs the calls submitted by the reads on a pool of threads
+shared by the plugins of the collectd process, a read then costs about
+its longest call.  At most `limit` calls of an endpoint (compute,
+network, ...) run at once, so that a read does not flood an API: the
+other ones wait in the queue of their endpoint without holding a
+thread, and the endpoints with waiting calls are served in turn, like
+the tasks of an event loop.
+
+The collectd embedded interpreter is often python 2, without asyncio,
+and the client libraries block on their sockets, so the calls run on
+threads.  A call submitted from a thread of the engine runs at once in
+that thread: a call waiting for calls queued behind it would never end.
+With no workers, the calls run at once in the thread submitting them,
+as before.
+
+The requests a call sends with the client libraries wait for their
+turn under the rate limit of its endpoint, when one is configured, see
+`ratelimit.calls`.  The plugins get a `Scope` of the engine, which
+throttles them with the limits of their tenant too; `calls` does the
+same for the calls made outside the engine.
+"""
+import collections
+import threading
+import time
+
+from collectd_openstack import ratelimit
+
+
+class Call:
+    """A call submitted to the engine, and its result once done"""
+
+    def __init__(self, endpoint, function, args, kwargs, tenant=None):
+        self.endpoint = endpoint
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.tenant = tenant
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.elapsed = None
+
+    def run(self):
+        start = time.time()
+        try:
+            with ratelimit.calls(self.endpoint, self.tenant):
+                self.value = self.function(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        self.elapsed = time.time() - start
+        self.done.set()
+
+    def result(self, timeout=None):
+        """Value of the call, its exception is raised"""
+        if not self.done.wait(timeout):
+            raise RuntimeError("Call of %s still running after %ss" %
+                               (self.endpoint, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Engine:
+    """Pool of `workers` threads running at most `limit` calls of each
+    endpoint at once, `limits` overriding it for some endpoints"""
+
+    def __init__(self, workers=8, limit=4, limits=None):
+        self.workers = workers
+        self.limit = limit
+        self.limits = dict(limits or {})
+        self.condition = threading.Condition()
+        # endpoint -> calls waiting, endpoints in their turn to be served
+        self.waiting = {}
+        self.turns = collections.deque()
+        self.queued = 0
+        self.running = {}
+        self.threads = []
+        self.idle = 0
+        self.submitted = 0
+        self.stopping = False
+        self.local = threading.local()
+
+    def limit_of(self, endpoint):
+        return self.limits.get(endpoint, self.limit)
+
+    def submit(self, endpoint, function, *args, **kwargs):
+        """Queue function(*args, **kwargs) on the queue of `endpoint`,
+        return its Call"""
+        return self.submit_call(Call(endpoint, function, args, kwargs))
+
+    def submit_call(self, call):
+        """Queue a Call, return it"""
+        endpoint = call.endpoint
+        if not self.workers or getattr(self.local, 'worker', False):
+            with self.condition:
+                self.submitted += 1
+            call.run()
+            return call
+        with self.condition:
+            self.submitted += 1
+            if endpoint not in self.waiting:
+                self.waiting[endpoint] = collections.deque()
+                self.turns.append(endpoint)
+            self.waiting[endpoint].append(call)
+            self.queued += 1
+            if self.queued > self.idle and len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='collectd-openstack-engine')
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+        return call
+
+    def gather(self, calls, timeout=None):
+        """Values of the calls, in order.  All the calls are waited for,
+        then the exception of the first failed one is raised."""
+        for call in calls:
+            call.done.wait(timeout)
+        return [call.result(0) for call in calls]
+
+    def map(self, endpoint, function, items):
+        """[function(item) for item in items], called concurrently"""
+        return self.gather([self.submit(endpoint, function, item)
+                            for item in items])
+
+    def calls(self, endpoint):
+        """Block of calls of `endpoint` made outside the engine"""
+        return ratelimit.calls(endpoint)
+
+    def _next(self):
+        """The first call of the next endpoint under its limit, or None"""
+        for _ in range(len(self.turns)):
+            endpoint = self.turns[0]
+            self.turns.rotate(-1)
+            if self.running.get(endpoint, 0) < self.limit_of(endpoint):
+                queue = self.waiting[endpoint]
+                call = queue.popleft()
+                self.queued -= 1
+                if not queue:
+                    del self.waiting[endpoint]
+                    self.turns.remove(endpoint)
+                return call
+        return None
+
+    def _work(self):
+        self.local.worker = True
+        while True:
+            with self.condition:
+                call = self._next()
+                while call is None:
+                    if self.stopping:
+                        return
+                    self.idle += 1
+                    self.condition.wait()
+                    self.idle -= 1
+                    call = self._next()
+                self.running[call.endpoint] = \
+                    self.running.get(call.endpoint, 0) + 1
+            call.run()
+            with self.condition:
+                self.running[call.endpoint] -= 1
+                # the endpoint may have calls waiting for this one
+                self.condition.notify_all()
+
+    def grow(self, workers):
+        """Run up to `workers` threads, the threads being started when
+        calls wait"""
+        with self.condition:
+            self.workers = max(self.workers, workers)
+
+    def metrics(self):
+        """[calls since the start, calls waiting, calls running]"""
+        with self.condition:
+            return [self.submitted, self.queued, sum(self.running.values())]
+
+    def stop(self):
+        """Stop the threads once the waiting calls are done"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class Scope:
+    """The engine seen by the calls of a tenant"""
+
+    def __init__(self, engine, tenant):
+        self.engine = engine
+        self.tenant = tenant
+
+    def submit(self, endpoint, function, *args, **kwargs):
+        return self.engine.submit_call(Call(endpoint, function, args, kwargs,
+                                            tenant=self.tenant))
+
+    def gather(self, calls, timeout=None):
+        return self.engine.gather(calls, timeout)
+
+    def map(self, endpoint, function, items):
+        return self.gather([self.submit(endpoint, function, item)
+                            for item in items])
+
+    def calls(self, endpoint):
+        return ratelimit.calls(endpoint, self.tenant)
+
+    def metrics(self):
+        return self.engine.metrics()
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def engine(name='default', **args):
+    """The engine shared by the plugins, created with `args` at the
+    first call"""
+    with _engines_lock:
+        if name not in _engines:
+            _engines[name] = Engine(**args)
+        return _engines[name]
+
+
+def parse_config(node):
+    """Parse a <Concurrency> configuration block"""
+    conf = {
+        'workers': 8,
+        'limit': 4,
+        'limits': {},
+    }
+    for child in node.children:
+        if child.key == 'Workers':
+            conf['workers'] = int(child.values[0])
+        elif child.key == 'Limit':
+            conf['limit'] = int(child.values[0])
+        elif child.key == 'EndpointLimit':
+            if len(child.values) != 2:
+                raise ValueError("Concurrency EndpointLimit takes an "
+                                 "endpoint and a number of calls")
+            conf['limits'][child.values[0]] = int(child.values[1])
+        else:
+            raise ValueError("Unknown Concurrency key: %s" % child.key)
+    if conf['limit'] < 1 or min(conf['limits'].values() or [1]) < 1:
+        raise ValueError("Concurrency limits must be at least 1")
+    return conf
+
+
+def engine_from_config(conf=None, tenant=None, log=None):
+    """The engine shared by the plugins, as seen by the calls of `tenant`.
+    Without a <Concurrency> block or with Workers 0, the calls of the
+    plugin are made one after the other.  The shared engine runs the
+    most workers asked by a plugin, with the limits of the first plugin
+    initialized: the other limits are reported to `log`."""
+    if conf is None or not conf['workers']:
+        return Scope(Engine(workers=0), tenant)
+    shared = engine(workers=conf['workers'], limit=conf['limit'],
+                    limits=conf['limits'])
+    shared.grow(conf['workers'])
+    if log and (conf['limit'], conf['limits']) != (shared.limit,
+                                                   shared.limits):
+        log("Concurrency limits already set to %d, %s by another plugin, "
+            "ignoring %d, %s" % (shared.limit, shared.limits,
+                                 conf['limit'], conf['limits']))
+    return Scope(shared, tenant)
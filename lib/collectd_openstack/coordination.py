@@ -0,0 +1,248 @@
+# -*- encoding: utf-8 -*-
+#
+# Leader election between collector nodes
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Lease based leader election.
+
+Every node running a collector tries to take or renew a lease named
+after the collector at each read, and from a timer every third of
+`lease_time` in between.  Only the holder of a valid lease polls the
+APIs.  When the leader stops renewing, the lease expires after
+`lease_time` seconds and another node takes it over, within the lease
+time: shorter than the interval of the reads, no read is missed.
+
+Lease expiry is computed with the wall clock of each node, so the
+clocks of the collector nodes must be kept in sync (ntp).
+"""
+import fcntl
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+class FileBackend:
+    """Leases stored in one file per collector, protected by flock.
+
+    `path` is a directory, usually on storage shared by the collector
+    nodes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _lease_file(self, name):
+        return os.path.join(self.path, "%s.lease" % name)
+
+    def acquire(self, name, member, ttl):
+        now = time.time()
+        fd = os.open(self._lease_file(name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.read(fd, 4096)
+            lease = json.loads(raw.decode('utf-8')) if raw else {}
+            if (lease.get('holder') not in (None, member)
+                    and lease.get('expires', 0) > now):
+                return False
+            data = json.dumps({'holder': member, 'expires': now + ttl})
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data.encode('utf-8'))
+            return True
+        finally:
+            os.close(fd)
+
+    def release(self, name, member):
+        fd = os.open(self._lease_file(name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.read(fd, 4096)
+            lease = json.loads(raw.decode('utf-8')) if raw else {}
+            if lease.get('holder') == member:
+                os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+
+class SQLiteBackend:
+    """Leases stored in a SQLite database."""
+
+    def __init__(self, path):
+        self.path = path
+        connection = self._connect()
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS leases ("
+                               "name TEXT PRIMARY KEY, "
+                               "holder TEXT, "
+                               "expires REAL)")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # isolation_level None: transactions are handled by hand so
+        # that the read and the write of the lease are atomic.
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def acquire(self, name, member, ttl):
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT holder, expires FROM leases WHERE name = ?",
+                (name,)).fetchone()
+            if row and row[0] not in (None, member) and row[1] > now:
+                connection.execute("ROLLBACK")
+                return False
+            connection.execute(
+                "INSERT OR REPLACE INTO leases (name, holder, expires) "
+                "VALUES (?, ?, ?)", (name, member, now + ttl))
+            connection.execute("COMMIT")
+            return True
+        finally:
+            connection.close()
+
+    def release(self, name, member):
+        connection = self._connect()
+        try:
+            connection.execute("DELETE FROM leases WHERE name = ? "
+                               "AND holder = ?", (name, member))
+        finally:
+            connection.close()
+
+
+BACKENDS = {
+    'file': FileBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+class LeaderElector:
+    """Tell whether this node holds the lease of a collector.
+
+    Backend failures do not stop the collection: the node then behaves
+    as if it was the leader, which at worst means some duplicated API
+    calls.  `log` is called with a message on failures and on
+    leadership changes.
+    """
+
+    def __init__(self, backend, name, member=None, lease_time=5,
+                 log=None):
+        self.backend = backend
+        self.name = name
+        self.member = member or "%s:%d" % (socket.getfqdn(), os.getpid())
+        self.lease_time = lease_time
+        self.log = log
+        self.leader = False
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def renew(self):
+        """Take or renew the lease, whether this node holds it"""
+        with self.lock:
+            leader = self.backend.acquire(self.name, self.member,
+                                          self.lease_time)
+            if leader != self.leader and self.log:
+                self.log("%s %s leadership of %s" %
+                         (self.member, leader and "took" or "lost",
+                          self.name))
+            self.leader = leader
+            return leader
+
+    def is_leader(self):
+        try:
+            return self.renew()
+        except Exception as e:
+            if self.log:
+                self.log("Coordination backend failed, polling anyway: %s"
+                         % e)
+            return True
+
+    def start(self):
+        """Renew the lease every third of the lease time, between the
+        reads"""
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopping.wait(self.lease_time / 3.0):
+            try:
+                self.renew()
+            except Exception:
+                # logged by the next read
+                pass
+
+    def release(self):
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            if self.leader:
+                self.backend.release(self.name, self.member)
+                self.leader = False
+
+
+def parse_config(node):
+    """Parse a <Coordination> configuration block"""
+    conf = {
+        'backend': 'file',
+        'path': None,
+        'lease_time': 5,
+        'member_id': None,
+    }
+    for child in node.children:
+        if child.key == 'Backend':
+            conf['backend'] = child.values[0]
+        elif child.key == 'Path':
+            conf['path'] = child.values[0]
+        elif child.key == 'LeaseTime':
+            conf['lease_time'] = float(child.values[0])
+        elif child.key == 'MemberId':
+            conf['member_id'] = child.values[0]
+        else:
+            raise ValueError("Unknown Coordination key: %s" % child.key)
+    if conf['backend'] not in BACKENDS:
+        raise ValueError("Unknown Coordination backend: %s, must be one of %s"
+                         % (conf['backend'], ', '.join(sorted(BACKENDS))))
+    if not conf['path']:
+        raise ValueError("Coordination Path not defined")
+    return conf
+
+
+def elector_from_config(name, conf, log=None, schedule=None):
+    """Started elector of the collector `name`.  A lease time that does
+    not let another node take over within the shortest interval of its
+    `schedule` configuration is a ValueError."""
+    if schedule:
+        interval = schedule['min_interval'] or schedule['interval']
+        if conf['lease_time'] >= interval:
+            raise ValueError("Coordination LeaseTime must be shorter than "
+                             "the interval of the Schedule, %s seconds"
+                             % interval)
+    backend = BACKENDS[conf['backend']](conf['path'])
+    return LeaderElector(backend, name,
+                         member=conf['member_id'],
+                         lease_time=conf['lease_time'],
+                         log=log).start()
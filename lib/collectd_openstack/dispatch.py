@@ -0,0 +1,183 @@
+# -*- encoding: utf-8 -*-
+#
+# Batched dispatch of the values to collectd
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Dispatch of the stats snapshots.
+
+The plugins dispatch the same metrics at every read.  `Dispatcher` keeps
+one collectd Values per (plugin, plugin instance, type, host), with
+these fields set once, and only updates the type instance, the values
+and the time before dispatching it again: collectd copies the values at
+dispatch, so the object can be reused.
+
+A read queues its values with `add` and dispatches them all in one loop
+with `flush`.  With a `snapshot` writer, see `shm.SnapshotWriter`, the
+flushed values are also written to its memory mapped snapshot, and
+with an `exposition` source, see `exposition.Source`, they replace the
+values it serves to the scrapes.
+
+Once `track` is called, `flush` also counts the values that changed
+since the previous flush, the self metrics apart, and the bytes of the
+`http_transfer` records, the measures of the adaptive schedules.
+
+The `interval` set with `set_interval`, the one of a schedule reading
+less often than collectd calls the plugin, is the interval of the
+dispatched values, so that collectd and its writers do not take the
+values missing between two reads for gaps.
+"""
+
+
+def _items(values):
+    """Iterator over the items of a dict, without a copy on python 2"""
+    return getattr(values, 'iteritems', values.items)()
+
+
+class Dispatcher:
+    """Dispatch values through Values objects reused across reads"""
+
+    def __init__(self, collectd):
+        self.collectd = collectd
+        self.plans = {}
+        self.pending = []
+        self.snapshot = None
+        self.exposition = None
+        # of the values, the one of the read callback when None
+        self.interval = None
+        # (id of the Values, type instance) -> values of the previous flush
+        self.previous = None
+        self.changes = [0, 0, 0]
+
+    def _plan(self, identity):
+        plugin, plugin_instance, type_name, host = identity
+        val = self.collectd.Values()
+        val.plugin = plugin
+        if self.interval:
+            val.interval = self.interval
+        if plugin_instance:
+            val.plugin_instance = plugin_instance
+        if type_name:
+            val.type = type_name
+        if host:
+            val.host = host
+        self.plans[identity] = val
+        return val
+
+    def add(self, value, plugin, type_name='', type_instance='',
+            plugin_instance='', host='', date=None):
+        """Queue a value.
+
+        A dict value gives one value per key, the key being the type
+        instance.  A list is dispatched as the values of a multi-value
+        type, anything else as a single value.
+        """
+        identity = (plugin, plugin_instance, type_name, host)
+        val = self.plans.get(identity) or self._plan(identity)
+        if isinstance(value, dict):
+            self.pending.append((val, None, value, date))
+        elif isinstance(value, (list, tuple)):
+            self.pending.append((val, type_instance, list(value), date))
+        else:
+            self.pending.append((val, type_instance, [int(value)], date))
+
+    def set_interval(self, interval):
+        """Dispatch the values with `interval`, in seconds"""
+        self.interval = interval
+        for val in self.plans.values():
+            val.interval = interval
+
+    def track(self):
+        """Count the changes of the values from now on, see pop_changes"""
+        if self.previous is None:
+            self.previous = {}
+
+    def pop_changes(self):
+        """[changed values, compared values, bytes transferred] since the
+        last call"""
+        changes, self.changes = self.changes, [0, 0, 0]
+        return changes
+
+    def _compare(self, pending):
+        previous = self.previous
+        changes = self.changes
+        # nothing to compare with at the first flush
+        first = not previous
+        for val, type_instance, values, date in pending:
+            if val.plugin_instance == 'self':
+                if val.type == 'http_transfer':
+                    changes[2] += values[0]
+                continue
+            if type_instance is None:
+                items = values.items()
+            else:
+                items = [(type_instance, tuple(values))]
+            for type_instance, value in items:
+                key = (id(val), type_instance)
+                if previous.get(key) != value:
+                    changes[0] += not first
+                    previous[key] = value
+                changes[1] += not first
+
+    def flush(self):
+        """Dispatch the queued values, return how many were dispatched"""
+        pending, self.pending = self.pending, []
+        if self.snapshot is not None or self.exposition is not None:
+            records = self.records(pending)
+            if self.snapshot is not None:
+                self.snapshot.write(records)
+            if self.exposition is not None:
+                self.exposition.update(records)
+        if self.previous is not None:
+            self._compare(pending)
+        count = 0
+        for val, type_instance, values, date in pending:
+            # a time of 0 lets collectd use the time of the dispatch
+            val.time = date or 0
+            dispatch = val.dispatch
+            if type_instance is None:
+                # one list for all the values, collectd reads it at
+                # dispatch
+                current = [0]
+                val.values = current
+                for type_instance, value in _items(values):
+                    val.type_instance = type_instance
+                    current[0] = int(value)
+                    dispatch()
+                count += len(values)
+            else:
+                val.type_instance = type_instance
+                val.values = values
+                dispatch()
+                count += 1
+        return count
+
+    def records(self, pending):
+        """(values, plugin, type, type instance, plugin instance, host,
+        time) of the queued values"""
+        records = []
+        for val, type_instance, values, date in pending:
+            plugin, plugin_instance, type_name, host = (
+                val.plugin, val.plugin_instance, val.type, val.host)
+            if type_instance is None:
+                for type_instance, value in values.items():
+                    records.append(([int(value)], plugin, type_name,
+                                    type_instance, plugin_instance, host,
+                                    date))
+            else:
+                records.append((values, plugin, type_name, type_instance,
+                                plugin_instance, host, date))
+        return records
@@ -0,0 +1,376 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenMetrics exposition of the last values of the plugins
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Prometheus scrapes of the values of the last reads.
+
+A second exporter listing the clouds for Prometheus doubles the cost of
+the APIs.  With an <Exposition> block, the plugin hands the values of
+each read, as flushed by its `Dispatcher`, to a `Source` of an
+`Exposition`: an HTTP server shared by the plugins of the process,
+answering the scrapes with the last values of all its sources in the
+OpenMetrics text format.
+
+A scrape never calls the APIs, nor waits for a read: the text is
+rendered when a read hands its values over, then served as is, gzip
+compressed when the scraper accepts it, until the next read.  The
+server answers on 127.0.0.1 unless another `Address` is configured:
+the scrapes are not authenticated.
+
+The metrics are named after the plugin, the type and the data source,
+`openstack_nova_instance_states_active` for example, with the host, the
+plugin instance and the type instance as labels.  The DERIVE and
+COUNTER data sources are counters, the others gauges.  The time of the
+last read of each source is exposed as
+`openstack_exposition_updated_seconds`.
+
+    python -m collectd_openstack.exposition --port 9190 SNAPSHOT_FILE...
+
+serves the snapshots of other processes instead, see `shm`.
+"""
+import argparse
+import glob
+import gzip
+import io
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PREFIX = 'openstack'
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 9190
+
+INVALID = re.compile(r'[^A-Za-z0-9_]')
+COUNTERS = ('DERIVE', 'COUNTER')
+
+
+def metric_name(*parts):
+    return INVALID.sub('_', '_'.join([PREFIX] + [p for p in parts if p]))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def number(value):
+    if value != value:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Source:
+    """The values of the last read of the plugin `name`"""
+
+    # whether the values change only when read by a scrape
+    polled = False
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.records = []
+        self.generation = 0
+        self.updated = 0
+        self.exposition = None
+
+    def update(self, records):
+        """Replace the values with records, see `Dispatcher.records`, and
+        render the text of the exposition again"""
+        with self.lock:
+            self.records = records
+            self.generation += 1
+            self.updated = time.time()
+        if self.exposition is not None:
+            self.exposition.refresh()
+
+    def current(self):
+        """(generation, time, records) of the last values"""
+        with self.lock:
+            return self.generation, self.updated, self.records
+
+
+class SnapshotSource(Source):
+    """The values of the last snapshot of the file `path`"""
+
+    polled = True
+
+    def __init__(self, name, path):
+        Source.__init__(self, name)
+        self.path = path
+        self.reader = None
+
+    def current(self):
+        with self.lock:
+            try:
+                if self.reader is None:
+                    self.reader = shm.SnapshotReader(self.path)
+                if self.reader.changed():
+                    self.records = self.reader.read()
+                    self.generation += 1
+                    self.updated = self.reader.updated
+            except (EnvironmentError, ValueError, RuntimeError):
+                # not written yet, or being replaced: the last values
+                if self.reader is not None:
+                    self.reader.close()
+                    self.reader = None
+            return self.generation, self.updated, self.records
+
+
+class Exposition:
+    """The last values of the sources, as OpenMetrics text"""
+
+    def __init__(self, types=()):
+        self.lock = threading.Lock()
+        self.sources = {}
+        self.types = {}
+        for group in types:
+            self.add_types(group)
+        self.key = None
+        self.rendered = b'', b''
+        self.renders = 0
+
+    def add_types(self, types):
+        """Name the data sources of a `typesdb.Types`"""
+        for type_ in types:
+            self.types[type_.name] = type_
+
+    def add(self, source):
+        with self.lock:
+            self.sources[source.name] = source
+            source.exposition = self
+        return source
+
+    def source(self, name):
+        """The source of the plugin `name`, created at the first call"""
+        with self.lock:
+            if name not in self.sources:
+                self.sources[name] = Source(name)
+                self.sources[name].exposition = self
+            return self.sources[name]
+
+    def _shared_types(self):
+        # the shared modules dispatching types of their own
+        for name, module in list(sys.modules.items()):
+            if name.startswith('collectd_openstack.') and \
+                    isinstance(getattr(module, 'TYPES', None), typesdb.Types):
+                for type_ in module.TYPES:
+                    self.types.setdefault(type_.name, type_)
+
+    def _families(self, sources):
+        """{metric name: (type, {labels: value})} of the values of the
+        sources"""
+        families = {}
+        updated = families[metric_name('exposition', 'updated', 'seconds')] \
+            = ('gauge', {})
+        for name, date, records in sources:
+            updated[1]['{collector="%s"}' % escape(name)] = date
+            for values, plugin, type_name, type_instance, plugin_instance, \
+                    host, _ in records:
+                type_ = self.types.get(type_name)
+                if type_ is not None and len(type_.ds_names) == len(values):
+                    # the single value of a type is named after it
+                    ds_names = type_.ds_names != ['value'] and \
+                        type_.ds_names or ['']
+                    kind = type_.ds_type in COUNTERS and 'counter' or 'gauge'
+                elif len(values) == 1:
+                    ds_names = ['']
+                    kind = 'gauge'
+                else:
+                    ds_names = [str(i) for i in range(len(values))]
+                    kind = 'gauge'
+                labels = ','.join('%s="%s"' % (label, escape(str(value)))
+                                  for label, value in (
+                                      ('host', host),
+                                      ('plugin_instance', plugin_instance),
+                                      ('type_instance', type_instance))
+                                  if value)
+                labels = labels and '{%s}' % labels
+                for ds_name, value in zip(ds_names, values):
+                    family = metric_name(plugin, type_name, ds_name)
+                    # the last value of a series dispatched twice
+                    families.setdefault(family, (kind, {}))[1][labels] = value
+        return families
+
+    def _render(self, sources):
+        self._shared_types()
+        lines = []
+        families = self._families(sources)
+        for family in sorted(families):
+            kind, samples = families[family]
+            lines.append('# TYPE %s %s' % (family, kind))
+            suffix = kind == 'counter' and '_total' or ''
+            for labels in sorted(samples):
+                lines.append('%s%s%s %s' % (family, suffix, labels,
+                                            number(samples[labels])))
+        lines.append('# EOF\n')
+        return '\n'.join(lines).encode('utf-8')
+
+    def refresh(self):
+        """Render the text again when a source has new values"""
+        with self.lock:
+            currents = [(name, source.current()) for name, source in
+                        sorted(self.sources.items())]
+            key = [(name, current[0]) for name, current in currents]
+            if key == self.key:
+                return
+            text = self._render([(name, updated, records)
+                                 for name, (_, updated, records) in currents])
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(text)
+            # replaced at once, the scrapes are not locked out
+            self.rendered = text, buf.getvalue()
+            self.key = key
+            self.renders += 1
+
+    def render(self, compressed=False):
+        """The text of the last values, as rendered by the last update;
+        the snapshot files are read first"""
+        if [source for source in list(self.sources.values())
+                if source.polled]:
+            self.refresh()
+        text, gzipped = self.rendered
+        return gzipped if compressed else text
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = self.server.exposition.render(compressed)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(exposition, address=DEFAULT_ADDRESS, port=DEFAULT_PORT):
+    """Serve the scrapes of `exposition` in a thread, return the server"""
+    server = Server((address, port), Handler)
+    server.exposition = exposition
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+_expositions = {}
+_expositions_lock = threading.Lock()
+
+
+def exposition(address=DEFAULT_ADDRESS, port=DEFAULT_PORT):
+    """The exposition served on `address` and `port`, shared by the
+    plugins, started at the first call"""
+    with _expositions_lock:
+        if (address, port) not in _expositions:
+            shared = Exposition()
+            shared.server = serve(shared, address, port)
+            _expositions[(address, port)] = shared
+        return _expositions[(address, port)]
+
+
+def parse_config(node):
+    """Parse an <Exposition> configuration block"""
+    conf = {
+        'address': DEFAULT_ADDRESS,
+        'port': DEFAULT_PORT,
+    }
+    for child in node.children:
+        if child.key == 'Address':
+            conf['address'] = child.values[0]
+        elif child.key == 'Port':
+            conf['port'] = int(child.values[0])
+        else:
+            raise ValueError("Unknown Exposition key: %s" % child.key)
+    if not 0 < conf['port'] < 65536:
+        raise ValueError("Exposition Port must be between 1 and 65535")
+    return conf
+
+
+def source_from_config(name, conf, types=None):
+    """The source of the plugin `name`, exposing the values of its
+    `types`"""
+    shared = exposition(conf['address'], conf['port'])
+    if types is not None:
+        shared.add_types(types)
+    return shared.source(name)
+
+
+def default_types_dbs():
+    share = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))), 'share')
+    return sorted(glob.glob(os.path.join(share, '*-types.db')))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m collectd_openstack.exposition',
+        description='Serve the snapshot files to Prometheus')
+    parser.add_argument('snapshots', metavar='SNAPSHOT_FILE', nargs='+')
+    parser.add_argument('--address', metavar='ADDRESS',
+                        default=DEFAULT_ADDRESS)
+    parser.add_argument('--port', metavar='PORT', type=int,
+                        default=DEFAULT_PORT)
+    parser.add_argument('--types-db', metavar='FILE', action='append',
+                        help='types.db naming the data sources, the ones '
+                        'of share by default')
+    args = parser.parse_args(args)
+    shared = Exposition([typesdb.load(path) for path in
+                         args.types_db or default_types_dbs()])
+    for path in args.snapshots:
+        name = os.path.splitext(os.path.basename(path))[0]
+        shared.add(SnapshotSource(name, path))
+    server = Server((args.address, args.port), Handler)
+    server.exposition = shared
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
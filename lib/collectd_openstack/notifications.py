@@ -0,0 +1,423 @@
+# -*- encoding: utf-8 -*-
+#
+# Counters kept current by the notifications of the services
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Event driven counters.
+
+Listing all the servers, volumes, ... of a cloud at every read costs
+as much as the size of the cloud.  The services already send a
+notification when a resource is created, changes state or is deleted
+(`compute.instance.create.end`, `volume.delete.end`, ...).
+
+A `Tally` keeps the resources known to a plugin with the counters they
+contribute to: a running server of the flavor m1.small adds one to
+('instances', 'active') and to ('flavors', 'm1.small').  When a
+resource changes, its old contribution is subtracted from the counters
+and the new one added, so a read only costs the notifications received
+since the last one.  The contributions are interned, the resources of
+the same state, flavor, ... share one.
+
+A `Consumer` drains the notifications of a transport at each read and
+applies them to the tally with the `interpret` function of the plugin.
+Every `interval` seconds the plugin still lists the resources and the
+tally is reset to the listing: the notifications older than the listing
+are then dropped as stale, and the difference between the counters of
+the tally and the ones of the listing is reported as drift.
+
+The transports:
+
+* `memory`: a queue of the collectd process, for the tests and the
+  benchmarks;
+* `file`: JSON lines appended to a file by a forwarder, read from the
+  end of the file at startup;
+* `kombu`: a queue bound to the notification topics of the exchanges of
+  the services on the message bus, with the optional kombu library.
+  It only receives, the services publish.
+"""
+import calendar
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+from collectd_openstack import clients
+from collectd_openstack import typesdb
+
+kombu = clients.lazy('kombu')
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('notifications', ['received', 'applied', 'stale'],
+                 ds_type='DERIVE'),
+    typesdb.Type('reconciliation_drift'),
+])
+
+UPDATE, REMOVE = 'update', 'remove'
+
+def parse_timestamp(value):
+    """Seconds since the epoch of a UTC notification timestamp, like
+    2014-06-01 10:00:00.123456 or 2014-06-01T10:00:00Z, or None"""
+    # sliced, strptime would cost more than applying the notification
+    if not value or len(value) < 19 or value[4] != '-' or \
+            value[10] not in ' T':
+        return None
+    try:
+        seconds = calendar.timegm((int(value[0:4]), int(value[5:7]),
+                                   int(value[8:10]), int(value[11:13]),
+                                   int(value[14:16]), int(value[17:19]),
+                                   0, 0, 0))
+        if value[19:20] == '.':
+            seconds += float('0.' + value[20:].rstrip('Z'))
+    except ValueError:
+        return None
+    return seconds
+
+
+def unwrap(message):
+    """The notification of a message, out of its oslo.messaging envelope"""
+    if isinstance(message, (bytes, type(u''))):
+        message = json.loads(message)
+    if 'oslo.message' in message:
+        message = json.loads(message['oslo.message'])
+    return message
+
+
+def last_segment(value):
+    """Id at the end of an URL or of a heat stack identity"""
+    if value:
+        return value.rstrip('/').rsplit('/', 1)[-1]
+    return value
+
+
+class MemoryTransport:
+    """Queues of the collectd process, shared by name"""
+
+    _queues = {}
+    _lock = threading.Lock()
+
+    def __init__(self, conf):
+        with self._lock:
+            self.queue = self._queues.setdefault(conf['queue'],
+                                                 collections.deque())
+
+    def publish(self, notification):
+        self.queue.append(notification)
+
+    def receive(self, limit):
+        received = []
+        try:
+            while len(received) < limit:
+                received.append(self.queue.popleft())
+        except IndexError:
+            pass
+        return received
+
+
+class FileTransport:
+    """Notifications appended as JSON lines to a file.
+
+    Only the notifications appended after the start are read, the ones
+    before are covered by the first listing.  A file shorter than what
+    was read was rotated and is read again from its start.
+    """
+
+    def __init__(self, conf):
+        self.path = conf['path']
+        try:
+            self.offset = os.path.getsize(self.path)
+        except OSError:
+            self.offset = 0
+
+    def publish(self, notification):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(notification) + '\n')
+
+    def receive(self, limit):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return []
+        received = []
+        with f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < self.offset:
+                self.offset = 0
+            f.seek(self.offset)
+            while len(received) < limit:
+                line = f.readline()
+                # a line is complete once its end of line is written
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                if line.strip():
+                    received.append(json.loads(line.decode('utf-8')))
+        return received
+
+
+class KombuTransport:
+    """Queue bound to the notification topic of the service exchanges.
+
+    It only receives: the exchanges are the ones of the services, and
+    what is published there is consumed by ceilometer too.
+    """
+
+    def __init__(self, conf):
+        self.connection = kombu.Connection(conf['url'])
+        bindings = [kombu.binding(kombu.Exchange(exchange, 'topic',
+                                                 durable=False),
+                                  routing_key=conf['topic'] + '.info')
+                    for exchange in conf['exchanges']]
+        self.queue = kombu.Queue(conf['queue'], bindings, durable=False,
+                                 auto_delete=True)(self.connection.channel())
+        self.queue.declare()
+
+    def receive(self, limit):
+        received = []
+        while len(received) < limit:
+            message = self.queue.get(no_ack=True)
+            if message is None:
+                break
+            received.append(unwrap(message.payload))
+        return received
+
+
+TRANSPORTS = {
+    'memory': MemoryTransport,
+    'file': FileTransport,
+    'kombu': KombuTransport,
+}
+
+
+class Tally:
+    """Counters of the contributions of the resources"""
+
+    def __init__(self, contribution):
+        self.contribution = contribution
+        # id -> (time of the last change, record, contribution)
+        self.resources = {}
+        # id -> time of the deletion, for the late notifications
+        self.deleted = {}
+        self.counters = {}
+        self.interned = {}
+        # time of the last listing, older notifications are stale
+        self.since = 0
+        self.churn = [0, 0, 0]
+
+    def _contribute(self, record):
+        contribution = tuple(self.contribution(record))
+        return self.interned.setdefault(contribution, contribution)
+
+    def _add(self, contribution, sign):
+        counters = self.counters
+        for key, weight in contribution:
+            counters[key] = counters.get(key, 0) + sign * weight
+
+    def update(self, resource_id, record, stamp):
+        """Add or change a resource, False for a stale notification.
+
+        The fields of the record left to None keep their last value.
+        """
+        if stamp < self.since or self.deleted.get(resource_id, 0) > stamp:
+            return False
+        known = self.resources.get(resource_id)
+        if known:
+            if known[0] > stamp:
+                return False
+            record = known[1]._replace(**dict(
+                (field, value) for field, value in zip(record._fields,
+                                                       record)
+                if value is not None))
+        contribution = self._contribute(record)
+        if known:
+            if known[2] is not contribution:
+                self._add(known[2], -1)
+                self._add(contribution, 1)
+                self.churn[2] += 1
+        else:
+            self._add(contribution, 1)
+            self.churn[0] += 1
+        self.resources[resource_id] = (stamp, record, contribution)
+        return True
+
+    def remove(self, resource_id, stamp):
+        """Forget a resource, False for a stale notification"""
+        if stamp < self.since:
+            return False
+        known = self.resources.get(resource_id)
+        if known and known[0] > stamp:
+            return False
+        self.deleted[resource_id] = stamp
+        if known:
+            del self.resources[resource_id]
+            self._add(known[2], -1)
+            self.churn[1] += 1
+        return True
+
+    def get(self, resource_id):
+        """Record of a resource, None when it is not known"""
+        known = self.resources.get(resource_id)
+        return known and known[1]
+
+    def reset(self, records, stamp):
+        """Replace the resources by the (id, record) of a listing made at
+        `stamp`, return the drift of the counters"""
+        old = self.counters
+        self.counters = {}
+        self.resources = {}
+        self.deleted = {}
+        self.interned = {}
+        for resource_id, record in records:
+            contribution = self._contribute(record)
+            self.resources[resource_id] = (stamp, record, contribution)
+            self._add(contribution, 1)
+        self.since = stamp
+        return sum(abs(self.counters.get(key, 0) - old.get(key, 0))
+                   for key in set(old) | set(self.counters))
+
+    def pop_churn(self):
+        """[created, deleted, changed] since the last call"""
+        churn, self.churn = self.churn, [0, 0, 0]
+        return churn
+
+    def nested(self):
+        """The counters as nested dicts, ('a', 'b'): 1 gives {'a': {'b': 1}}"""
+        nested = {}
+        for key, value in self.counters.items():
+            group = nested
+            for part in key[:-1]:
+                group = group.setdefault(part, {})
+            group[key[-1]] = value
+        return nested
+
+
+class Consumer:
+    """Notifications of a transport applied to a tally"""
+
+    def __init__(self, transport, interpret, tally, interval=3600,
+                 batch=1000, clock=time.time):
+        self.transport = transport
+        self.interpret = interpret
+        self.tally = tally
+        self.interval = interval
+        self.batch = batch
+        self.clock = clock
+        self.reconciled = None
+        self.drift = None
+        # received, applied, stale
+        self.counts = [0, 0, 0]
+
+    def due(self):
+        """Whether the resources must be listed again"""
+        return self.reconciled is None or \
+            self.clock() >= self.reconciled + self.interval
+
+    def reconcile(self, records, stamp):
+        """Reset the tally to the (id, record) of a listing started at
+        `stamp`, then apply the notifications received meanwhile"""
+        drift = self.tally.reset(records, stamp)
+        # nothing to drift from at the first listing
+        if self.reconciled is not None:
+            self.drift = drift
+        self.reconciled = self.clock()
+        self.drain()
+
+    def drain(self):
+        """Apply the pending notifications, return how many"""
+        count = 0
+        while True:
+            received = self.transport.receive(self.batch)
+            for notification in received:
+                self.apply(notification)
+            count += len(received)
+            if len(received) < self.batch:
+                return count
+
+    def apply(self, notification):
+        self.counts[0] += 1
+        changes = self.interpret(notification.get('event_type') or '',
+                                 notification.get('payload') or {})
+        if not changes:
+            return
+        stamp = parse_timestamp(notification.get('timestamp'))
+        if stamp is None:
+            stamp = self.clock()
+        for action, resource_id, record in changes:
+            if action == REMOVE:
+                applied = self.tally.remove(resource_id, stamp)
+            else:
+                applied = self.tally.update(resource_id, record, stamp)
+            self.counts[1 if applied else 2] += 1
+
+    def metrics(self):
+        """[received, applied, stale] since the start"""
+        return list(self.counts)
+
+
+def parse_config(node):
+    """Parse a <Notifications> configuration block"""
+    conf = {
+        'transport': 'memory',
+        'queue': None,
+        'path': None,
+        'url': None,
+        'topic': 'notifications',
+        'exchanges': [],
+        'interval': 3600,
+    }
+    for child in node.children:
+        if child.key == 'Transport':
+            conf['transport'] = child.values[0]
+        elif child.key == 'Queue':
+            conf['queue'] = child.values[0]
+        elif child.key == 'Path':
+            conf['path'] = child.values[0]
+        elif child.key == 'URL':
+            conf['url'] = child.values[0]
+        elif child.key == 'Topic':
+            conf['topic'] = child.values[0]
+        elif child.key == 'Exchange':
+            conf['exchanges'].extend(child.values)
+        elif child.key == 'ReconcileInterval':
+            conf['interval'] = float(child.values[0])
+        else:
+            raise ValueError("Unknown Notifications key: %s" % child.key)
+    if conf['transport'] not in TRANSPORTS:
+        raise ValueError("Unknown Notifications transport: %s, must be one "
+                         "of %s" % (conf['transport'],
+                                    ', '.join(sorted(TRANSPORTS))))
+    if conf['transport'] == 'file' and not conf['path']:
+        raise ValueError("Notifications Path not defined")
+    if conf['transport'] == 'kombu' and not conf['url']:
+        raise ValueError("Notifications URL not defined")
+    return conf
+
+
+def consumer_from_config(name, conf, interpret, contribution, exchanges,
+                         host=None):
+    """Consumer of the notifications of the `exchanges` of the services
+    read by the plugin `name`.  The queue is of the plugin on `host` by
+    default: the nodes sharing a queue would each get a part of the
+    notifications."""
+    conf = dict(conf)
+    conf['queue'] = conf['queue'] or 'collectd-%s-%s' % (
+        name, host or socket.gethostname())
+    conf['exchanges'] = conf['exchanges'] or exchanges
+    transport = TRANSPORTS[conf['transport']](conf)
+    return Consumer(transport, interpret, Tally(contribution),
+                    interval=conf['interval'])
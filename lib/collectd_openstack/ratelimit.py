@@ -0,0 +1,253 @@
+# -*- encoding: utf-8 -*-
+#
+# Rate limits of the API calls shared by the plugins
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Token bucket rate limits of the API calls.
+
+Each plugin only knows its own calls: during an incident, when the APIs
+are slow already, the reads of all the plugins of the node keep
+listing them at full speed.
+
+A `Limiter` budgets the calls of the plugins of the collectd process to
+a service (compute, volume, ...): `rate` calls per second with bursts
+of `burst` calls, and `tenant_rate` calls per second with bursts of
+`tenant_burst` for each tenant the plugins authenticate with.  A call
+over the budget either waits for its turn, `queue` mode, up to
+`max_wait` seconds, or is skipped, `skip` mode: `throttle` raises
+`Throttled` and the read is skipped by its `resilience.Guard`.
+
+Each HTTP request is a call, the pages of a listing and the retries of
+a read included.  `rest.RestClient` throttles its requests with the
+service and tenant it is created with.  The client libraries send
+theirs with the `HTTPAdapter` of requests, wrapped by `install`: the
+requests a thread sends in a `calls` block, like the calls run by the
+`concurrency.Engine`, are throttled with the service and tenant of the
+block, the other ones are not limited.  The limiters are shared by the
+plugins, their counts of allowed, delayed and skipped calls are
+dispatched as `rate_limit` records.
+"""
+import contextlib
+import threading
+import time
+
+from collectd_openstack import typesdb
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('rate_limit', ['allowed', 'delayed', 'skipped'],
+                 ds_type='DERIVE'),
+])
+
+MODES = ('queue', 'skip')
+
+
+class Throttled(Exception):
+    """A call skipped to stay within the rate limit of its service"""
+
+
+class Bucket:
+    """`rate` tokens per second, up to `burst`"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def delay(self, now):
+        """Seconds before a token is available"""
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        # below 0 for the calls waiting, in the order they came
+        self.tokens -= 1
+
+
+class Limiter:
+    """Rate limits of the calls to the service `name`"""
+
+    def __init__(self, name, rate=10, burst=20, tenant_rate=None,
+                 tenant_burst=None, mode='queue', max_wait=10,
+                 clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.bucket = Bucket(rate, burst, clock())
+        self.tenant_rate = tenant_rate
+        self.tenant_burst = tenant_burst or max(1, (tenant_rate or 0) * 2)
+        self.tenants = {}
+        self.mode = mode
+        self.max_wait = max_wait
+        # allowed, delayed, skipped
+        self.counts = [0, 0, 0]
+
+    def _buckets(self, tenant, now):
+        if tenant is None or not self.tenant_rate:
+            return [self.bucket]
+        if tenant not in self.tenants:
+            self.tenants[tenant] = Bucket(self.tenant_rate,
+                                          self.tenant_burst, now)
+        return [self.bucket, self.tenants[tenant]]
+
+    def acquire(self, tenant=None):
+        """Whether a call of `tenant` may be made, after waiting for its
+        turn in queue mode"""
+        with self.lock:
+            now = self.clock()
+            buckets = self._buckets(tenant, now)
+            wait = max(bucket.delay(now) for bucket in buckets)
+            if wait and (self.mode == 'skip' or wait > self.max_wait):
+                self.counts[2] += 1
+                return False
+            for bucket in buckets:
+                bucket.take()
+            self.counts[0] += 1
+            if wait:
+                self.counts[1] += 1
+        if wait:
+            self.sleep(wait)
+        return True
+
+    def metrics(self):
+        """[allowed, delayed, skipped] calls since the start"""
+        with self.lock:
+            return list(self.counts)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(name, **args):
+    """The limiter of the service `name` shared by the plugins, created
+    with `args` at the first call, None when `args` is empty and no
+    plugin configured one"""
+    with _limiters_lock:
+        if name not in _limiters and args:
+            _limiters[name] = Limiter(name, **args)
+        return _limiters.get(name)
+
+
+def throttle(name, tenant=None):
+    """Wait for the turn of a call of `tenant` to the service `name`,
+    raise Throttled when it must be skipped"""
+    shared = limiter(name)
+    if shared is not None and not shared.acquire(tenant):
+        raise Throttled("Rate limit of %s reached, call skipped" % name)
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def calls(name, tenant=None):
+    """Throttle the requests of the client libraries sent by the thread
+    in the block as calls of `tenant` to the service `name`"""
+    previous = getattr(_local, 'service', None)
+    _local.service = (name, tenant)
+    try:
+        yield
+    finally:
+        _local.service = previous
+
+
+_installed = []
+
+
+def install():
+    """Throttle the requests sent by the HTTPAdapter of requests in the
+    `calls` blocks, once per process"""
+    with _limiters_lock:
+        if _installed:
+            return
+        try:
+            from requests import adapters
+        except ImportError:
+            return
+        send = adapters.HTTPAdapter.__dict__['send']
+
+        def throttled_send(adapter, request, **kwargs):
+            service = getattr(_local, 'service', None)
+            if service is not None:
+                throttle(*service)
+            return send(adapter, request, **kwargs)
+        adapters.HTTPAdapter.send = throttled_send
+        _installed.append(send)
+
+
+def parse_config(node):
+    """Parse a <RateLimit> configuration block, with a <Service> block
+    per limited service"""
+    conf = {
+        'mode': 'queue',
+        'max_wait': 10,
+        'services': {},
+    }
+    for child in node.children:
+        if child.key == 'Mode':
+            conf['mode'] = child.values[0]
+        elif child.key == 'MaxWait':
+            conf['max_wait'] = float(child.values[0])
+        elif child.key == 'Service':
+            conf['services'][child.values[0]] = _parse_service(child)
+        else:
+            raise ValueError("Unknown RateLimit key: %s" % child.key)
+    if conf['mode'] not in MODES:
+        raise ValueError("RateLimit Mode must be one of %s" %
+                         ', '.join(MODES))
+    return conf
+
+
+def _parse_service(node):
+    service = {
+        'rate': 10,
+        'burst': None,
+        'tenant_rate': None,
+        'tenant_burst': None,
+    }
+    for child in node.children:
+        if child.key == 'Rate':
+            service['rate'] = float(child.values[0])
+        elif child.key == 'Burst':
+            service['burst'] = float(child.values[0])
+        elif child.key == 'TenantRate':
+            service['tenant_rate'] = float(child.values[0])
+        elif child.key == 'TenantBurst':
+            service['tenant_burst'] = float(child.values[0])
+        else:
+            raise ValueError("Unknown RateLimit Service key: %s" % child.key)
+    if service['rate'] <= 0 or (service['tenant_rate'] or 1) <= 0:
+        raise ValueError("RateLimit rates must be positive")
+    service['burst'] = service['burst'] or max(1, service['rate'] * 2)
+    if service['burst'] < 1 or (service['tenant_burst'] or 1) < 1:
+        raise ValueError("RateLimit bursts must be at least 1")
+    return service
+
+
+def limiters_from_config(conf):
+    """Create the limiters of a <RateLimit> block, the first plugin
+    configuring a service sets its limits"""
+    for name, service in conf['services'].items():
+        limiter(name, mode=conf['mode'], max_wait=conf['max_wait'],
+                **service)
+    install()
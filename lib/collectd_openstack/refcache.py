@@ -0,0 +1,186 @@
+# -*- encoding: utf-8 -*-
+#
+# Cache of the reference data of the plugins
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Cache of the reference data.
+
+The flavors, images, aggregates, neutron extensions and subnets change
+a few times a day but the plugins used to list them at every read.
+`RefCache` keeps them for a time to live depending on their kind, and
+at most `max_entries` of them, evicting the least recently used one.
+
+When an entry expires and the caller gave a `revalidate` function, it
+is called with the cached value first: a cheap request telling whether
+the value is still valid, like the ids of the subnets of a network
+instead of all the subnets.  The value is only fetched again when it
+is not.
+
+The cache can be used by several threads: a value being fetched is
+fetched once, the other threads wait for it.  The hits, misses,
+evictions and revalidations of each kind are counted, the plugins
+dispatch them as `reference_cache` records.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from collectd_openstack import typesdb
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('reference_cache', ['hits', 'misses', 'evictions',
+                                     'revalidations'], ds_type='DERIVE'),
+])
+
+# Time to live of the kinds of reference data, in seconds
+TTLS = {
+    'images': 300,
+    'flavors': 300,
+    'aggregates': 300,
+    'extensions': 3600,
+    'subnets': 3600,
+}
+
+HITS, MISSES, EVICTIONS, REVALIDATIONS = range(4)
+
+
+class RefCache:
+    """Values of (kind, key) kept for the time to live of their kind"""
+
+    def __init__(self, ttls=None, default_ttl=300, max_entries=64,
+                 clock=time.time):
+        self.ttls = dict(TTLS)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (kind, key) -> [value, expiry], least recently used first
+        self.entries = OrderedDict()
+        self.fetching = {}
+        self.counters = {}
+
+    def ttl(self, kind):
+        return self.ttls.get(kind, self.default_ttl)
+
+    def _count(self, kind, counter):
+        counters = self.counters.get(kind)
+        if counters is None:
+            counters = self.counters[kind] = [0, 0, 0, 0]
+        counters[counter] += 1
+
+    def _fresh(self, identity):
+        """The entry if it has not expired, made the most recently used"""
+        entry = self.entries.get(identity)
+        if entry is None or entry[1] <= self.clock():
+            return None
+        self.entries[identity] = self.entries.pop(identity)
+        return entry
+
+    def _store(self, identity, value):
+        self.entries.pop(identity, None)
+        self.entries[identity] = [value, self.clock() + self.ttl(identity[0])]
+        while len(self.entries) > self.max_entries:
+            (kind, _), _ = self.entries.popitem(last=False)
+            self._count(kind, EVICTIONS)
+
+    def get(self, kind, key, fetch, revalidate=None):
+        """The cached value of (kind, key), or the value of fetch().
+
+        `revalidate(value)` tells whether an expired value is still
+        valid.  The exceptions of fetch and revalidate are raised and
+        nothing is cached.
+        """
+        identity = (kind, key)
+        with self.lock:
+            entry = self._fresh(identity)
+            if entry:
+                self._count(kind, HITS)
+                return entry[0]
+            fetching = self.fetching.get(identity)
+            if fetching is None:
+                fetching = self.fetching[identity] = threading.Lock()
+        with fetching:
+            with self.lock:
+                # fetched by another thread while we waited
+                entry = self._fresh(identity)
+                if entry:
+                    self._count(kind, HITS)
+                    return entry[0]
+                entry = self.entries.get(identity)
+            try:
+                if entry and revalidate and revalidate(entry[0]):
+                    with self.lock:
+                        self._store(identity, entry[0])
+                        self._count(kind, REVALIDATIONS)
+                    return entry[0]
+                value = fetch()
+                with self.lock:
+                    self._store(identity, value)
+                    self._count(kind, MISSES)
+                return value
+            finally:
+                with self.lock:
+                    self.fetching.pop(identity, None)
+
+    def put(self, kind, key, value):
+        """Cache a value, from a warm start snapshot for example"""
+        with self.lock:
+            self._store((kind, key), value)
+
+    def invalidate(self, kind, key=None):
+        """Forget a value, or all the values of a kind"""
+        with self.lock:
+            for identity in list(self.entries):
+                if identity[0] == kind and key in (None, identity[1]):
+                    del self.entries[identity]
+
+    def stats(self):
+        """{kind: [hits, misses, evictions, revalidations]} since the start"""
+        with self.lock:
+            return dict((kind, list(counters))
+                        for kind, counters in self.counters.items())
+
+
+def parse_config(node):
+    """Parse a <ReferenceCache> configuration block"""
+    conf = {
+        'ttls': {},
+        'default_ttl': 300,
+        'max_entries': 64,
+    }
+    for child in node.children:
+        if child.key == 'TTL':
+            if len(child.values) != 2:
+                raise ValueError("ReferenceCache TTL takes a kind and "
+                                 "a number of seconds")
+            conf['ttls'][child.values[0]] = float(child.values[1])
+        elif child.key == 'DefaultTTL':
+            conf['default_ttl'] = float(child.values[0])
+        elif child.key == 'MaxEntries':
+            conf['max_entries'] = int(child.values[0])
+        else:
+            raise ValueError("Unknown ReferenceCache key: %s" % child.key)
+    return conf
+
+
+def cache_from_config(conf=None):
+    """The cache of a parsed configuration, the default one without"""
+    if conf is None:
+        return RefCache()
+    return RefCache(ttls=conf['ttls'], default_ttl=conf['default_ttl'],
+                    max_entries=conf['max_entries'])
@@ -0,0 +1,257 @@
+# -*- encoding: utf-8 -*-
+#
+# Timeouts, retries and circuit breakers around the API calls
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Resilience of the reads to failing APIs.
+
+A hung API used to block `read_callback`, and with it a collectd read
+thread, forever.  `Guard` bounds the cost of a failing endpoint:
+
+* the clients get a connect and a read timeout, see `Guard.timeout`;
+* a read failing with a transient error (timeout, connection error,
+  5xx or 429 status) is retried after an exponential backoff with full
+  jitter, see `Backoff`;
+* after `threshold` consecutive failed reads the `Breaker` of the
+  endpoint opens: the reads are skipped without calling the API for a
+  cool-down growing exponentially, with jitter, with the number of
+  consecutive trips.  Then the reads are tried again (half open), the
+  first one closes the breaker when it succeeds and opens it again when
+  it fails.
+
+A read making a call skipped by the rate limit of its service, see
+`ratelimit`, is skipped too, without counting as a failure.
+
+The breakers are shared by the plugins calling the same endpoint, like
+the compute API of collectd-nova-stats, collectd-nova-hypervisor-stats
+and collectd-instances-stats.  Their state is dispatched as
+`circuit_breaker` records.
+"""
+import random
+import socket
+import threading
+import time
+
+from collectd_openstack import ratelimit
+from collectd_openstack import typesdb
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('circuit_breaker', ['state', 'trips', 'failures',
+                                     'rejected']),
+])
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+def is_transient(error):
+    """Whether an error of a client library may go away by itself"""
+    for attribute in ('status', 'http_status', 'status_code', 'code'):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int):
+            return status >= 500 or status == 429
+    if isinstance(error, (socket.error, EnvironmentError)):
+        return True
+    # requests, the client libraries and the REST fast path do not share
+    # their exceptions
+    name = type(error).__name__
+    return 'Timeout' in name or 'Connection' in name
+
+
+class Backoff:
+    """Exponential delays with jitter, capped.
+
+    The delay of an attempt is drawn between `floor` times and once
+    base * 2 ** attempt: a floor of 0 is the full jitter, with the
+    shortest delays, 0.5 the equal jitter, that always waits.
+    """
+
+    def __init__(self, base=1.0, cap=60.0, floor=0, rand=random.random):
+        self.base = base
+        self.cap = cap
+        self.floor = floor
+        self.rand = rand
+
+    def delay(self, attempt):
+        """Delay before the retry `attempt`, counted from 0"""
+        ceiling = min(self.cap, self.base * 2 ** attempt)
+        return ceiling * (self.floor + (1 - self.floor) * self.rand())
+
+
+class Breaker:
+    """Circuit breaker of one endpoint"""
+
+    def __init__(self, name, threshold=3, cooldown=None, clock=time.time):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown or Backoff(base=30, cap=600, floor=0.5)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        # consecutive trips, for the cool-down
+        self.streak = 0
+        self.trips = 0
+        self.rejected = 0
+        self.reopen_at = 0
+
+    def allow(self):
+        """Whether a call can be made now"""
+        with self.lock:
+            if self.state == OPEN:
+                if self.clock() < self.reopen_at:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+            return True
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.streak = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self.trips += 1
+                self.reopen_at = self.clock() + \
+                    self.cooldown.delay(self.streak)
+                self.streak += 1
+
+    def metrics(self):
+        """[state, trips, consecutive failures, rejected calls]"""
+        with self.lock:
+            return [self.state, self.trips, self.failures, self.rejected]
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name, **args):
+    """The breaker of an endpoint, created with `args` at the first call"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = Breaker(name, **args)
+        return _breakers[name]
+
+
+class Guard:
+    """Timeouts, retries and breaker of the reads of one endpoint"""
+
+    def __init__(self, name, connect_timeout=10, read_timeout=30,
+                 retries=1, backoff=None, breaker=None, sleep=time.sleep):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker or Breaker(name)
+        self.sleep = sleep
+
+    @property
+    def timeout(self):
+        """(connect, read) timeouts, for RestClient and requests"""
+        return (self.connect_timeout, self.read_timeout)
+
+    def call(self, function, *args, **kwargs):
+        """Result of function, None without calling it when the breaker
+        is open, or when it was throttled.  The last error is raised when
+        all the tries failed; only the transient errors are retried and
+        counted by the breaker.
+        """
+        if not self.breaker.allow():
+            return None
+        attempt = 0
+        while True:
+            try:
+                result = function(*args, **kwargs)
+            except ratelimit.Throttled:
+                return None
+            except Exception as e:
+                if not is_transient(e):
+                    # the endpoint answered: a rejected token or a bug
+                    # of the plugin is no outage
+                    self.breaker.success()
+                    raise
+                if attempt >= self.retries:
+                    self.breaker.failure()
+                    raise
+                self.sleep(self.backoff.delay(attempt))
+                attempt += 1
+            else:
+                self.breaker.success()
+                return result
+
+    def metrics(self):
+        return self.breaker.metrics()
+
+
+DEFAULTS = {
+    'endpoint': None,
+    'connect_timeout': 10,
+    'read_timeout': 30,
+    'retries': 1,
+    'retry_delay': 1,
+    'failure_threshold': 3,
+    'cooldown': 30,
+    'max_cooldown': 600,
+}
+
+
+def parse_config(node):
+    """Parse a <Resilience> configuration block"""
+    conf = dict(DEFAULTS)
+    for child in node.children:
+        if child.key == 'Endpoint':
+            conf['endpoint'] = child.values[0]
+        elif child.key == 'ConnectTimeout':
+            conf['connect_timeout'] = float(child.values[0])
+        elif child.key == 'ReadTimeout':
+            conf['read_timeout'] = float(child.values[0])
+        elif child.key == 'Retries':
+            conf['retries'] = int(child.values[0])
+        elif child.key == 'RetryDelay':
+            conf['retry_delay'] = float(child.values[0])
+        elif child.key == 'FailureThreshold':
+            conf['failure_threshold'] = int(child.values[0])
+        elif child.key == 'Cooldown':
+            conf['cooldown'] = float(child.values[0])
+        elif child.key == 'MaxCooldown':
+            conf['max_cooldown'] = float(child.values[0])
+        else:
+            raise ValueError("Unknown Resilience key: %s" % child.key)
+    return conf
+
+
+def guard_from_config(endpoint, conf=None):
+    """Guard of the reads of an endpoint, with the defaults without conf"""
+    conf = conf or DEFAULTS
+    endpoint = conf['endpoint'] or endpoint
+    return Guard(endpoint,
+                 connect_timeout=conf['connect_timeout'],
+                 read_timeout=conf['read_timeout'],
+                 retries=conf['retries'],
+                 backoff=Backoff(base=conf['retry_delay'],
+                                 cap=conf['retry_delay'] * 8),
+                 breaker=breaker(endpoint,
+                                 threshold=conf['failure_threshold'],
+                                 cooldown=Backoff(base=conf['cooldown'],
+                                                  cap=conf['max_cooldown'],
+                                                  floor=0.5)))
@@ -0,0 +1,415 @@
+# -*- encoding: utf-8 -*-
+#
+# Lightweight REST access to the OpenStack listing endpoints
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Fast path for the big listings.
+
+The python-*client libraries turn every record of a listing into a
+Resource object, when the collectors only read a few of its fields.
+`RestClient` fetches the listing with a token and an endpoint taken
+from the client library, and a `Projection` turns each JSON record into
+a namedtuple of the fields a collector needs.  The same projection
+applied to the Resource objects of the client libraries gives the same
+tuples, so the collectors do not care which path was used.
+
+With `stream` set, the listings are parsed while they are read from the
+socket by `JsonStream`, one record at a time, instead of loading the
+whole page first.
+
+With `compress` set, gzip and deflate encodings are accepted and the
+responses are decompressed as they are read.  The bytes received and
+decoded for each listing are kept in `transfers` until `pop_transfers`
+is called.
+
+A `RestClient` can be used by several threads at once, like the calls
+of a `concurrency.Engine`: it keeps a pool of at most `pool_size` idle
+connections, a request takes one from the pool or opens a new one, and
+gives it back once its response is read.
+
+With `service` set, each request waits for its turn under the rate limit
+of the service and of `tenant`, see `ratelimit`.
+"""
+import codecs
+import json
+import re
+import socket
+import threading
+import zlib
+from collections import namedtuple
+
+try:
+    import httplib
+    from urllib import urlencode
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlencode
+    from urllib.parse import urlsplit
+
+from collectd_openstack import ratelimit
+from collectd_openstack import typesdb
+
+# Bytes received and decoded for a listing, see RestClient.pop_transfers
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('http_transfer', ['compressed', 'uncompressed']),
+])
+
+
+class RestError(Exception):
+    def __init__(self, status, reason, url):
+        Exception.__init__(self, "%s %s on %s" % (status, reason, url))
+        self.status = status
+        self.reason = reason
+
+
+class Body:
+    """Body of a response, decompressed while it is read.
+
+    The bytes read from the network and the decoded bytes are counted in
+    `wire_bytes` and `decoded_bytes`.
+    """
+
+    def __init__(self, response, connection=None):
+        self.response = response
+        # given back to the pool of the client once the body is read
+        self.connection = connection
+        self.encoding = (response.getheader('content-encoding') or '').lower()
+        self.decompressor = None
+        if self.encoding in ('gzip', 'deflate'):
+            # 32 + MAX_WBITS accepts both the gzip and the zlib headers
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def _decompress(self, chunk):
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error:
+            if self.encoding != 'deflate' or self.wire_bytes != len(chunk):
+                raise
+            # Some servers send deflate data without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompressor.decompress(chunk)
+
+    def read(self, size=None):
+        """Read at most size bytes of the response, everything when size
+        is None, and return them decoded: more than size bytes for a
+        compressed body"""
+        while True:
+            if size is None:
+                chunk = self.response.read()
+            else:
+                chunk = self.response.read(size)
+            self.wire_bytes += len(chunk)
+            if self.decompressor is None:
+                data = chunk
+            elif size is None:
+                data = self._decompress(chunk) + self.decompressor.flush()
+            elif chunk:
+                data = self._decompress(chunk)
+            else:
+                data = self.decompressor.flush()
+            self.decoded_bytes += len(data)
+            # a compressed chunk can decode to nothing, read another one
+            if data or not chunk or size is None:
+                return data
+
+
+class JsonStream:
+    """Incremental parser of a listing document.
+
+    Iterating over it yields the records of the `key` array of the JSON
+    object read from `stream` (anything with a read(size) method) as
+    soon as they are complete.  Only the current chunk and record are
+    kept in memory.  The other members of the object, like the
+    pagination links, are available in `document` once the iteration
+    is over.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, stream, key, chunk_size=65536):
+        self.stream = stream
+        self.key = key
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.document = {}
+
+    def _read(self):
+        """Append a chunk to the buffer, False at the end of the stream"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer += self.text_decoder.decode(b'', True)
+            return False
+        # forget what was already parsed
+        self.buffer = self.buffer[self.position:] + \
+            self.text_decoder.decode(chunk)
+        self.position = 0
+        return True
+
+    def _skip(self):
+        """Skip the whitespaces, return the next character"""
+        while True:
+            self.position = self.whitespace.match(self.buffer,
+                                                  self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read():
+                raise ValueError("Unexpected end of the JSON document")
+
+    def _expect(self, characters):
+        character = self._skip()
+        if character not in characters:
+            raise ValueError("Expecting one of %r at %d, got %r" %
+                             (characters, self.position, character))
+        self.position += 1
+        return character
+
+    def _value(self):
+        """Decode the next JSON value, reading more data as needed"""
+        self._skip()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer,
+                                                     self.position)
+                # A number cut by the end of a chunk is decoded without
+                # error: only accept a value followed by a delimiter.
+                following = self.whitespace.match(self.buffer, end).end()
+                if self.eof or (following < len(self.buffer) and
+                                self.buffer[following] in ',]}:'):
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._skip() == '}':
+            return
+        while True:
+            member = self._value()
+            self._expect(':')
+            if member == self.key and self._skip() == '[':
+                self.position += 1
+                if self._skip() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.document[member] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+class Projection:
+    """Extract some fields of a JSON record into a namedtuple.
+
+    `fields` is a list of (attribute, path) where path is a dotted key
+    in the record, like 'flavor.id'.  Missing keys give None.
+    """
+
+    def __init__(self, name, fields):
+        self.tuple = namedtuple(name, [attribute for attribute, _ in fields])
+        self.paths = [tuple(path.split('.')) for _, path in fields]
+
+    def __call__(self, record):
+        values = []
+        for path in self.paths:
+            value = record
+            for key in path:
+                if isinstance(value, dict):
+                    value = value.get(key)
+                else:
+                    value = None
+                    break
+            values.append(value)
+        return self.tuple._make(values)
+
+    def from_resource(self, resource):
+        """Same as calling the projection on a client library Resource"""
+        return self(resource._info)
+
+
+class RestClient:
+    """GET only client keeping its connections to one endpoint open"""
+
+    def __init__(self, endpoint, token, timeout=None, stream=False,
+                 compress=False, pool_size=4, service=None, tenant=None):
+        url = urlsplit(endpoint)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self.stream = stream
+        self.compress = compress
+        self.pool_size = pool_size
+        # the rate limit of the requests, see ratelimit
+        self.service = service
+        self.tenant = tenant
+        self.lock = threading.Lock()
+        # idle connections, the most recently used last
+        self.connections = []
+        self.transfers = {}
+
+    def _connect(self):
+        # a timeout for all the socket operations, or (connect, read)
+        connect_timeout = read_timeout = self.timeout
+        if isinstance(self.timeout, tuple):
+            connect_timeout, read_timeout = self.timeout
+        if self.scheme == 'https':
+            connection = httplib.HTTPSConnection(self.netloc,
+                                                 timeout=connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(self.netloc,
+                                                timeout=connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(read_timeout)
+        return connection
+
+    def _acquire(self):
+        with self.lock:
+            if self.connections:
+                return self.connections.pop()
+        return self._connect()
+
+    def _release(self, connection):
+        """Keep the connection of a response read to its end"""
+        with self.lock:
+            if len(self.connections) < self.pool_size:
+                self.connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, path):
+        """Send a GET of path, return the Body of the response"""
+        headers = {'X-Auth-Token': self.token,
+                   'Accept': 'application/json'}
+        if self.compress:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        if self.service is not None:
+            ratelimit.throttle(self.service, self.tenant)
+        for retry in (True, False):
+            connection = self._acquire()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                break
+            except socket.timeout:
+                connection.close()
+                raise
+            except (httplib.HTTPException, IOError):
+                # the server may have closed the kept alive connection
+                connection.close()
+                if not retry:
+                    raise
+        if response.status >= 400:
+            response.read()
+            self._release(connection)
+            raise RestError(response.status, response.reason, path)
+        return Body(response, connection)
+
+    def _account(self, name, body):
+        """Count the transfer of a body read to its end"""
+        self._release(body.connection)
+        with self.lock:
+            transfer = self.transfers.setdefault(name, [0, 0])
+            transfer[0] += body.wire_bytes
+            transfer[1] += body.decoded_bytes
+
+    def pop_transfers(self):
+        """Return and reset the [received, decoded] bytes of each listing"""
+        with self.lock:
+            transfers, self.transfers = self.transfers, {}
+        return transfers
+
+    def _path(self, path, params=None):
+        if path.startswith(('http://', 'https://')):
+            url = urlsplit(path)
+            path = url.path + (url.query and '?' + url.query or '')
+        elif not path.startswith('/'):
+            path = "%s/%s" % (self.base_path, path)
+        if params:
+            path += ('?' in path and '&' or '?') + urlencode(params)
+        return path
+
+    def _get(self, path, name):
+        body = self.request(path)
+        try:
+            document = json.loads(body.read().decode('utf-8'))
+        except Exception:
+            # maybe not read to its end, the connection cannot be reused
+            body.connection.close()
+            raise
+        self._account(name, body)
+        return document
+
+    def get(self, path, params=None):
+        """Return the decoded JSON document at path"""
+        return self._get(self._path(path, params), path)
+
+    def listing(self, path, key, projection, params=None):
+        """Iterate over the projected records of a listing.
+
+        The `<key>_links` next links of paginated listings are followed.
+        """
+        path = self._path(path, params)
+        while path:
+            if self.stream:
+                body = self.request(path)
+                complete = False
+                try:
+                    document = JsonStream(body, key)
+                    for record in document:
+                        yield projection(record)
+                    document = document.document
+                    # the end of the response, to reuse the connection
+                    body.read()
+                    complete = True
+                finally:
+                    if not complete:
+                        # abandoned or failed in the middle of the body,
+                        # the connection cannot be reused
+                        body.connection.close()
+                self._account(key, body)
+            else:
+                document = self._get(path, key)
+                for record in document.get(key, ()):
+                    yield projection(record)
+            path = None
+            for link in document.get("%s_links" % key, ()):
+                if link.get('rel') == 'next':
+                    path = self._path(link['href'])
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,236 @@
+# -*- encoding: utf-8 -*-
+#
+# Reads spread over the interval
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Phase spread reads.
+
+collectd starts the reads of all its plugins at the start of each
+interval, and with ntp the nodes of a fleet start them at the same
+time: the APIs get all the listings at once, then nothing until the
+next interval.
+
+With a `Schedule`, the read of a plugin is registered with a short
+`tick` and only made when due: once per `interval`, at a phase of the
+interval derived from a hash of the host and of the plugin, so the
+collectors of the fleet start their reads spread over the interval, at
+the same phase from one interval to the next.  A random delay of up to
+`jitter` seconds is added to each start, against the hosts hashed to
+close phases.
+
+With `min_interval` and `max_interval` bounds, the interval adapts to
+the cost of the reads and to the rate of change of their values, as
+counted by `Dispatcher.track`:
+
+* a read where no value changed doubles the interval, one where all
+  the values changed halves it, and one where some changed shrinks it
+  in proportion;
+* the interval stays long enough for the reads to take at most
+  `budget` of the time, and to transfer at most `byte_rate` bytes per
+  second when set, so the expensive collectors back off first while
+  the cheap ones follow their values down to `min_interval`.
+
+The values of a scheduled read are dispatched with the current
+interval, not the tick, see `Dispatcher.set_interval`.
+
+The phase of the last start in the interval, its lag behind the
+planned start, jitter included, and the current interval are
+dispatched as `schedule` records.
+"""
+import functools
+import hashlib
+import math
+import random
+import socket
+import threading
+import time
+
+from collectd_openstack import typesdb
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('schedule', ['phase', 'lag', 'interval']),
+])
+
+
+def phase_of(key):
+    """Phase of `key` in the interval, in [0, 1)"""
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / float(1 << 32)
+
+
+class Schedule:
+    """Starts of the reads of the collector `name` of `host`, one per
+    `interval` seconds at the `phase` of the interval, the hashed one by
+    default.  The interval adapts between `min_interval` and
+    `max_interval` when they differ."""
+
+    def __init__(self, name, interval=10, tick=1, jitter=1, host=None,
+                 phase=None, min_interval=None, max_interval=None,
+                 budget=0.1, byte_rate=None, clock=time.time):
+        self.interval = interval
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.budget = budget
+        self.byte_rate = byte_rate
+        self.tick = tick
+        # a start never slips into the next interval
+        self.max_jitter = jitter
+        self.jitter = min(jitter, interval / 2.0)
+        self.host = host or socket.gethostname()
+        key = "%s/%s" % (self.host, name)
+        self.phase = phase_of(key) if phase is None else phase
+        self.offset = self.phase * interval
+        self.random = random.Random(key)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.planned = None
+        self.start_at = None
+        self.started = None
+        self.last = [0, 0]
+
+    def _plan(self, now):
+        """Plan the start of the first interval after `now`"""
+        cycle = math.floor((now - self.offset) / self.interval) + 1
+        self.planned = cycle * self.interval + self.offset
+        self.start_at = self.planned + self.random.uniform(0, self.jitter)
+
+    def due(self):
+        """Whether a read must start now, then the next one is planned"""
+        with self.lock:
+            now = self.clock()
+            if self.start_at is None:
+                self._plan(now)
+            if now < self.start_at:
+                return False
+            self.last = [now % self.interval, now - self.planned]
+            self.started = now
+            self._plan(now)
+            return True
+
+    def adapt(self, elapsed, changed, compared, transferred=0):
+        """Adapt the interval to a read of `elapsed` seconds, where
+        `changed` of the `compared` values changed and `transferred` bytes
+        were received"""
+        if self.min_interval == self.max_interval:
+            return
+        with self.lock:
+            interval = self.interval
+            if compared:
+                if changed:
+                    interval *= 1 - float(changed) / compared / 2
+                else:
+                    interval *= 2
+            interval = max(interval, elapsed / self.budget)
+            if self.byte_rate:
+                interval = max(interval, float(transferred) / self.byte_rate)
+            interval = min(max(interval, self.min_interval),
+                           self.max_interval)
+            if interval != self.interval:
+                self.interval = interval
+                self.offset = self.phase * interval
+                self.jitter = min(self.max_jitter, interval / 2.0)
+                # about one new interval after the last start
+                self._plan(self.started + interval / 2.0)
+
+    def wrap(self, read, dispatcher):
+        """The read callback to register: `read` when due, its values
+        dispatched with `dispatcher` adapting the interval"""
+        dispatcher.track()
+        # registered with the tick, the values come once per interval
+        dispatcher.set_interval(self.interval)
+
+        @functools.wraps(read)
+        def scheduled(*args):
+            if not self.due():
+                return
+            start = self.clock()
+            dispatcher.pop_changes()
+            try:
+                read(*args)
+            finally:
+                self.adapt(self.clock() - start, *dispatcher.pop_changes())
+                if dispatcher.interval != self.interval:
+                    dispatcher.set_interval(self.interval)
+        return scheduled
+
+    def metrics(self):
+        """[phase of the last start in the interval, lag behind its
+        planned start, interval], in seconds"""
+        with self.lock:
+            return self.last + [self.interval]
+
+
+def parse_config(node):
+    """Parse a <Schedule> configuration block"""
+    conf = {
+        'interval': 10,
+        'tick': 1,
+        'jitter': 1,
+        'host': None,
+        'phase': None,
+        'min_interval': None,
+        'max_interval': None,
+        'budget': 0.1,
+        'byte_rate': None,
+    }
+    for child in node.children:
+        if child.key == 'Interval':
+            conf['interval'] = float(child.values[0])
+        elif child.key == 'Tick':
+            conf['tick'] = float(child.values[0])
+        elif child.key == 'Jitter':
+            conf['jitter'] = float(child.values[0])
+        elif child.key == 'Host':
+            conf['host'] = child.values[0]
+        elif child.key == 'Phase':
+            conf['phase'] = float(child.values[0])
+        elif child.key == 'MinInterval':
+            conf['min_interval'] = float(child.values[0])
+        elif child.key == 'MaxInterval':
+            conf['max_interval'] = float(child.values[0])
+        elif child.key == 'Budget':
+            conf['budget'] = float(child.values[0])
+        elif child.key == 'ByteRate':
+            conf['byte_rate'] = float(child.values[0])
+        else:
+            raise ValueError("Unknown Schedule key: %s" % child.key)
+    if conf['interval'] <= 0 or not 0 < conf['tick'] <= conf['interval']:
+        raise ValueError("Schedule Tick must be positive and at most the "
+                         "Interval")
+    if conf['jitter'] < 0:
+        raise ValueError("Schedule Jitter must be positive")
+    if conf['phase'] is not None and not 0 <= conf['phase'] < 1:
+        raise ValueError("Schedule Phase must be in [0, 1)")
+    if not (conf['min_interval'] or conf['interval']) <= conf['interval'] \
+            <= (conf['max_interval'] or conf['interval']):
+        raise ValueError("Schedule Interval must be between MinInterval and "
+                         "MaxInterval")
+    if conf['min_interval'] is not None and \
+            conf['tick'] > conf['min_interval']:
+        raise ValueError("Schedule Tick must be at most the MinInterval")
+    if not 0 < conf['budget'] <= 1:
+        raise ValueError("Schedule Budget must be in (0, 1]")
+    return conf
+
+
+def schedule_from_config(name, conf):
+    """Schedule of the reads of the plugin `name`"""
+    return Schedule(name, interval=conf['interval'], tick=conf['tick'],
+                    jitter=conf['jitter'], host=conf['host'],
+                    phase=conf['phase'], min_interval=conf['min_interval'],
+                    max_interval=conf['max_interval'], budget=conf['budget'],
+                    byte_rate=conf['byte_rate'])
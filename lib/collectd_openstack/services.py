@@ -0,0 +1,122 @@
+# -*- encoding: utf-8 -*-
+#
+# Health of the OpenStack services
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Service health from the service listings.
+
+The nova and cinder services, the neutron agents and the heat engines
+are turned into `Service` tuples, then `ServiceHealth` counts the ones
+up, enabled and stale of each binary in one pass over the listing.  A
+service is stale when its last heartbeat (`updated_at`) is older than
+`stale_after` seconds, even if the API still reports it up.
+
+The binaries are the ones found in the listing, each one is dispatched
+as a `service_health` record with the binary as type instance.
+"""
+import calendar
+import re
+import time
+from collections import namedtuple
+
+from collectd_openstack import typesdb
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('service_health', ['total', 'up', 'enabled', 'stale']),
+])
+
+# 2014-06-01T10:00:00.000000, 2014-06-01 10:00:00, with a timezone or not
+TIMESTAMP = re.compile(r'^(\d{4}-\d\d-\d\d)[T ](\d\d:\d\d:\d\d)(?:\.\d+)?'
+                       r'\s*(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+Service = namedtuple('Service', ['binary', 'host', 'zone', 'up', 'enabled',
+                                 'updated_at'])
+
+
+def from_resource(service):
+    """Service of the nova and cinder os-services listings"""
+    return Service(service.binary,
+                   service.host,
+                   getattr(service, 'zone', None),
+                   service.state == 'up',
+                   service.status == 'enabled',
+                   getattr(service, 'updated_at', None))
+
+
+def from_agent(agent):
+    """Service of a record of the neutron agents listing"""
+    return Service(agent.get('binary'),
+                   agent.get('host'),
+                   agent.get('availability_zone'),
+                   bool(agent.get('alive')),
+                   bool(agent.get('admin_state_up')),
+                   agent.get('heartbeat_timestamp'))
+
+
+def from_engine(service):
+    """Service of the heat services listing, engines cannot be disabled"""
+    return Service(service.binary,
+                   service.host,
+                   None,
+                   service.status == 'up',
+                   True,
+                   getattr(service, 'updated_at', None))
+
+
+def parse_time(value):
+    """Seconds since the epoch of an API timestamp, in UTC without a
+    timezone, or None"""
+    match = value and TIMESTAMP.match(value.strip())
+    if not match:
+        return None
+    day, clock, _, sign, hours, minutes = match.groups()
+    try:
+        seconds = calendar.timegm(time.strptime('%s %s' % (day, clock),
+                                                '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return None
+    if sign:
+        offset = int(hours) * 3600 + int(minutes) * 60
+        seconds -= offset if sign == '+' else -offset
+    return seconds
+
+
+class ServiceHealth:
+    """Count the services of a listing per binary"""
+
+    def __init__(self, stale_after=60):
+        self.stale_after = stale_after
+
+    def is_stale(self, service, now):
+        updated = parse_time(service.updated_at)
+        return updated is None or now - updated > self.stale_after
+
+    def summary(self, services, now=None):
+        """[total, up, enabled, stale] of each binary"""
+        if now is None:
+            now = time.time()
+        binaries = {}
+        for service in services:
+            totals = binaries.setdefault(service.binary, [0, 0, 0, 0])
+            totals[0] += 1
+            if service.up:
+                totals[1] += 1
+            if service.enabled:
+                totals[2] += 1
+            if self.is_stale(service, now):
+                totals[3] += 1
+        return binaries
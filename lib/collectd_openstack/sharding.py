@@ -0,0 +1,259 @@
+# -*- encoding: utf-8 -*-
+#
+# Sharded collection across collector nodes
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Split the listings of a collector between several nodes.
+
+Each of the `count` nodes gets an `index` and reads one contiguous part
+of the paginated all-tenants listings: a first listing of the ids only,
+cheap, is cut in `count` parts, and each node lists the details from the
+marker of its part, the last id of the part before, up to the first
+item of the next part.  The items created in between come first in the
+listings, sorted by creation date from the newest, so in the first
+part.  Every node publishes its partial aggregate after its read, and
+the node of index 0 merges the last partial of every node with its own
+before dispatching them.
+
+The reads of the nodes are not aligned, each one starts at the phase of
+its host in the interval, so the merger never waits for the others: it
+takes their last partials, as long as they are at most one interval and
+the timeout old.
+"""
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+def merge(left, right):
+    """Sum two aggregates of the same shape.
+
+    Dicts are merged key by key, lists element by element and numbers
+    are added.  Anything else is taken from `right`.
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if isinstance(left, dict):
+        merged = dict(left)
+        for key, value in right.items():
+            merged[key] = merge(left.get(key), value)
+        return merged
+    if isinstance(left, list):
+        size = max(len(left), len(right))
+        left = left + [0] * (size - len(left))
+        right = right + [0] * (size - len(right))
+        return [merge(l, r) for l, r in zip(left, right)]
+    if isinstance(left, (int, float)) and isinstance(right, (int, float)):
+        return left + right
+    return right
+
+
+class Part:
+    """The part of a listing read by node `index` of `count`, `ids` being
+    the ids of all the items in the order of the listing"""
+
+    def __init__(self, ids, index, count):
+        start = len(ids) * index // count
+        end = len(ids) * (index + 1) // count
+        # where the listing of the part starts, after this id
+        self.marker = ids[start - 1] if start else None
+        self.first = index == 0
+        self.listed = set(ids)
+        self.owned = set(ids[start:end])
+
+    def owns(self, item_id):
+        """Whether an item is in the part, the ones created since the
+        listing of the ids being in the first part"""
+        if item_id in self.owned:
+            return True
+        return self.first and item_id not in self.listed
+
+    def take(self, items):
+        """The items of a listing started after the marker, up to the
+        first one of a later part"""
+        for item in items:
+            if item.id in self.listed and item.id not in self.owned:
+                # no more page of the listing
+                if hasattr(items, 'close'):
+                    items.close()
+                return
+            yield item
+
+
+def pages(list_page, search_opts, limit=1000):
+    """Items of a listing of a client library, read page by page from
+    the marker of `search_opts`.  `list_page` returns the items, with an
+    `id`, of the page of some search options."""
+    search_opts = dict(search_opts, limit=limit)
+    while True:
+        page = list_page(search_opts)
+        for item in page:
+            yield item
+        if len(page) < limit:
+            return
+        search_opts['marker'] = page[-1].id
+
+
+class LocalTransport:
+    """In process transport, for tests and the command line tool."""
+
+    _partials = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        pass
+
+    def publish(self, name, index, stamp, partial):
+        with self._lock:
+            self._partials[(name, index)] = (stamp, partial)
+
+    def fetch(self, name, index):
+        with self._lock:
+            return self._partials.get((name, index))
+
+
+class FileTransport:
+    """One pickle file per collector and shard in a shared directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _partial_file(self, name, index):
+        return os.path.join(self.path, "%s.%d.partial" % (name, index))
+
+    def publish(self, name, index, stamp, partial):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.partial')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((stamp, partial), f, 2)
+        # rename is atomic, readers never see a partial file
+        os.rename(tmp, self._partial_file(name, index))
+
+    def fetch(self, name, index):
+        try:
+            with open(self._partial_file(name, index), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError):
+            return None
+
+
+TRANSPORTS = {
+    'local': LocalTransport,
+    'file': FileTransport,
+}
+
+
+class Sharding:
+    """Partition of the work of one collector"""
+
+    def __init__(self, name, index, count, transport, interval=10,
+                 timeout=None, clock=time.time):
+        self.name = name
+        self.index = index
+        self.count = count
+        self.transport = transport
+        self.interval = interval
+        self.timeout = interval / 2.0 if timeout is None else timeout
+        self.clock = clock
+        self.missing = []
+
+    def part(self, ids):
+        """The Part of this node of a listing of `ids`"""
+        return Part(ids, self.index, self.count)
+
+    def is_merger(self):
+        return self.index == 0
+
+    def exchange(self, partial):
+        """Publish the local partial aggregate.
+
+        On the merger node, return the merged aggregate of its partial
+        and of the last ones of the other nodes, published at most an
+        interval and the timeout ago.  None is returned on the other
+        nodes, and on the merger when some shards are missing; their
+        indexes are then listed in `missing`.
+        """
+        now = self.clock()
+        self.transport.publish(self.name, self.index, now, partial)
+        if not self.is_merger():
+            return None
+        oldest = now - self.interval - self.timeout
+        partials = {self.index: partial}
+        for index in range(self.count):
+            if index == self.index:
+                continue
+            published = self.transport.fetch(self.name, index)
+            if published is not None and published[0] >= oldest:
+                partials[index] = published[1]
+        self.missing = [i for i in range(self.count) if i not in partials]
+        if self.missing:
+            return None
+        merged = None
+        for index in range(self.count):
+            merged = merge(merged, partials[index])
+        return merged
+
+
+def parse_config(node):
+    """Parse a <Sharding> configuration block"""
+    conf = {
+        'index': None,
+        'count': None,
+        'transport': 'file',
+        'path': None,
+        'interval': None,
+        'timeout': None,
+    }
+    for child in node.children:
+        if child.key == 'Index':
+            conf['index'] = int(child.values[0])
+        elif child.key == 'Count':
+            conf['count'] = int(child.values[0])
+        elif child.key == 'Transport':
+            conf['transport'] = child.values[0]
+        elif child.key == 'Path':
+            conf['path'] = child.values[0]
+        elif child.key == 'Interval':
+            conf['interval'] = float(child.values[0])
+        elif child.key == 'Timeout':
+            conf['timeout'] = float(child.values[0])
+        else:
+            raise ValueError("Unknown Sharding key: %s" % child.key)
+    if conf['count'] is None or conf['count'] < 1:
+        raise ValueError("Sharding Count must be a positive number")
+    if conf['index'] is None or not 0 <= conf['index'] < conf['count']:
+        raise ValueError("Sharding Index must be between 0 and Count - 1")
+    if conf['transport'] not in TRANSPORTS:
+        raise ValueError("Unknown Sharding transport: %s, must be one of %s"
+                         % (conf['transport'], ', '.join(sorted(TRANSPORTS))))
+    if conf['transport'] == 'file' and not conf['path']:
+        raise ValueError("Sharding Path not defined")
+    return conf
+
+
+def sharding_from_config(name, conf, schedule=None):
+    """Sharding of the collector `name`, over the interval of its
+    `schedule` configuration unless one is set"""
+    interval = conf['interval']
+    if interval is None and schedule:
+        interval = schedule['max_interval'] or schedule['interval']
+    transport = TRANSPORTS[conf['transport']](conf['path'])
+    return Sharding(name, conf['index'], conf['count'], transport,
+                    interval=interval or 10, timeout=conf['timeout'])
@@ -0,0 +1,332 @@
+# -*- encoding: utf-8 -*-
+#
+# Memory mapped snapshots of the dispatched values
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Snapshots of the values of a collector in a memory mapped file.
+
+The values dispatched by a read reach the collectd side of a worker,
+and the tools reading the current values without calling the APIs,
+through a file mapped in memory, on /dev/shm when there is one.
+
+The file has a fixed layout:
+
+* a header, see `HEADER`;
+* the schema: the identity (plugin, type, type instance, plugin
+  instance, host) and the number of values of each slot, as JSON;
+* the slots: the number of the snapshot that last wrote the slot, the
+  time and the values, as doubles.
+
+A slot is allocated at the first write of an identity, then updated in
+place: after the first reads, a snapshot only writes numbers, no
+pickling of the nested stats.  When the schema or the slots outgrow
+the file, a bigger one replaces it, with only the slots of the last
+snapshot, and the old one is marked as retired.
+
+A snapshot is written under a sequence lock: the sequence number of
+the header is odd while the writer updates the file.  A reader reads
+the slots between two reads of the sequence number and starts again
+when they differ or when it was odd, without ever blocking the writer.
+The slots not written by the last snapshot, the images deleted since
+for example, are not read.
+
+    python -m collectd_openstack.shm /dev/shm/collectd-openstack/...
+
+prints the current snapshot of a file.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+MAGIC = b'COSS'
+FORMAT = 1
+
+# magic, format, sequence, snapshot, generation of the schema, retired,
+# slots, size of the schema, capacity of the schema, offset of the
+# slots, time of the last snapshot
+HEADER = struct.Struct('<4sIQQIIIIIId')
+HEADER_SIZE = 64
+SEQUENCE_OFFSET = 8
+RETIRED_OFFSET = 28
+SLOT = struct.Struct('<Qd')
+
+DEFAULT_SLOTS = 1024
+# bytes of schema reserved per slot
+SCHEMA_PER_SLOT = 96
+
+
+def default_directory():
+    """Directory of the snapshots, in memory when possible"""
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/collectd-openstack'
+    return os.path.join(tempfile.gettempdir(), 'collectd-openstack')
+
+
+class SnapshotWriter:
+    """Writer of the snapshots of `path`, with room for `slots` slots"""
+
+    def __init__(self, path, slots=DEFAULT_SLOTS):
+        self.path = path
+        self.capacity = slots
+        # identity -> offset and struct of the slot
+        self.slots = {}
+        self.schema = []
+        self.end = 0
+        self.snapshot = 0
+        self.generation = 0
+        self.file = None
+        self.map = None
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._create([])
+
+    def _layout(self, capacity):
+        schema_capacity = capacity * SCHEMA_PER_SLOT
+        return schema_capacity, HEADER_SIZE + schema_capacity
+
+    def _create(self, identities):
+        """Replace the file by a new one with the slots of `identities`"""
+        capacity = self.capacity
+        needed = sum(SLOT.size + 8 * identity[-1] for identity in identities)
+        while capacity * (SLOT.size + 8) < needed or \
+                len(json.dumps(identities)) > capacity * SCHEMA_PER_SLOT:
+            capacity *= 2
+        self.capacity = capacity
+        schema_capacity, values_offset = self._layout(capacity)
+        # a slot of 4 values on average
+        size = values_offset + capacity * (SLOT.size + 32) + needed
+        temporary = self.path + '.new'
+        f = open(temporary, 'w+b')
+        f.truncate(size)
+        new_map = mmap.mmap(f.fileno(), size)
+        self.generation += 1
+        self.slots = {}
+        self.schema = []
+        self.end = values_offset
+        self.schema_capacity = schema_capacity
+        self.values_offset = values_offset
+        self.size = size
+        old_file, old_map = self.file, self.map
+        self.file, self.map = f, new_map
+        for identity in identities:
+            self._allocate(identity)
+        self._write_header(0, 0, schema=True)
+        os.rename(temporary, self.path)
+        if old_map is not None:
+            # the readers of the old file open the new one
+            struct.pack_into('<I', old_map, RETIRED_OFFSET, 1)
+            old_map.close()
+            old_file.close()
+
+    def _allocate(self, identity):
+        if identity in self.slots:
+            return
+        count = identity[-1]
+        self.slots[identity] = (self.end, struct.Struct('<Qd%dd' % count))
+        self.schema.append(list(identity))
+        self.end += SLOT.size + 8 * count
+
+    def _write_header(self, sequence, updated, schema=False):
+        if schema:
+            encoded = json.dumps(self.schema).encode('utf-8')
+            self.map[HEADER_SIZE:HEADER_SIZE + len(encoded)] = encoded
+            self.schema_size = len(encoded)
+        HEADER.pack_into(self.map, 0, MAGIC, FORMAT, sequence, self.snapshot,
+                         self.generation, 0, len(self.schema),
+                         self.schema_size, self.schema_capacity,
+                         self.values_offset, updated)
+
+    def write(self, records):
+        """Write a snapshot of records, the arguments of Dispatcher.add:
+        (values, plugin, type, type instance, plugin instance, host,
+        time)"""
+        identities = [record[1:6] + (len(record[0]),) for record in records]
+        new = [identity for identity in identities
+               if identity not in self.slots]
+        if new:
+            size = self.end + sum(SLOT.size + 8 * identity[-1]
+                                  for identity in new)
+            schema = len(json.dumps(self.schema + new))
+            if size > self.size or schema > self.schema_capacity:
+                self._create(identities)
+                new = []
+        sequence = struct.unpack_from('<Q', self.map, SEQUENCE_OFFSET)[0]
+        mapped = self.map
+        struct.pack_into('<Q', mapped, SEQUENCE_OFFSET, sequence + 1)
+        if new:
+            for identity in new:
+                self._allocate(identity)
+            self.generation += 1
+        self.snapshot += 1
+        snapshot = self.snapshot
+        # replaced when the file grew
+        slots = self.slots
+        for identity, record in zip(identities, records):
+            offset, slot = slots[identity]
+            slot.pack_into(mapped, offset, snapshot, record[6] or 0,
+                           *record[0])
+        self._write_header(sequence + 2, time.time(), schema=bool(new))
+        return snapshot
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+
+class SnapshotReader:
+    """Reader of the snapshots of `path`"""
+
+    def __init__(self, path, timeout=1):
+        self.path = path
+        self.timeout = timeout
+        self.file = None
+        self.map = None
+        self.generation = None
+        self.layout = []
+        self.snapshot = 0
+        self.updated = 0
+        self._open()
+
+    def _open(self):
+        self.close()
+        self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != MAGIC:
+            raise ValueError("%s is not a snapshot file" % self.path)
+        self.generation = None
+
+    def _schema(self, header):
+        """(offset, struct, names) of the slots of the schema of the
+        header, the names being the ones of the records"""
+        schema = json.loads(self.map[HEADER_SIZE:HEADER_SIZE + header[7]]
+                            .decode('utf-8'))
+        layout = []
+        offset = header[9]
+        for identity in schema:
+            count = identity[-1]
+            layout.append((offset, struct.Struct('<Qd%dd' % count),
+                           tuple(identity[:-1])))
+            offset += SLOT.size + 8 * count
+        return layout
+
+    def changed(self):
+        """Whether a snapshot was written since the last read"""
+        header = HEADER.unpack_from(self.map, 0)
+        return bool(header[5]) or header[3] != self.snapshot or \
+            self.generation is None
+
+    def read(self):
+        """The records of the last snapshot, like SnapshotWriter.write
+        takes them"""
+        deadline = time.time() + self.timeout
+        retry = False
+        while not retry or time.time() < deadline:
+            if retry:
+                # let the writer end its snapshot
+                time.sleep(0.001)
+            retry = True
+            header = HEADER.unpack_from(self.map, 0)
+            if header[5]:
+                self._open()
+                continue
+            sequence = header[2]
+            if sequence % 2:
+                continue
+            try:
+                if header[4] != self.generation:
+                    layout = self._schema(header)
+                else:
+                    layout = self.layout
+                records = []
+                append = records.append
+                snapshot = header[3]
+                mapped = self.map
+                for offset, slot, names in layout:
+                    values = slot.unpack_from(mapped, offset)
+                    if values[0] != snapshot:
+                        continue
+                    # doubles, collectd makes ints of the counters
+                    append((list(values[2:]),) + names + (values[1],))
+            except (ValueError, struct.error):
+                # a schema being written
+                continue
+            if struct.unpack_from('<Q', self.map,
+                                  SEQUENCE_OFFSET)[0] == sequence:
+                self.generation, self.layout = header[4], layout
+                self.snapshot, self.updated = snapshot, header[10]
+                return records
+        raise RuntimeError("No consistent snapshot in %s in %ss" %
+                           (self.path, self.timeout))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+
+def parse_config(node):
+    """Parse a <Snapshot> configuration block"""
+    conf = {
+        'path': None,
+        'slots': DEFAULT_SLOTS,
+    }
+    for child in node.children:
+        if child.key == 'Path':
+            conf['path'] = child.values[0]
+        elif child.key == 'Slots':
+            conf['slots'] = int(child.values[0])
+        else:
+            raise ValueError("Unknown Snapshot key: %s" % child.key)
+    return conf
+
+
+def writer_from_config(name, conf):
+    """Writer of the snapshots of the plugin `name`"""
+    path = conf['path'] or os.path.join(default_directory(),
+                                        "%s.snapshot" % name)
+    return SnapshotWriter(path, slots=conf['slots'])
+
+
+def main(args):
+    if not args or args[0] in ('-h', '--help'):
+        print("usage: python -m collectd_openstack.shm SNAPSHOT_FILE...")
+        return 2
+    for path in args:
+        reader = SnapshotReader(path)
+        records = reader.read()
+        print("%s: snapshot %d, %d values, written %.1fs ago" % (
+            path, reader.snapshot, len(records),
+            time.time() - reader.updated))
+        for values, plugin, type_name, type_instance, plugin_instance, \
+                host, date in records:
+            print("%s: %s.%s-%s.%s-%s = %s" % (
+                date, host, plugin, plugin_instance, type_name,
+                type_instance, values))
+        reader.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,122 @@
+# -*- encoding: utf-8 -*-
+#
+# Heavy hitters in bounded memory
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Per tenant usage with a fixed number of metrics.
+
+`TopK` finds the heaviest keys of a weighted stream with the Misra-Gries
+algorithm: when it has more than 2 * capacity counters, it subtracts
+the capacity-th largest count from all of them and forgets the ones left
+at zero.  A key weighing more than total /
+capacity is always kept, and its count is at most total / capacity
+under the real one.  The whole weight is kept, `top()` reports the k
+heaviest keys and the rest of the weight in an `other` bucket, so the
+values dispatched always add up to the real total.
+
+A key can carry several weights, one per resource (servers, vcpus, ...)
+of a tenant: they share one counter list so that the loop over a listing
+only does one lookup per record, and each resource is shrunk on its own.
+A method call per record costs more than the rest of the loop of a
+plugin: the loops update the lists of `counters` in place and only call
+`insert` for the keys they have not seen, the shrinks happening there.
+Up to capacity keys can stay for each resource, so the shrink waits for
+(width + 1) * capacity counters to free at least capacity of them.
+`Usage` names these resources.
+"""
+import heapq
+from operator import itemgetter
+
+OTHER = 'other'
+
+
+class TopK:
+    """The k heaviest keys of a stream of `width` weights per key"""
+
+    def __init__(self, k, width=1, capacity=None):
+        self.k = k
+        self.width = width
+        self.capacity = max(capacity or 64 * k, k, 1)
+        self.limit = (width + 1) * self.capacity
+        self.counters = {}
+        # weight subtracted by the shrinks, part of the totals
+        self.removed = [0] * width
+
+    def add(self, key, *weights):
+        counts = self.counters.get(key)
+        if counts is None:
+            self.insert(key, list(weights))
+        else:
+            for i, weight in enumerate(weights):
+                counts[i] += weight
+
+    def insert(self, key, counts):
+        """Count the list `counts` of a new key, updated in place by the
+        next records of the key"""
+        self.counters[key] = counts
+        if len(self.counters) > self.limit:
+            self._shrink()
+
+    def _shrink(self):
+        # in place, the loops hold the dict
+        counters = self.counters
+        columns = list(zip(*counters.values()))
+        cuts = [sorted(column)[-self.capacity - 1] for column in columns]
+        for i, cut in enumerate(cuts):
+            self.removed[i] += sum(min(count, cut) for count in columns[i])
+        for key, counts in list(counters.items()):
+            for i, cut in enumerate(cuts):
+                counts[i] = counts[i] - cut if counts[i] > cut else 0
+            if not any(counts):
+                del counters[key]
+
+    def total(self, index=0):
+        return self.removed[index] + sum(counts[index]
+                                         for counts in self.counters.values())
+
+    def top(self, index=0):
+        """{key: weight} of the k heaviest keys, and of OTHER"""
+        result = dict(heapq.nlargest(
+            self.k, ((key, counts[index])
+                     for key, counts in self.counters.items()
+                     if counts[index]),
+            key=itemgetter(1)))
+        result[OTHER] = self.total(index) - sum(result.values())
+        return result
+
+
+def trim(top, k):
+    """Keep the k heaviest keys of merged top() results"""
+    other = top.get(OTHER, 0)
+    keys = [(key, weight) for key, weight in top.items() if key != OTHER]
+    result = dict(heapq.nlargest(k, keys, key=itemgetter(1)))
+    result[OTHER] = other + sum(weight for _, weight in keys) - \
+        sum(result.values())
+    return result
+
+
+class Usage(TopK):
+    """Top k tenants of several resources"""
+
+    def __init__(self, k, resources, capacity=None):
+        TopK.__init__(self, k, len(resources), capacity)
+        self.resources = resources
+
+    def top(self):
+        """{resource: top()} of each resource"""
+        return dict((resource, TopK.top(self, index))
+                    for index, resource in enumerate(self.resources))
@@ -0,0 +1,158 @@
+# -*- encoding: utf-8 -*-
+#
+# collectd types of the plugins
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Definitions of the types dispatched by the plugins.
+
+Each plugin lists the collectd types it dispatches in a module level
+`TYPES`.  A stats group with a fixed set of keys, like a status
+histogram, is dispatched as one multi-value record of a type with one
+data source per key instead of one value per key.  The share/*-types.db
+files are generated from these definitions by bin/collectd-types.py.
+"""
+import os
+import re
+
+# collectd limit, rrdtool only accepts 19 characters
+DS_NAME = re.compile(r'^[A-Za-z0-9_]{1,63}$')
+
+# Value of the data sources missing from a stats group, unknown to collectd
+UNKNOWN = float('nan')
+
+
+class Type:
+    """A collectd type.
+
+    `sources` lists the data sources, each one either a key of the stats
+    group or a (data source name, key) pair.  Keys not listed are summed
+    in the `other` data source when it is set, the missing ones take the
+    `default` value.  `stats_key` is the key of the group in the stats
+    of the plugin, the type name by default.
+    """
+
+    def __init__(self, name, sources=('value',), ds_type='GAUGE',
+                 minimum=0, maximum=None, other=None, stats_key=None,
+                 default=UNKNOWN):
+        self.name = name
+        self.default = default
+        self.stats_key = stats_key or name
+        self.ds_names = []
+        self.keys = []
+        for source in sources:
+            if isinstance(source, tuple):
+                ds_name, key = source
+            else:
+                ds_name = key = source
+            self.ds_names.append(ds_name)
+            self.keys.append(key)
+        self.other = other
+        if other:
+            self.ds_names.append(other)
+        for ds_name in self.ds_names:
+            if not DS_NAME.match(ds_name):
+                raise ValueError("Invalid data source name %r in type %s"
+                                 % (ds_name, name))
+        self.ds_type = ds_type
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def values(self, group):
+        """Values of the data sources, from a dict or a list"""
+        if isinstance(group, dict):
+            values = [group.get(key, self.default) for key in self.keys]
+            if self.other:
+                keys = set(self.keys)
+                values.append(sum(value for key, value in group.items()
+                                  if key not in keys))
+            return values
+        # Pad the lists of the stats that can miss their last values
+        values = list(group)
+        return values + [self.default] * (len(self.ds_names) - len(values))
+
+    def line(self, width=0):
+        """The line of the type in a types.db file"""
+        bound = lambda b: b is None and 'U' or str(b)
+        return "%-*s %s" % (width, self.name, ", ".join(
+            "%s:%s:%s:%s" % (ds_name, self.ds_type, bound(self.minimum),
+                             bound(self.maximum))
+            for ds_name in self.ds_names))
+
+    def __eq__(self, other):
+        return self.line() == other.line()
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class Types:
+    """The types of a plugin, written to share/<db>-types.db"""
+
+    def __init__(self, db, types):
+        self.db = db
+        self.types = list(types)
+        self.by_name = dict((t.name, t) for t in self.types)
+        self.by_stats_key = dict((t.stats_key, t) for t in self.types)
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def __iter__(self):
+        return iter(self.types)
+
+    def group(self, key, value):
+        """Type name and value to dispatch for the stats group `key`.
+
+        Groups without a multi-value type are returned unchanged, a dict
+        is then dispatched as one value per key.
+        """
+        type_ = self.by_stats_key.get(key)
+        if type_ is None:
+            return key, value
+        if len(type_.ds_names) == 1 and not isinstance(value, (list, tuple)):
+            return type_.name, value
+        return type_.name, type_.values(value)
+
+
+
+def _bound(text):
+    if text == 'U':
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def load(path):
+    """The Types of a types.db file, named after it"""
+    db = os.path.basename(path)
+    if db.endswith('-types.db'):
+        db = db[:-len('-types.db')]
+    types = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split(None, 1)
+            if not fields or fields[0].startswith('#'):
+                continue
+            sources = [source.strip().split(':')
+                       for source in fields[1].split(',')]
+            minimum, maximum = [_bound(b) for b in sources[0][2:4]]
+            types.append(Type(fields[0], [source[0] for source in sources],
+                              ds_type=sources[0][1], minimum=minimum,
+                              maximum=maximum))
+    return Types(db, types)
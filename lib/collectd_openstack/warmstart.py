@@ -0,0 +1,122 @@
+# -*- encoding: utf-8 -*-
+#
+# Plugin state persisted across collectd restarts
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Warm start snapshots.
+
+A plugin periodically saves its last stats and the reference data it
+built (images, flavors, ...) in a SQLite database.  At init, the
+snapshot is loaded back if it was written by the same version of the
+plugin and is recent enough, so the first read can dispatch without
+waiting for the APIs.
+"""
+import pickle
+import sqlite3
+import time
+import zlib
+
+# Bump when the layout of the saved states changes
+FORMAT = 6
+
+
+class WarmStart:
+    """Snapshot of one plugin in a database shared by all the plugins"""
+
+    def __init__(self, path, name, version, max_age=300, save_interval=60):
+        self.path = path
+        self.name = name
+        self.version = "%d:%s" % (FORMAT, version)
+        self.max_age = max_age
+        self.save_interval = save_interval
+        self.last_save = 0
+        connection = self._connect()
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                               "name TEXT PRIMARY KEY, "
+                               "version TEXT, "
+                               "saved REAL, "
+                               "data BLOB)")
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def load(self):
+        """Return the saved state, None if missing, stale or outdated"""
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT version, saved, data FROM snapshots WHERE name = ?",
+                (self.name,)).fetchone()
+        finally:
+            connection.close()
+        if not row:
+            return None
+        version, saved, data = row
+        if version != self.version or time.time() - saved > self.max_age:
+            return None
+        state = pickle.loads(zlib.decompress(bytes(data)))
+        state['age'] = time.time() - saved
+        return state
+
+    def save(self, state, force=False):
+        """Save the state, at most once per save_interval unless forced"""
+        now = time.time()
+        if not force and now - self.last_save < self.save_interval:
+            return False
+        data = zlib.compress(pickle.dumps(state, 2))
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO snapshots (name, version, saved, data) "
+                "VALUES (?, ?, ?, ?)",
+                (self.name, self.version, now, sqlite3.Binary(data)))
+            connection.commit()
+        finally:
+            connection.close()
+        self.last_save = now
+        return True
+
+
+def parse_config(node):
+    """Parse a <WarmStart> configuration block"""
+    conf = {
+        'path': None,
+        'max_age': 300,
+        'save_interval': 60,
+    }
+    for child in node.children:
+        if child.key == 'Path':
+            conf['path'] = child.values[0]
+        elif child.key == 'MaxAge':
+            conf['max_age'] = float(child.values[0])
+        elif child.key == 'SaveInterval':
+            conf['save_interval'] = float(child.values[0])
+        else:
+            raise ValueError("Unknown WarmStart key: %s" % child.key)
+    if not conf['path']:
+        raise ValueError("WarmStart Path not defined")
+    return conf
+
+
+def warmstart_from_config(name, version, conf):
+    return WarmStart(conf['path'], name, version,
+                     max_age=conf['max_age'],
+                     save_interval=conf['save_interval'])
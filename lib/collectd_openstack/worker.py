@@ -0,0 +1,375 @@
+# -*- encoding: utf-8 -*-
+#
+# Reads of a plugin made by a worker process
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Out of process reads.
+
+All the python plugins of collectd share one interpreter, and its
+global lock: while collectd-instances-stats parses and counts 100000
+servers, the other python plugins of the node wait.
+
+With a <Worker> block, the plugin only starts a `Worker`: a python
+process running the plugin script with a stand-in of the collectd
+module, see `main`.  The worker gets the configuration of the plugin,
+then makes the reads when asked.  The values it dispatched are written
+to a memory mapped snapshot, see `shm`, and the messages it logged are
+sent back.  The collectd side only reads the snapshot and dispatches its
+values, a few hundred for the biggest clouds.
+
+The messages are JSON lines on the pipes of the worker.  A worker that
+exits, or does not answer a read within `timeout` seconds, is killed
+and started again at the next read, after a delay growing with the
+consecutive failures, see `resilience.Backoff`.  Its restarts and
+memory are dispatched as `worker` records.
+"""
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+import traceback
+
+from collectd_openstack import resilience
+from collectd_openstack import shm
+from collectd_openstack import typesdb
+
+TYPES = typesdb.Types('metering', [
+    typesdb.Type('worker', ['restarts', 'max_rss']),
+])
+
+LEVELS = ('debug', 'info', 'notice', 'warning', 'error')
+
+
+class WorkerError(Exception):
+    pass
+
+
+def dump_config(node, skip=('Worker', 'Schedule', 'Exposition')):
+    """[key, values, children] trees of the children of a configuration
+    node, without the `skip` ones.  The collectd side schedules the
+    reads and serves the scrapes."""
+    return [[child.key, list(child.values), dump_config(child, ())]
+            for child in node.children if child.key not in skip]
+
+
+class Node:
+    """Configuration node of a dumped tree, like the collectd ones"""
+
+    def __init__(self, key, values, children):
+        self.key = key
+        self.values = tuple(values)
+        self.children = [Node(*child) for child in children]
+
+
+def default_python():
+    """The interpreter of collectd, when it is a python one"""
+    if os.path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+    return 'python'
+
+
+class Worker:
+    """Worker process making the reads of the plugin `script`.
+
+    `config` is the dumped configuration of the plugin, the messages
+    logged by the worker are logged with `collectd`.  The values of the
+    reads go through the snapshot file `snapshot`.
+    """
+
+    def __init__(self, script, config, collectd, python=None, timeout=60,
+                 backoff=None, clock=time.time, snapshot=None):
+        # collectd imports the plugins, they may be compiled
+        if script.endswith(('.pyc', '.pyo')):
+            script = script[:-1]
+        self.script = os.path.abspath(script)
+        self.config = config
+        self.collectd = collectd
+        self.python = python or default_python()
+        self.timeout = timeout
+        self.backoff = backoff or resilience.Backoff(base=1, cap=300,
+                                                     floor=0.5)
+        self.clock = clock
+        self.process = None
+        self.buffer = b''
+        self.failures = 0
+        self.restarts = 0
+        self.start_at = 0
+        self.max_rss = 0
+        self.snapshot = snapshot or os.path.join(
+            shm.default_directory(), 'worker-%s-%d.snapshot' % (
+                os.path.splitext(os.path.basename(self.script))[0],
+                os.getpid()))
+        self.reader = None
+
+    def _spawn(self):
+        env = dict(os.environ)
+        # the package next to the plugins
+        lib = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [lib] + [p for p in [env.get('PYTHONPATH')] if p])
+        self.process = subprocess.Popen(
+            [self.python, '-m', 'collectd_openstack.worker', self.script],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+            close_fds=True)
+        self.buffer = b''
+        self._call({'op': 'configure', 'config': self.config,
+                    'snapshot': self.snapshot})
+        # a new worker replaces the snapshot file
+        if self.reader is not None:
+            self.reader.close()
+        self.reader = shm.SnapshotReader(self.snapshot)
+
+    def _send(self, message):
+        self.process.stdin.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.process.stdin.flush()
+
+    def _receive(self):
+        """The next message, within the timeout"""
+        fd = self.process.stdout.fileno()
+        deadline = self.clock() + self.timeout
+        while b'\n' not in self.buffer:
+            left = deadline - self.clock()
+            if left <= 0 or not select.select([fd], [], [], left)[0]:
+                raise WorkerError("No answer from the worker of %s in %ss"
+                                  % (self.script, self.timeout))
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise WorkerError("The worker of %s exited with status %s" %
+                                  (self.script, self.process.wait()))
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def _call(self, message):
+        """Send a message and return the answer, after relaying the
+        messages logged meanwhile.  A worker failing to answer is
+        killed and WorkerError raised."""
+        try:
+            self._send(message)
+            answer = self._receive()
+        except (EnvironmentError, ValueError, WorkerError) as e:
+            self._kill()
+            if isinstance(e, WorkerError):
+                raise
+            raise WorkerError("Lost the worker of %s: %s" % (self.script, e))
+        for level, text in answer.get('logs', ()):
+            # the collectd of collectd-cli.py only logs info and warning
+            log = getattr(self.collectd, level, None) or self.collectd.info
+            log(text)
+        self.max_rss = answer.get('max_rss', self.max_rss)
+        if 'error' in answer:
+            raise WorkerError(answer['error'])
+        return answer
+
+    def _kill(self):
+        """Kill the worker, it is started again after a delay"""
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+        self.failures += 1
+        self.start_at = self.clock() + self.backoff.delay(self.failures - 1)
+
+    def read(self):
+        """The values dispatched by a read of the worker, as arguments of
+        `Dispatcher.add`, None while waiting to restart the worker"""
+        if self.process is not None and self.process.poll() is not None:
+            # exited between two reads
+            self._kill()
+        if self.process is None:
+            if self.clock() < self.start_at:
+                return None
+            if self.failures:
+                self.restarts += 1
+            try:
+                self._spawn()
+            except WorkerError:
+                # killed already when it did not answer
+                if self.process is not None:
+                    self._kill()
+                raise
+            except Exception as e:
+                self._kill()
+                raise WorkerError("Cannot start the worker of %s: %s" %
+                                  (self.script, e))
+        snapshot = self._call({'op': 'read'})['snapshot']
+        values = self.reader.read()
+        if self.reader.snapshot != snapshot:
+            raise WorkerError("Snapshot %s of the worker of %s read instead "
+                              "of %s" % (self.reader.snapshot, self.script,
+                                         snapshot))
+        self.failures = 0
+        return values
+
+    def metrics(self):
+        """[restarts, peak memory of the worker in bytes]"""
+        return [self.restarts, self.max_rss]
+
+    def stop(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+            os.remove(self.snapshot)
+
+
+def parse_config(node):
+    """Parse a <Worker> configuration block"""
+    conf = {
+        'python': None,
+        'timeout': 60,
+        'restart_delay': 1,
+        'max_restart_delay': 300,
+        'snapshot': None,
+    }
+    for child in node.children:
+        if child.key == 'Python':
+            conf['python'] = child.values[0]
+        elif child.key == 'Timeout':
+            conf['timeout'] = float(child.values[0])
+        elif child.key == 'RestartDelay':
+            conf['restart_delay'] = float(child.values[0])
+        elif child.key == 'MaxRestartDelay':
+            conf['max_restart_delay'] = float(child.values[0])
+        elif child.key == 'Snapshot':
+            conf['snapshot'] = child.values[0]
+        else:
+            raise ValueError("Unknown Worker key: %s" % child.key)
+    return conf
+
+
+def worker_from_config(script, config, conf, collectd):
+    """Worker of the plugin `script`, configured with the dumped
+    `config`"""
+    return Worker(script, config, collectd, python=conf['python'],
+                  timeout=conf['timeout'],
+                  backoff=resilience.Backoff(base=conf['restart_delay'],
+                                             cap=conf['max_restart_delay'],
+                                             floor=0.5),
+                  snapshot=conf['snapshot'])
+
+
+class Recorder:
+    """Stand-in of the collectd module in the worker, recording the
+    dispatched values and the logged messages"""
+
+    def __init__(self):
+        self.callbacks = {}
+        self.values = []
+        self.logs = []
+        for level in LEVELS:
+            setattr(self, level, self._logger(level))
+
+    def _logger(self, level):
+        def log(message):
+            self.logs.append((level, message))
+        return log
+
+    def register_config(self, function):
+        self.callbacks['config'] = function
+
+    def register_init(self, function):
+        self.callbacks['init'] = function
+
+    def register_read(self, function, *args, **kwargs):
+        self.callbacks['read'] = function
+
+    def register_shutdown(self, function):
+        self.callbacks['shutdown'] = function
+
+    def Values(self, **args):
+        return Values(self)
+
+    def pop(self):
+        """Values and messages recorded since the last call"""
+        values, self.values = self.values, []
+        logs, self.logs = self.logs, []
+        return values, logs
+
+
+class Values:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.host = ''
+        self.plugin = ''
+        self.plugin_instance = ''
+        self.type = ''
+        self.type_instance = ''
+        self.time = 0
+        self.values = []
+
+    def dispatch(self):
+        self.recorder.values.append(
+            (list(self.values), self.plugin, self.type, self.type_instance,
+             self.plugin_instance, self.host, self.time))
+
+
+def max_rss():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main(script):
+    """Serve the reads of the plugin `script` on stdin and stdout"""
+    # the answers only, the plugins may print
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    recorder = Recorder()
+    writer = None
+    namespace = {'__name__': '__main__', '__file__': script,
+                 'collectd': recorder}
+    with open(script) as f:
+        exec(compile(f.read(), script, 'exec'), namespace)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        message = json.loads(line)
+        answer = {}
+        try:
+            if message['op'] == 'configure':
+                recorder.callbacks['config'](Node(None, (), message['config']))
+                recorder.callbacks['init']()
+                writer = shm.SnapshotWriter(message['snapshot'])
+            elif message['op'] == 'read':
+                recorder.callbacks['read']()
+        except Exception as e:
+            recorder.debug(traceback.format_exc())
+            answer['error'] = str(e)
+        values, answer['logs'] = recorder.pop()
+        if writer is not None and message['op'] == 'read' and \
+                'error' not in answer:
+            answer['snapshot'] = writer.write(values)
+        answer['max_rss'] = max_rss()
+        output.write(json.dumps(answer).encode('utf-8') + b'\n')
+        output.flush()
+    if 'shutdown' in recorder.callbacks:
+        recorder.callbacks['shutdown']()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
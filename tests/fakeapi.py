@@ -0,0 +1,480 @@
+# -*- encoding: utf-8 -*-
+#
+# Stand-in of the OpenStack APIs for the tests and the benchmarks
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Synthetic listings shaped like the ones of a real cloud.
+
+The records carry all the fields the APIs return, not only the ones
+the collectors read, so that parsing costs are realistic.
+
+`FakeAPI` serves them over HTTP, paginated like the real APIs when a
+`limit` is given, from the record after the id of the `marker`, and
+filtered on the tenant of the `tenant_id` or `project_id` option.  The
+listings without the details only carry the summary fields.  They are
+gzip compressed when the client accepts it, and at a
+limited bandwidth to look like a remote API.  A latency can be added
+to the answers, the time a real API takes to build a listing, and the
+number of requests answered at once limited, like the workers of a real
+API, the other requests waiting for their turn.  Faults can be
+injected: the next requests hang or fail with a 5xx error.
+"""
+import bisect
+import gzip
+import io
+import json
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+
+SERVER_STATUSES = ['ACTIVE'] * 8 + ['SHUTOFF', 'ERROR']
+VOLUME_STATUSES = ['available', 'in-use', 'in-use', 'error']
+
+
+def _uuid(kind, i):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "%s/%d" % (kind, i)))
+
+
+def server(i, tenants=100, flavors=10, images=20):
+    server_id = _uuid('server', i)
+    return {
+        'id': server_id,
+        'name': 'server-%d' % i,
+        'status': SERVER_STATUSES[i % len(SERVER_STATUSES)],
+        'tenant_id': _uuid('tenant', i % tenants),
+        'user_id': _uuid('user', i % tenants),
+        'hostId': _uuid('host', i % 50).replace('-', ''),
+        'flavor': {
+            'id': str(i % flavors + 1),
+            'links': [{'href': 'http://nova:8774/flavors/%d' % (i % flavors + 1),
+                       'rel': 'bookmark'}],
+        },
+        'image': i % 5 and {
+            'id': _uuid('image', i % images),
+            'links': [{'href': 'http://nova:8774/images/%s' %
+                       _uuid('image', i % images), 'rel': 'bookmark'}],
+        } or '',
+        'addresses': {
+            'private': [{'addr': '10.0.%d.%d' % (i // 250 % 250, i % 250 + 2),
+                         'version': 4,
+                         'OS-EXT-IPS:type': 'fixed',
+                         'OS-EXT-IPS-MAC:mac_addr': 'fa:16:3e:00:%02x:%02x'
+                         % (i // 256 % 256, i % 256)}],
+        },
+        'metadata': {},
+        'key_name': 'key-%d' % (i % tenants),
+        'security_groups': [{'name': 'default'}],
+        'accessIPv4': '',
+        'accessIPv6': '',
+        'progress': 0,
+        'config_drive': '',
+        'created': '2014-06-01T10:00:00Z',
+        'updated': '2014-06-02T10:00:00Z',
+        'OS-DCF:diskConfig': 'MANUAL',
+        'OS-EXT-AZ:availability_zone': 'nova',
+        'OS-EXT-SRV-ATTR:host': 'compute-%d' % (i % 50),
+        'OS-EXT-SRV-ATTR:hypervisor_hostname': 'compute-%d.cloud' % (i % 50),
+        'OS-EXT-SRV-ATTR:instance_name': 'instance-%08x' % i,
+        'OS-EXT-STS:power_state': 1,
+        'OS-EXT-STS:task_state': None,
+        'OS-EXT-STS:vm_state': 'active',
+        'OS-SRV-USG:launched_at': '2014-06-01T10:01:00.000000',
+        'OS-SRV-USG:terminated_at': None,
+        'os-extended-volumes:volumes_attached': [],
+        'links': [{'href': 'http://nova:8774/v2/servers/%s' % server_id,
+                   'rel': 'self'}],
+    }
+
+
+def volume(i, tenants=100, volume_types=3):
+    volume_id = _uuid('volume', i)
+    status = VOLUME_STATUSES[i % len(VOLUME_STATUSES)]
+    return {
+        'id': volume_id,
+        'display_name': 'volume-%d' % i,
+        'display_description': None,
+        'status': status,
+        'size': i % 100 + 1,
+        'volume_type': 'type-%d' % (i % volume_types),
+        'bootable': i % 3 and 'false' or 'true',
+        'availability_zone': 'nova',
+        'snapshot_id': None,
+        'source_volid': None,
+        'metadata': {},
+        'created_at': '2014-06-01T10:00:00.000000',
+        'os-vol-host-attr:host': 'volume-%d@backend' % (i % 4),
+        'os-vol-tenant-attr:tenant_id': _uuid('tenant', i % tenants),
+        'attachments': status == 'in-use' and [{
+            'id': volume_id,
+            'volume_id': volume_id,
+            'server_id': _uuid('server', i),
+            'device': '/dev/vdb',
+            'host_name': None,
+        }] or [],
+    }
+
+
+def snapshot(i, volumes=1000):
+    return {
+        'id': _uuid('snapshot', i),
+        'display_name': 'snapshot-%d' % i,
+        'display_description': None,
+        'volume_id': _uuid('volume', i % volumes),
+        'status': i % 10 and 'available' or 'error',
+        'size': i % 100 + 1,
+        'created_at': '2014-06-01T10:00:00.000000',
+        'metadata': {},
+    }
+
+
+def hypervisor(i):
+    return {
+        'id': i,
+        'hypervisor_hostname': 'compute-%d.cloud' % i,
+        'hypervisor_type': 'QEMU',
+        'hypervisor_version': 2000000,
+        'host_ip': '192.168.%d.%d' % (i // 250, i % 250 + 2),
+        'service': {'host': 'compute-%d' % i, 'id': i + 10},
+        'cpu_info': '{"vendor": "Intel", "model": "SandyBridge"}',
+        'running_vms': 20,
+        'vcpus': 32,
+        'vcpus_used': 40,
+        'memory_mb': 262144,
+        'memory_mb_used': 163840,
+        'free_ram_mb': 98304,
+        'local_gb': 2000,
+        'local_gb_used': 800,
+        'free_disk_gb': 1200,
+        'disk_available_least': 1100,
+        'current_workload': i % 3,
+    }
+
+
+def stack(i, tenants=100):
+    return {
+        'id': _uuid('stack', i),
+        'stack_name': 'stack-%d' % i,
+        'description': 'A stack',
+        'stack_status': i % 10 and 'CREATE_COMPLETE' or 'CREATE_FAILED',
+        'stack_status_reason': 'Stack CREATE completed successfully',
+        'creation_time': '2014-06-01T10:00:00Z',
+        'updated_time': None,
+        'project': _uuid('tenant', i % tenants),
+        'links': [{'href': 'http://heat:8004/v1/stacks/%d' % i,
+                   'rel': 'self'}],
+    }
+
+
+RECORDS = {
+    'servers': server,
+    'volumes': volume,
+    'snapshots': snapshot,
+    'hypervisors': hypervisor,
+    'stacks': stack,
+}
+
+
+def instance_notification(i, event_type='compute.instance.update',
+                          state='active', tenants=100, flavors=10, images=20):
+    """Notification of a change of the server i, like the ones of nova"""
+    return {
+        'message_id': str(uuid.uuid4()),
+        'event_type': event_type,
+        'publisher_id': 'compute.compute-%d' % (i % 50),
+        'priority': 'INFO',
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S.000000',
+                                   time.gmtime()),
+        'payload': {
+            'instance_id': _uuid('server', i),
+            'display_name': 'server-%d' % i,
+            'tenant_id': _uuid('tenant', i % tenants),
+            'user_id': _uuid('user', i % tenants),
+            'state': state,
+            'instance_flavor_id': str(i % flavors + 1),
+            'image_meta': {
+                'base_image_ref': i % 5 and _uuid('image', i % images) or '',
+            },
+            'host': 'compute-%d' % (i % 50),
+        },
+    }
+
+
+def listing(key, count, start=0):
+    """A listing document of `count` records of kind `key`"""
+    record = RECORDS[key]
+    return {key: [record(i) for i in range(start, start + count)]}
+
+
+def record_id(key, i):
+    """The id of the record i of a listing, as in the markers"""
+    if key == 'hypervisors':
+        return str(i)
+    return _uuid(key[:-1], i)
+
+
+def summary(key, i, tenants=100):
+    """The record i of a listing without the details"""
+    if key == 'servers':
+        server_id = _uuid('server', i)
+        return {
+            'id': server_id,
+            'name': 'server-%d' % i,
+            'links': [{'href': 'http://nova:8774/v2/servers/%s' % server_id,
+                       'rel': 'self'}],
+        }
+    # the ones of cinder v1 only miss the fields of the extensions
+    return dict((field, value)
+                for field, value in RECORDS[key](i, tenants=tenants).items()
+                if not field.startswith('os-'))
+
+
+# Listing endpoints served by FakeAPI, by the last elements of their
+# path, and whether they are detailed
+ENDPOINTS = {
+    'servers/detail': ('servers', True),
+    'servers': ('servers', False),
+    'volumes/detail': ('volumes', True),
+    'volumes': ('volumes', False),
+    'snapshots/detail': ('snapshots', True),
+    'snapshots': ('snapshots', False),
+    'os-hypervisors/detail': ('hypervisors', True),
+    'stacks': ('stacks', True),
+}
+
+# Listings of the records of the tenants
+TENANT_RECORDS = ('servers', 'volumes', 'stacks')
+
+
+def gzip_compress(data, level=6):
+    buf = io.BytesIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        fault = self.server.next_fault()
+        if fault:
+            kind, value = fault
+            if kind == 'hang':
+                with self.server.lock:
+                    self.server.hanging.append(threading.current_thread())
+                if self.server.stopping.wait(value):
+                    # stopped while hanging, do not answer
+                    self.close_connection = True
+                    return
+            else:
+                self.send_error(value)
+                return
+        url = urlsplit(self.path)
+        key = None
+        for endpoint, (kind, detailed) in ENDPOINTS.items():
+            if url.path.endswith('/' + endpoint):
+                key = kind
+                break
+        if key is None:
+            self.send_error(404)
+            return
+        if self.server.capacity is None:
+            self._answer(url, key, detailed)
+        else:
+            with self.server.capacity:
+                self._answer(url, key, detailed)
+
+    def _answer(self, url, key, detailed=True):
+        latency = self.server.latency
+        if isinstance(latency, dict):
+            latency = latency.get(key)
+        if latency:
+            self.server.stopping.wait(latency)
+        query = parse_qs(url.query)
+        count = self.server.counts.get(key, 0)
+        indexes = range(count)
+        tenants = self.server.tenants
+        tenant = query.get('tenant_id') or query.get('project_id')
+        if tenant:
+            tenant = self.server.tenant_index(tenant[0])
+            indexes = [] if tenant is None else range(tenant, count, tenants)
+        start = 0
+        if 'marker' in query:
+            index = self.server.index_of(key, query['marker'][0])
+            if index is None:
+                self.send_error(400)
+                return
+            start = bisect.bisect_right(indexes, index)
+        limit = self.server.max_limit
+        if 'limit' in query:
+            limit = min(int(query['limit'][0]), limit or float('inf'))
+        end = len(indexes)
+        if limit:
+            end = min(end, start + int(limit))
+        if not detailed:
+            records = [summary(key, indexes[i], tenants)
+                       for i in range(start, end)]
+        elif key in TENANT_RECORDS:
+            records = [RECORDS[key](indexes[i], tenants=tenants)
+                       for i in range(start, end)]
+        else:
+            records = [RECORDS[key](indexes[i]) for i in range(start, end)]
+        document = {key: records}
+        if end < len(indexes):
+            query['marker'] = [str(records[-1]['id'])]
+            href = "http://%s%s?%s" % (
+                self.headers.get('Host'), url.path,
+                '&'.join("%s=%s" % (k, v[0]) for k, v in query.items()))
+            document["%s_links" % key] = [{'href': href, 'rel': 'next'}]
+        body = json.dumps(document).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip_compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self._send(body)
+
+    def _send(self, body, chunk_size=16384):
+        bandwidth = self.server.bandwidth
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(float(len(chunk)) / bandwidth)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the connections of the bursts wait in the backlog, not in SYN retries
+    request_queue_size = 128
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.lock = threading.Lock()
+        self.faults = []
+        self.requests = 0
+        # the ids of the records, for the markers, and of the tenants
+        self.indexes = {}
+        self.tenant_indexes = None
+        # cuts the hangs short
+        self.stopping = threading.Event()
+        self.hanging = []
+
+    def handle_error(self, request, client_address):
+        # the clients give up on the hung requests and close the socket
+        if not isinstance(sys.exc_info()[1], IOError):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def index_of(self, key, marker):
+        """Index of the record of a listing by its id, None when unknown"""
+        with self.lock:
+            if key not in self.indexes:
+                self.indexes[key] = dict(
+                    (record_id(key, i), i)
+                    for i in range(self.counts.get(key, 0)))
+            return self.indexes[key].get(marker)
+
+    def tenant_index(self, tenant):
+        """Index of a tenant by its id, None when unknown"""
+        with self.lock:
+            if self.tenant_indexes is None:
+                self.tenant_indexes = dict((_uuid('tenant', i), i)
+                                           for i in range(self.tenants))
+            return self.tenant_indexes.get(tenant)
+
+    def next_fault(self):
+        with self.lock:
+            self.requests += 1
+            if self.faults:
+                return self.faults.pop(0)
+
+
+class FakeAPI:
+    """HTTP server of the listings, running in a thread.
+
+    `counts` gives the number of records of each kind of listing, like
+    {'servers': 10000}.  `bandwidth` is in bytes per second, unlimited
+    when None.  `latency` is the time taken to answer, in seconds, or
+    the one of each kind of listing, like {'servers': 0.5}.  At most
+    `capacity` requests are answered at once, unlimited when None.  The
+    pages have at most `max_limit` records, whatever the `limit`.  The
+    servers, volumes and stacks belong to `tenants` tenants.
+    """
+
+    def __init__(self, counts, bandwidth=None, host='127.0.0.1', port=0,
+                 latency=None, capacity=None, max_limit=None, tenants=100):
+        self.server = Server((host, port), Handler)
+        self.server.counts = counts
+        self.server.max_limit = max_limit
+        self.server.tenants = tenants
+        self.server.bandwidth = bandwidth
+        self.server.latency = latency
+        self.server.capacity = None
+        if capacity:
+            self.server.capacity = threading.Semaphore(capacity)
+        self.thread = None
+
+    @property
+    def requests(self):
+        """Number of requests received"""
+        return self.server.requests
+
+    def hang(self, seconds, count=1):
+        """Answer the next `count` requests after `seconds`"""
+        with self.server.lock:
+            self.server.faults.extend([('hang', seconds)] * count)
+
+    def fail(self, status=503, count=1):
+        """Fail the next `count` requests with an HTTP error"""
+        with self.server.lock:
+            self.server.faults.extend([('error', status)] * count)
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d/v2/tenant" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.stopping.set()
+        for thread in self.server.hanging:
+            thread.join(1)
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,92 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the cassettes of the HTTP exchanges
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""The listings multiplied by `cassette.multiply`, and the bodies of
+`cassette.Recorder` replayed by `cassette.Player`.
+
+    python -m unittest discover -s tests
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lib'))
+
+from collectd_openstack import cassette
+
+URL = 'http://cloud:8774/v2/servers/detail'
+DOCUMENT = {'servers': [{'id': 'a', 'status': 'ACTIVE'}]}
+
+
+def deflate(data, wbits):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+class MultiplyTest(unittest.TestCase):
+
+    def multiply(self, document):
+        return json.loads(cassette.multiply(
+            json.dumps(document).encode('utf-8'), 3).decode('utf-8'))
+
+    def test_resources(self):
+        self.assertEqual([server['id'] for server in
+                          self.multiply(DOCUMENT)['servers']],
+                         ['a', 'a-1', 'a-2'])
+
+    def test_tenants(self):
+        # requested again by their ids
+        for key in ('tenants', 'projects'):
+            document = {key: [{'id': 'a', 'name': 'admin'}]}
+            self.assertEqual(self.multiply(document), document)
+
+
+class RecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.cassette')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replayed(self, body, encoding):
+        recorder = cassette.Recorder(self.path)
+        recorder.record('GET', URL, 200, 'OK', [], body, 0.1, encoding)
+        recorder.close()
+        return cassette.Player(self.path).answer('GET', URL)['data']
+
+    def test_encodings(self):
+        data = json.dumps(DOCUMENT).encode('utf-8')
+        for encoding, body in (('', data),
+                               ('gzip', deflate(data, 16 + zlib.MAX_WBITS)),
+                               ('deflate', deflate(data, zlib.MAX_WBITS)),
+                               # without the zlib header
+                               ('deflate', deflate(data, -zlib.MAX_WBITS))):
+            self.assertEqual(json.loads(self.replayed(body, encoding)
+                                        .decode('utf-8')), DOCUMENT)
+
+
+if __name__ == '__main__':
+    unittest.main()
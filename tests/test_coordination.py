@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the leader election between collector nodes
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Contention and expiry of the leases of the `coordination` backends,
+and their renewal by `LeaderElector` between the reads.
+
+    python -m unittest discover -s tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lib'))
+
+from collectd_openstack import coordination
+
+
+class BackendTests:
+    """Checks of a backend, made by `backend()`"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_contention(self):
+        backend = self.backend()
+        self.assertTrue(backend.acquire('nova', 'a', 10))
+        self.assertFalse(backend.acquire('nova', 'b', 10))
+        # renewed by its holder, the other leases are apart
+        self.assertTrue(backend.acquire('nova', 'a', 10))
+        self.assertTrue(backend.acquire('cinder', 'b', 10))
+
+    def test_concurrent(self):
+        winners = []
+
+        def acquire(member):
+            # a backend per thread, like the nodes
+            if self.backend().acquire('nova', member, 10):
+                winners.append(member)
+        threads = [threading.Thread(target=acquire, args=('node-%d' % i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(winners), 1)
+
+    def test_expiry(self):
+        backend = self.backend()
+        self.assertTrue(backend.acquire('nova', 'a', 0.2))
+        self.assertFalse(backend.acquire('nova', 'b', 0.2))
+        time.sleep(0.3)
+        self.assertTrue(backend.acquire('nova', 'b', 0.2))
+        self.assertFalse(backend.acquire('nova', 'a', 0.2))
+
+    def test_release(self):
+        backend = self.backend()
+        self.assertTrue(backend.acquire('nova', 'a', 10))
+        # only by its holder
+        backend.release('nova', 'b')
+        self.assertFalse(backend.acquire('nova', 'b', 10))
+        backend.release('nova', 'a')
+        self.assertTrue(backend.acquire('nova', 'b', 10))
+
+
+class FileBackendTest(BackendTests, unittest.TestCase):
+
+    def backend(self):
+        return coordination.FileBackend(self.directory)
+
+
+class SQLiteBackendTest(BackendTests, unittest.TestCase):
+
+    def backend(self):
+        return coordination.SQLiteBackend(
+            os.path.join(self.directory, 'leases.db'))
+
+
+class ElectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conf = {'backend': 'file', 'path': self.directory,
+                     'lease_time': 0.3, 'member_id': None}
+        self.electors = []
+
+    def tearDown(self):
+        for elector in self.electors:
+            elector.release()
+        shutil.rmtree(self.directory)
+
+    def elector(self, member, **conf):
+        conf = dict(self.conf, member_id=member, **conf)
+        elector = coordination.elector_from_config('nova', conf)
+        self.electors.append(elector)
+        return elector
+
+    def test_renewed(self):
+        leader = self.elector('a')
+        follower = self.elector('b')
+        self.assertTrue(leader.is_leader())
+        # no read of the leader for several lease times
+        time.sleep(1)
+        self.assertFalse(follower.is_leader())
+        self.assertTrue(leader.leader)
+
+    def test_takeover(self):
+        leader = self.elector('a')
+        follower = self.elector('b')
+        self.assertTrue(leader.is_leader())
+        self.assertFalse(follower.is_leader())
+        leader.release()
+        # taken by the timer of the follower, before its next read
+        time.sleep(0.3)
+        self.assertTrue(follower.leader)
+
+    def test_lease_time(self):
+        schedule = {'interval': 10, 'min_interval': None}
+        self.assertRaises(ValueError, coordination.elector_from_config,
+                          'nova', dict(self.conf, lease_time=10),
+                          schedule=schedule)
+        self.elector('a', lease_time=3).release()
+
+
+if __name__ == '__main__':
+    unittest.main()
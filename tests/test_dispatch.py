@@ -0,0 +1,88 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the batched dispatch of the values
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Values dispatched by `dispatch.Dispatcher`, copied at dispatch like
+collectd does.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lib'))
+
+from collectd_openstack import dispatch
+
+
+class Collectd:
+    """Records the dispatched values"""
+
+    def __init__(self):
+        self.dispatched = []
+        self.created = 0
+
+    def Values(self):
+        self.created += 1
+        collectd = self
+
+        class Values:
+            plugin = plugin_instance = type = type_instance = host = ''
+            interval = time = 0
+            values = []
+
+            def dispatch(self):
+                collectd.dispatched.append(
+                    (self.plugin, self.plugin_instance, self.type,
+                     self.type_instance, list(self.values), self.time))
+        return Values()
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collectd = Collectd()
+        self.dispatcher = dispatch.Dispatcher(self.collectd)
+
+    def test_flush(self):
+        self.dispatcher.add({'active': 3, 'error': 1}, 'nova', 'instances',
+                            date=10)
+        self.dispatcher.add([1, 2, 3], 'nova', 'flavor_resources', 'small',
+                            date=10)
+        self.dispatcher.add(7, 'cinder', 'volumes', 'count', 'lvm')
+        self.assertEqual(self.dispatcher.flush(), 4)
+        self.assertEqual(sorted(self.collectd.dispatched), [
+            ('cinder', 'lvm', 'volumes', 'count', [7], 0),
+            ('nova', '', 'flavor_resources', 'small', [1, 2, 3], 10),
+            ('nova', '', 'instances', 'active', [3], 10),
+            ('nova', '', 'instances', 'error', [1], 10),
+        ])
+
+    def test_reused(self):
+        for read in range(2):
+            self.dispatcher.add({'active': read}, 'nova', 'instances')
+            self.dispatcher.flush()
+        self.assertEqual(self.collectd.created, 1)
+        self.assertEqual([values for _, _, _, _, values, _ in
+                          self.collectd.dispatched], [[0], [1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the Prometheus exposition of the last reads
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""`exposition.Exposition` rendering the values handed to its sources,
+and the configuration of its server.
+
+    python -m unittest discover -s tests
+"""
+import gzip
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lib'))
+
+from collectd_openstack import exposition
+
+
+class Node:
+
+    def __init__(self, key, values=(), children=()):
+        self.key = key
+        self.values = values
+        self.children = children
+
+
+def record(value, type_instance):
+    return ([value], 'nova', 'instances', type_instance, '', 'cloud', 0)
+
+
+class ExpositionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.exposition = exposition.Exposition()
+        self.source = self.exposition.source('nova')
+
+    def test_update_renders(self):
+        self.source.update([record(3, 'active')])
+        self.assertEqual(self.exposition.renders, 1)
+        text = self.exposition.render()
+        self.assertTrue(b'openstack_nova_instances{host="cloud",'
+                        b'type_instance="active"} 3\n' in text)
+        self.assertTrue(text.endswith(b'# EOF\n'))
+        compressed = self.exposition.render(compressed=True)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed))
+                         .read(), text)
+        # the scrapes serve the text as is
+        self.exposition.render()
+        self.assertEqual(self.exposition.renders, 1)
+
+    def test_last_values(self):
+        self.source.update([record(3, 'active')])
+        self.source.update([record(4, 'active')])
+        self.assertEqual(self.exposition.renders, 2)
+        self.assertTrue(b'type_instance="active"} 4\n' in
+                        self.exposition.render())
+
+
+class ConfigTest(unittest.TestCase):
+
+    def test_default_address(self):
+        conf = exposition.parse_config(Node('Exposition'))
+        self.assertEqual(conf, {'address': '127.0.0.1',
+                                'port': exposition.DEFAULT_PORT})
+
+    def test_address(self):
+        conf = exposition.parse_config(Node('Exposition', children=[
+            Node('Address', ['0.0.0.0']), Node('Port', [9191])]))
+        self.assertEqual(conf, {'address': '0.0.0.0', 'port': 9191})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, exposition.parse_config,
+                          Node('Exposition', children=[Node('Port', [0])]))
+
+
+if __name__ == '__main__':
+    unittest.main()
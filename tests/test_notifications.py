@@ -0,0 +1,196 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the event driven counters with the memory transport
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""`notifications.Tally` and `Consumer` fed by the memory transport, and
+the `interpret` of the notifications of nova by collectd-instances-stats.
+
+    python -m unittest discover -s tests
+"""
+import collections
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+
+from collectd_openstack import notifications
+
+Server = collections.namedtuple('Server', ['status', 'flavor'])
+
+
+def contribution(server):
+    return [(('instances', server.status), 1),
+            (('flavors', server.flavor), 1)]
+
+
+def load_plugin(name):
+    """Namespace of a plugin of lib/ loaded with the proxy collectd"""
+    path = os.path.join(ROOT, 'bin', 'collectd-cli.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('collectd_cli', path)
+        cli = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(cli)
+    except ImportError:
+        import imp
+        cli = imp.load_source('collectd_cli', path)
+    return cli.load_plugin(os.path.join(ROOT, 'lib', name), cli.Collectd())
+
+
+def notification(event_type, server_id, stamp, state='active'):
+    return {
+        'event_type': event_type,
+        'timestamp': '2014-06-01 10:00:%02d.000000' % stamp,
+        'payload': {'instance_id': server_id, 'state': state,
+                    'instance_flavor_id': '1', 'tenant_id': 'tenant'},
+    }
+
+
+# 2014-06-01 10:00:00 UTC
+EPOCH = 1401616800
+
+
+class TallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tally = notifications.Tally(contribution)
+
+    def test_update(self):
+        self.tally.update('a', Server('active', 'small'), 1)
+        self.tally.update('b', Server('active', 'large'), 1)
+        self.tally.update('a', Server('error', None), 2)
+        self.assertEqual(self.tally.nested(), {
+            'instances': {'active': 1, 'error': 1},
+            'flavors': {'small': 1, 'large': 1},
+        })
+        self.assertEqual(self.tally.pop_churn(), [2, 0, 1])
+
+    def test_remove(self):
+        self.tally.update('a', Server('active', 'small'), 1)
+        self.assertTrue(self.tally.remove('a', 2))
+        self.assertEqual(self.tally.nested(), {
+            'instances': {'active': 0}, 'flavors': {'small': 0}})
+        # a late update of a deleted server
+        self.assertFalse(self.tally.update('a', Server('active', 'small'),
+                                           1))
+
+    def test_stale(self):
+        self.tally.update('a', Server('active', 'small'), 5)
+        self.assertFalse(self.tally.update('a', Server('error', 'small'), 4))
+        self.assertFalse(self.tally.remove('a', 4))
+        self.assertEqual(self.tally.get('a'), Server('active', 'small'))
+
+    def test_reset(self):
+        self.tally.update('a', Server('active', 'small'), 1)
+        drift = self.tally.reset([('a', Server('active', 'small')),
+                                  ('b', Server('active', 'small'))], 10)
+        # one more active server and small flavor
+        self.assertEqual(drift, 2)
+        self.assertFalse(self.tally.update('c', Server('active', 'small'),
+                                           9))
+
+
+class ConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = EPOCH
+        self.transport = notifications.MemoryTransport({'queue': self.id()})
+        self.consumer = notifications.Consumer(
+            self.transport, self.interpret, notifications.Tally(contribution),
+            interval=60, batch=2, clock=lambda: self.now)
+
+    def interpret(self, event_type, payload):
+        if event_type == 'delete':
+            return [(notifications.REMOVE, payload['id'], None)]
+        return [(notifications.UPDATE, payload['id'],
+                 Server(payload['status'], 'small'))]
+
+    def publish(self, event_type, server_id, stamp, status='active'):
+        self.transport.publish({
+            'event_type': event_type,
+            'timestamp': '2014-06-01 10:00:%02d' % stamp,
+            'payload': {'id': server_id, 'status': status}})
+
+    def test_drain(self):
+        self.consumer.reconcile([], EPOCH)
+        for i in range(5):
+            self.publish('update', 'server-%d' % i, 1)
+        self.publish('delete', 'server-0', 2)
+        self.assertEqual(self.consumer.drain(), 6)
+        self.assertEqual(self.consumer.tally.counters[('instances', 'active')],
+                         4)
+        self.assertEqual(self.consumer.metrics(), [6, 6, 0])
+
+    def test_reconcile(self):
+        self.assertTrue(self.consumer.due())
+        self.consumer.reconcile([('a', Server('active', 'small'))], EPOCH)
+        self.assertEqual(self.consumer.drift, None)
+        self.assertFalse(self.consumer.due())
+        # before the listing, then during it
+        self.publish('update', 'a', 5, 'error')
+        self.publish('update', 'b', 15)
+        self.now += 60
+        self.assertTrue(self.consumer.due())
+        self.consumer.reconcile([('a', Server('active', 'small'))],
+                                EPOCH + 10)
+        self.assertEqual(self.consumer.metrics(), [2, 1, 1])
+        self.assertEqual(self.consumer.tally.nested()['instances'],
+                         {'active': 2})
+        # the error of a was not seen by the listing
+        self.assertEqual(self.consumer.drift, 0)
+
+
+class InstancesInterpretTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.utils = load_plugin('collectd-instances-stats.py')[
+            'OpenstackUtils']()
+
+    def interpret(self, event_type, **args):
+        return self.utils.interpret(
+            event_type, notification(event_type, 'a', 0, **args)['payload'])
+
+    def test_update(self):
+        changes = self.interpret('compute.instance.update', state='stopped')
+        self.assertEqual(changes[0][:2], (notifications.UPDATE, 'a'))
+        self.assertEqual(changes[0][2].status, 'SHUTOFF')
+        self.assertEqual(self.interpret('compute.instance.power_on.end')[0][0],
+                         notifications.UPDATE)
+
+    def test_ignored(self):
+        self.assertEqual(self.interpret('compute.instance.create.start'),
+                         None)
+        # the hourly audit, sent for the deleted servers too
+        self.assertEqual(self.interpret('compute.instance.exists',
+                                        state='deleted'), None)
+        self.assertEqual(self.interpret('volume.create.end'), None)
+
+    def test_deleted(self):
+        self.assertEqual(self.interpret('compute.instance.delete.end'),
+                         [(notifications.REMOVE, 'a', None)])
+        for state in ('deleted', 'soft-delete'):
+            self.assertEqual(self.interpret('compute.instance.update',
+                                            state=state),
+                             [(notifications.REMOVE, 'a', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
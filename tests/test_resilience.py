@@ -0,0 +1,163 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the resilience of the reads against the fake API
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Breakers, retries and timeouts of `resilience.Guard` reading the
+listings of `fakeapi.FakeAPI` with the fast path.
+
+    python -m unittest discover -s tests
+"""
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lib'))
+
+from collectd_openstack import resilience
+from collectd_openstack import rest
+
+import fakeapi
+
+RECORD = rest.Projection('Record', [('id', 'id')])
+
+
+class Clock:
+    """Time moved by the test"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class GuardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = fakeapi.FakeAPI({'servers': 10}).start()
+        self.clock = Clock()
+        self.breaker = resilience.Breaker(
+            'compute', threshold=2, clock=self.clock,
+            cooldown=resilience.Backoff(base=30, cap=60, floor=1))
+
+    def tearDown(self):
+        self.client.close()
+        self.api.stop()
+
+    def guard(self, read_timeout=5, retries=0):
+        guard = resilience.Guard('compute', connect_timeout=5,
+                                 read_timeout=read_timeout, retries=retries,
+                                 breaker=self.breaker, sleep=lambda s: None)
+        self.client = rest.RestClient(self.api.endpoint, 'token',
+                                      timeout=guard.timeout)
+        return guard
+
+    def read(self):
+        return list(self.client.listing('servers/detail', 'servers', RECORD))
+
+    def test_retry(self):
+        guard = self.guard(retries=1)
+        self.api.fail(503)
+        self.assertEqual(len(guard.call(self.read)), 10)
+        self.assertEqual(self.api.requests, 2)
+        self.assertEqual(self.breaker.metrics()[0], resilience.CLOSED)
+
+    def test_breaker_opens(self):
+        guard = self.guard()
+        self.api.fail(503, count=2)
+        for _ in range(2):
+            self.assertRaises(rest.RestError, guard.call, self.read)
+        self.assertEqual(self.breaker.metrics(),
+                         [resilience.OPEN, 1, 2, 0])
+        # skipped without a request until the end of the cool-down
+        self.assertEqual(guard.call(self.read), None)
+        self.assertEqual(self.api.requests, 2)
+        self.assertEqual(self.breaker.metrics()[3], 1)
+
+    def test_not_transient(self):
+        guard = self.guard(retries=1)
+        self.api.fail(401, count=3)
+        for _ in range(3):
+            self.assertRaises(rest.RestError, guard.call, self.read)
+        # neither retried nor counted
+        self.assertEqual(self.api.requests, 3)
+        self.assertEqual(self.breaker.metrics(),
+                         [resilience.CLOSED, 0, 0, 0])
+
+    def test_half_open_recovers(self):
+        guard = self.guard()
+        self.api.fail(503, count=2)
+        for _ in range(2):
+            self.assertRaises(rest.RestError, guard.call, self.read)
+        self.clock.now += 30
+        self.assertEqual(len(guard.call(self.read)), 10)
+        self.assertEqual(self.breaker.metrics()[:3],
+                         [resilience.CLOSED, 1, 0])
+
+    def test_half_open_fails(self):
+        guard = self.guard()
+        self.api.fail(503, count=3)
+        for _ in range(2):
+            self.assertRaises(rest.RestError, guard.call, self.read)
+        self.clock.now += 30
+        # a single failure opens it again, for a longer cool-down
+        self.assertRaises(rest.RestError, guard.call, self.read)
+        self.assertEqual(self.breaker.metrics()[:2], [resilience.OPEN, 2])
+        self.clock.now += 30
+        self.assertEqual(guard.call(self.read), None)
+
+    def test_hang_times_out(self):
+        guard = self.guard(read_timeout=0.5)
+        self.api.hang(10)
+        start = time.time()
+        self.assertRaises(socket.timeout, guard.call, self.read)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(self.breaker.metrics()[2], 1)
+
+
+class GetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = fakeapi.FakeAPI({'servers': 10}).start()
+        self.client = rest.RestClient(self.api.endpoint, 'token')
+
+    def tearDown(self):
+        self.client.close()
+        self.api.stop()
+
+    def test_truncated(self):
+        request = self.client.request
+        bodies = []
+
+        def truncated(path):
+            body = request(path)
+            body.read = lambda size=None: b'{"servers": ['
+            bodies.append(body)
+            return body
+        self.client.request = truncated
+        self.assertRaises(ValueError, self.client.get, 'servers/detail')
+        # closed, not kept for the next request
+        self.assertEqual(self.client.connections, [])
+        self.assertEqual(bodies[0].connection.sock, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the service health of the service listings
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""The heartbeats parsed by `services.parse_time` and the counts of
+`services.ServiceHealth`.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'lib'))
+
+from collectd_openstack import services
+
+# 2014-06-01 10:00:00 UTC
+EPOCH = 1401616800
+
+
+class ParseTimeTest(unittest.TestCase):
+
+    def test_utc(self):
+        for value in ('2014-06-01T10:00:00.000000', '2014-06-01 10:00:00',
+                      '2014-06-01T10:00:00Z', '2014-06-01T10:00:00+00:00'):
+            self.assertEqual(services.parse_time(value), EPOCH)
+
+    def test_offset(self):
+        self.assertEqual(services.parse_time('2014-06-01T12:00:00+02:00'),
+                         EPOCH)
+        self.assertEqual(services.parse_time('2014-06-01T05:30:00.5-0430'),
+                         EPOCH)
+
+    def test_invalid(self):
+        for value in (None, '', 'yesterday', '2014-06-01',
+                      '2014-13-01 10:00:00', '2014-06-01T10:00:00+2'):
+            self.assertEqual(services.parse_time(value), None)
+
+
+class ServiceHealthTest(unittest.TestCase):
+
+    def test_summary(self):
+        fresh = '2014-06-01T10:00:30Z'
+        listing = [
+            services.Service('nova-compute', 'a', 'nova', True, True, fresh),
+            services.Service('nova-compute', 'b', 'nova', False, True,
+                             '2014-06-01T09:58:00Z'),
+            services.Service('nova-compute', 'c', 'nova', True, False,
+                             # a minute ahead, in another timezone
+                             '2014-06-01T11:00:30+01:00'),
+            services.Service('nova-scheduler', 'a', None, True, True, None),
+        ]
+        self.assertEqual(
+            services.ServiceHealth(60).summary(listing, EPOCH + 60), {
+                'nova-compute': [3, 2, 2, 1],
+                'nova-scheduler': [1, 1, 1, 1],
+            })
+
+
+if __name__ == '__main__':
+    unittest.main()
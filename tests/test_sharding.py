@@ -0,0 +1,209 @@
+# -*- encoding: utf-8 -*-
+#
+# Checks of the sharded collection over the local transport
+#
+# Copyright © 2014 eNovance <licensing@enovance.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Partition of the listings of the fake API between the nodes of
+`sharding.Sharding`, the read of the parts by collectd-instances-stats,
+and the exchange of the partials between nodes whose reads start at
+different phases of the interval.
+
+    python -m unittest discover -s tests
+"""
+import collections
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+
+from collectd_openstack import rest
+from collectd_openstack import sharding
+
+import fakeapi
+
+Item = collections.namedtuple('Item', ['id'])
+
+
+def load_plugin(name):
+    """Namespace of a plugin of lib/ loaded with the proxy collectd"""
+    path = os.path.join(ROOT, 'bin', 'collectd-cli.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('collectd_cli', path)
+        cli = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(cli)
+    except ImportError:
+        import imp
+        cli = imp.load_source('collectd_cli', path)
+    return cli.load_plugin(os.path.join(ROOT, 'lib', name), cli.Collectd())
+
+
+class Clock:
+    """Time moved by the test"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class PartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = ['id-%d' % i for i in range(10)]
+        self.parts = [sharding.Part(self.ids, index, 3)
+                      for index in range(3)]
+
+    def take(self, part, ids):
+        """The ids read by a part of a listing of `ids`"""
+        start = ids.index(part.marker) + 1 if part.marker else 0
+        return [item.id for item in part.take(Item(i) for i in ids[start:])]
+
+    def test_cover(self):
+        self.assertEqual([part.marker for part in self.parts],
+                         [None, 'id-2', 'id-5'])
+        read = [self.take(part, self.ids) for part in self.parts]
+        self.assertEqual(sum(read, []), self.ids)
+
+    def test_changed(self):
+        # created first in the listing, id-4 deleted, since the ids
+        ids = ['new'] + [i for i in self.ids if i != 'id-4']
+        read = [self.take(part, ids) for part in self.parts]
+        self.assertEqual(read[0], ['new', 'id-0', 'id-1', 'id-2'])
+        self.assertEqual(read[1], ['id-3', 'id-5'])
+        self.assertEqual(sum(read, []), ids)
+        self.assertTrue(self.parts[0].owns('new'))
+        self.assertFalse(self.parts[1].owns('new'))
+        self.assertTrue(self.parts[2].owns('id-9'))
+
+    def test_pages(self):
+        pages = []
+
+        def page(search_opts):
+            pages.append(search_opts.get('marker'))
+            start = int(search_opts.get('marker', '-1')) + 1
+            return [Item(str(i)) for i in
+                    range(start, min(start + search_opts['limit'], 7))]
+        items = list(sharding.pages(page, {'marker': '1'}, limit=2))
+        self.assertEqual([item.id for item in items], ['2', '3', '4', '5',
+                                                       '6'])
+        self.assertEqual(pages, ['1', '3', '5'])
+
+
+class ListingTest(unittest.TestCase):
+    """The servers of the fake API counted by three nodes"""
+
+    def setUp(self):
+        self.api = fakeapi.FakeAPI({'servers': 250}).start()
+        self.plugin = load_plugin('collectd-instances-stats.py')
+        transport = sharding.LocalTransport()
+        self.nodes = [sharding.Sharding(self.id(), index, 3, transport)
+                      for index in range(3)]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.api.stop()
+
+    def statuses(self, shard):
+        """Servers by status listed by the plugin with `shard`"""
+        utils = self.plugin['OpenstackUtils'](shard)
+        utils.rest_client = rest.RestClient(self.api.endpoint, 'token',
+                                            stream=True)
+        self.clients.append(utils.rest_client)
+        counts = {}
+        for vm in utils._list_servers(None):
+            counts[vm.status] = counts.get(vm.status, 0) + 1
+        return counts
+
+    def test_merged(self):
+        for node in self.nodes[1:]:
+            self.assertEqual(node.exchange(self.statuses(node)), None)
+        merged = self.nodes[0].exchange(self.statuses(self.nodes[0]))
+        self.assertEqual(merged, self.statuses(None))
+        self.assertEqual(merged, {'ACTIVE': 200, 'SHUTOFF': 25,
+                                  'ERROR': 25})
+
+    @unittest.skipIf(sys.version_info[0] > 2,
+                     "collectd-cinder-stats only runs on python 2")
+    def test_volumes(self):
+        cinder = load_plugin('collectd-cinder-stats.py')
+        self.api.server.counts['volumes'] = 100
+        types = []
+        for node in self.nodes:
+            utils = cinder['OpenstackUtils'](None, node)
+            utils.rest_client = rest.RestClient(self.api.endpoint, 'token')
+            self.clients.append(utils.rest_client)
+            types.extend(volume.volume_type for volume in utils._list(
+                None, 'volumes', cinder['VOLUME'],
+                cinder['VOLUME_INDEX']).result())
+            # the types of the volumes of the other parts too
+            self.assertEqual(len(utils.volume_index), 100)
+        self.assertEqual(len(types), 100)
+        self.assertEqual(types.count('type-0'), 34)
+
+    def test_requests(self):
+        self.statuses(self.nodes[1])
+        # the ids, then the servers from the marker of the part
+        self.assertEqual(self.api.requests, 2)
+
+
+class ExchangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        transport = sharding.LocalTransport()
+        self.nodes = [sharding.Sharding(self.id(), index, 3, transport,
+                                        interval=10, clock=self.clock)
+                      for index in range(3)]
+
+    def read(self, index, count):
+        return self.nodes[index].exchange({'servers': {'ACTIVE': count}})
+
+    def test_phases(self):
+        # the merger reads first in the interval, the others later
+        self.assertEqual(self.read(0, 1), None)
+        self.assertEqual(self.nodes[0].missing, [1, 2])
+        self.clock.now += 3
+        self.assertEqual(self.read(1, 2), None)
+        self.clock.now += 4
+        self.assertEqual(self.read(2, 4), None)
+        # the next interval merges the partials of the previous one
+        self.clock.now += 3
+        self.assertEqual(self.read(0, 8), {'servers': {'ACTIVE': 14}})
+        self.assertEqual(self.nodes[0].missing, [])
+
+    def test_stale(self):
+        self.read(1, 2)
+        self.read(2, 4)
+        self.clock.now += 16
+        self.read(2, 4)
+        self.assertEqual(self.read(0, 1), None)
+        self.assertEqual(self.nodes[0].missing, [1])
+
+    def test_merge(self):
+        self.assertEqual(sharding.merge({'a': [1, 2], 'b': 1},
+                                        {'a': [1], 'c': 2}),
+                         {'a': [2, 2], 'b': 1, 'c': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()